@@ -15,12 +15,17 @@ import json
 from beautifultable import BeautifulTable
 from sqlalchemy.exc import OperationalError
 
+from hpcflow.benchmark import benchmark_copytree as _benchmark_copytree
+from hpcflow.benchmark import benchmark_cloud_archive as _benchmark_cloud_archive
 from hpcflow.config import Config
 from hpcflow.init_db import init_db
-from hpcflow.models import Workflow, CommandGroupSubmission
+from hpcflow.models import Workflow, CommandGroupSubmission, IterationStatus
 from hpcflow.profiles import parse_job_profiles, prepare_workflow_dict
 from hpcflow.project import Project
+from hpcflow.staging import stage_in as _stage_in, stage_out as _stage_out
+from hpcflow.task_log import append_task_log as _append_task_log
 from hpcflow.archive.cloud.cloud import CloudProvider
+from hpcflow.archive.pack import extract_files
 
 
 def make_workflow(dir_path=None, profile_list=None, json_file=None, json_str=None,
@@ -94,6 +99,9 @@ def make_workflow(dir_path=None, profile_list=None, json_file=None, json_str=Non
     session.add(workflow)
     session.commit()
 
+    # Root archive (and resolution of cloud archive directories) runs in the background:
+    workflow.start_root_archive()
+
     workflow_id = workflow.id_
     session.close()
 
@@ -218,11 +226,13 @@ def set_task_start(cmd_group_sub_id, task_idx, iter_idx, dir_path=None, config_d
     block_msg = (f'{{}} api.set_task_start: Database locked. Sleeping for {sleep_time} '
                  f'seconds')
 
+    wait_start = datetime.now()
     blocked = True
     while blocked:
         try:
             session.refresh(cg_sub)
-            cg_sub.set_task_start(task_idx, iter_idx)
+            start_wait = (datetime.now() - wait_start).total_seconds()
+            cg_sub.set_task_start(task_idx, iter_idx, start_wait)
             session.commit()
             blocked = False
         except OperationalError:
@@ -250,7 +260,131 @@ def set_task_end(cmd_group_sub_id, task_idx, iter_idx, dir_path=None, config_dir
     while blocked:
         try:
             session.refresh(cg_sub)
-            cg_sub.set_task_end(task_idx, iter_idx)
+            is_last = cg_sub.set_task_end(task_idx, iter_idx)
+            session.commit()
+            blocked = False
+        except OperationalError:
+            # Database is likely locked.
+            session.rollback()
+            print(block_msg.format(datetime.now()), flush=True)
+            sleep(sleep_time)
+
+    if cg_sub.command_group.auto_throttle and is_last:
+        # Done after the task end is committed, by the last task of the iteration to end:
+        blocked = True
+        while blocked:
+            try:
+                session.refresh(cg_sub)
+                cg_sub.throttle_next_iteration(iter_idx)
+                session.commit()
+                blocked = False
+            except OperationalError:
+                # Database is likely locked.
+                session.rollback()
+                print(block_msg.format(datetime.now()), flush=True)
+                sleep(sleep_time)
+
+    if cg_sub.input_cache_dir and is_last:
+        # Remove the alternate scratch input cache once all tasks that use it have
+        # completed (only checked by the last task of each iteration to end):
+        blocked = True
+        while blocked:
+            try:
+                session.refresh(cg_sub)
+                in_use = cg_sub.submission.is_input_cache_in_use()
+                blocked = False
+            except OperationalError:
+                # Database is likely locked.
+                session.rollback()
+                print(block_msg.format(datetime.now()), flush=True)
+                sleep(sleep_time)
+        if not in_use:
+            cg_sub.submission.evict_input_caches()
+
+    session.close()
+
+
+def release_dependent_tasks(cmd_group_sub_id, task_idx, iter_idx, dir_path=None,
+                            config_dir=None):
+    """Mark the outputs of a task as finalised (i.e. staged out and archived), and
+    release those held tasks of the downstream (partial hold) command group whose
+    upstream tasks have now all finalised their outputs.
+
+    Parameters
+    ----------
+    cmd_group_sub_id : int
+        ID of the command group submission to which the finalised task belongs.
+    task_idx : int
+        The task index that has finalised its outputs.
+    iter_idx : int
+        The iteration index.
+    dir_path : str or Path, optional
+        The directory in which the Workflow exists. By default, this is the working
+        (i.e. invoking) directory.
+
+    """
+
+    project = Project(dir_path, config_dir)
+    Session = init_db(project, check_exists=True)
+    session = Session()
+
+    cg_sub = session.query(CommandGroupSubmission).get(cmd_group_sub_id)
+
+    sleep_time = 5
+    block_msg = (f'{{}} api.release_dependent_tasks: Database locked. Sleeping for '
+                 f'{sleep_time} seconds')
+
+    blocked = True
+    while blocked:
+        try:
+            session.refresh(cg_sub)
+            cg_sub.set_task_outputs_finalised(task_idx, iter_idx)
+            cg_sub.release_dependent_tasks(iter_idx)
+            session.commit()
+            blocked = False
+        except OperationalError:
+            # Database is likely locked.
+            session.rollback()
+            print(block_msg.format(datetime.now()), flush=True)
+            sleep(sleep_time)
+
+    session.close()
+
+
+def check_loop(cmd_group_sub_id, task_idx, iter_idx, dir_path=None, config_dir=None):
+    """Check for completion of a dynamic loop iteration, and if the iteration is complete,
+    evaluate the loop convergence command and submit the next iteration or the post-loop
+    command groups.
+
+    Parameters
+    ----------
+    cmd_group_sub_id : int
+        ID of the command group submission that is the final command group in the loop.
+    task_idx : int
+        The task index that has finished.
+    iter_idx : int
+        The loop iteration index.
+    dir_path : str or Path, optional
+        The directory in which the Workflow exists. By default, this is the working
+        (i.e. invoking) directory.
+
+    """
+
+    project = Project(dir_path, config_dir)
+    Session = init_db(project, check_exists=True)
+    session = Session()
+
+    cg_sub = session.query(CommandGroupSubmission).get(cmd_group_sub_id)
+
+    sleep_time = 5
+    block_msg = (f'{{}} api.check_loop: Database locked. Sleeping for {sleep_time} '
+                 f'seconds')
+
+    blocked = True
+    while blocked:
+        try:
+            session.refresh(cg_sub)
+            cg_sub.check_loop(project, task_idx, iter_idx)
             session.commit()
             blocked = False
         except OperationalError:
@@ -304,6 +438,136 @@ def root_archive(workflow_id, dir_path=None, config_dir=None):
     session.close()
 
 
+def get_root_archive_status(workflow_id=None, dir_path=None, config_dir=None):
+    """Get the status of the root archive process of a Workflow.
+
+    Parameters
+    ----------
+    workflow_id : int, optional
+        By default, the most recently generated Workflow.
+    dir_path : str or Path, optional
+        The directory in which the Workflow exists. By default, this is the working (i.e.
+        invoking) directory.
+
+    Returns
+    -------
+    dict
+        With keys: "status" (one of "pending", "active", "complete" or "failed", or
+        None if no root archive is required), "pid", "directory", "start_time",
+        "end_time" and "duration".
+
+    """
+
+    project = Project(dir_path, config_dir)
+    Session = init_db(project, check_exists=True)
+    session = Session()
+
+    if workflow_id is None:
+        workflow = session.query(Workflow).order_by(Workflow.id_.desc()).first()
+    else:
+        workflow = session.query(Workflow).get(workflow_id)
+    if workflow is None:
+        session.close()
+        msg = 'No workflow with ID "{}" was found in directory: "{}"'
+        raise ValueError(msg.format(workflow_id, project.dir_path))
+
+    out = workflow.get_root_archive_status()
+
+    session.close()
+
+    return out
+
+
+def append_task_log(task_log_path, iter_dir, command_group_order, task_idx):
+    """Append a task's log file to the consolidated log of its job array.
+
+    This does not load the Workflow database, since it is invoked by each task of a
+    command group with `consolidate_logs` set, on exit.
+
+    """
+
+    _append_task_log(task_log_path, iter_dir, command_group_order, task_idx)
+
+
+def stage_in(src, dst, exclusion_list_path=None, manifest_path=None, max_workers=None,
+             input_cache_dir=None, input_cache_patterns=None, config_dir=None):
+    """Copy a task working directory to an alternate scratch directory. See
+    `hpcflow.staging.stage_in` for details."""
+
+    Config.set_config(config_dir)
+    return _stage_in(src, dst, exclusion_list_path=exclusion_list_path,
+                     manifest_path=manifest_path, max_workers=max_workers,
+                     input_cache_dir=input_cache_dir,
+                     input_cache_patterns=input_cache_patterns)
+
+
+def stage_out(src, dst, manifest_path=None, max_workers=None, config_dir=None):
+    """Move new or modified files from a task working directory on an alternate scratch
+    back to the task working directory. See `hpcflow.staging.stage_out` for
+    details."""
+
+    Config.set_config(config_dir)
+    return _stage_out(src, dst, manifest_path=manifest_path, max_workers=max_workers)
+
+
+def get_task_log(task_idx, command_group=0, iteration=0, workflow_id=None,
+                 dir_path=None, config_dir=None):
+    """Get the log of a task of the most recent submission of a Workflow.
+
+    Parameters
+    ----------
+    task_idx : int
+    command_group : int, optional
+        Execution order of the command group. By default, the first command group.
+    iteration : int, optional
+        Iteration index. By default, the first iteration.
+    workflow_id : int, optional
+        By default, the most recently generated Workflow.
+    dir_path : str or Path, optional
+        The directory in which the Workflow exists. By default, this is the working (i.e.
+        invoking) directory.
+
+    Returns
+    -------
+    str or None
+        The task log, or `None` if the task has not yet written a log.
+
+    """
+
+    project = Project(dir_path, config_dir)
+    Session = init_db(project, check_exists=True)
+    session = Session()
+
+    if workflow_id is None:
+        workflow = session.query(Workflow).order_by(Workflow.id_.desc()).first()
+    else:
+        workflow = session.query(Workflow).get(workflow_id)
+    if workflow is None:
+        session.close()
+        msg = 'No workflow with ID "{}" was found in directory: "{}"'
+        raise ValueError(msg.format(workflow_id, project.dir_path))
+
+    if not workflow.submissions:
+        session.close()
+        raise ValueError('Workflow {} has not been submitted.'.format(workflow.id_))
+
+    submission = workflow.submissions[-1]
+    cg_subs = [i for i in submission.command_group_submissions
+               if i.command_group_exec_order == command_group]
+    iters = [i for i in workflow.iterations if i.order_id == iteration]
+    if not cg_subs or not iters:
+        session.close()
+        msg = 'No command group {} and iteration {} exist in workflow {}.'
+        raise ValueError(msg.format(command_group, iteration, workflow.id_))
+
+    try:
+        out = cg_subs[0].get_task_log(project.hf_dir, task_idx, iters[0])
+    finally:
+        session.close()
+
+    return out
+
+
 def get_scheduler_stats(cmd_group_sub_id, task_idx, iter_idx, dir_path=None,
                         config_dir=None):
     """Scrape completed task information from the scheduler.
@@ -421,9 +685,116 @@ def get_formatted_stats(dir_path=None, workflow_id=None, max_width=100,
 
                 out += str(task_table) + '\n\n'
 
+                runs = [(task, run) for task in cmd_group_sub['tasks']
+                        for run in task['archive_runs']]
+                if runs:
+                    out += 'Archive runs:\n'
+                    out += get_formatted_archive_runs(runs, max_width) + '\n\n'
+
     return out
 
 
+def get_formatted_archive_runs(runs, max_width=100):
+    """Format archive run statistics like a table.
+
+    Parameters
+    ----------
+    runs : list of tuple of (dict, dict)
+        The statistics of each archiving task and of its archive run, as returned by
+        `get_stats`.
+
+    """
+
+    run_table = BeautifulTable(max_width=max_width)
+    run_table.set_style(BeautifulTable.STYLE_BOX)
+    run_table.row_separator_char = ''
+    run_table.column_headers = [
+        'It.',
+        '#',
+        'Tasks',
+        'Wait/s',
+        'Debounce/s',
+        'Copy/s',
+        'Files',
+        'Skipped',
+        'MB',
+        'MB/s',
+        'API calls',
+    ]
+
+    for task, run in runs:
+        if run['success']:
+            num_bytes = run['bytes_copied']
+            rate = run['bytes_per_second']
+            row_stats = [
+                '{}/{}'.format(run['files_copied'], run['files_considered']),
+                run['files_skipped'],
+                '{:.1f}'.format(num_bytes / 2**20),
+                '{:.1f}'.format(rate / 2**20) if rate is not None else '-',
+            ]
+        else:
+            row_stats = ['failed', '-', '-', '-']
+        run_table.append_row([
+            task['iteration'],
+            task['order_id'],
+            run['num_tasks'],
+            '{:.1f}'.format(run['lock_wait']),
+            '{:.1f}'.format(run['debounce_wait'] or 0),
+            '{:.1f}'.format(run['copy_duration']),
+        ] + row_stats + [
+            sum((run['api_calls'] or {}).values()) or '-',
+        ])
+
+    return str(run_table)
+
+
+def get_throttle_recommendations(dir_path=None, workflow_id=None, config_dir=None,
+                                 max_wait=None):
+    """Get the recommended maximum number of concurrently running tasks for each
+    command group submission iteration, given the observed lock contention.
+
+    Parameters
+    ----------
+    max_wait : float, optional
+        Maximum acceptable mean lock wait time in seconds. By default, taken from the
+        `throttle_max_wait` configuration item.
+
+    Returns
+    -------
+    recommendations : list of dict
+
+    """
+
+    project = Project(dir_path, config_dir)
+    Session = init_db(project, check_exists=True)
+    session = Session()
+
+    query = session.query(Workflow)
+    if workflow_id:
+        query = query.filter(Workflow.id_ == workflow_id)
+
+    recommendations = []
+    for workflow in query:
+        for sub in workflow.submissions:
+            for cg_sub in sub.command_group_submissions:
+                for cg_sub_iter in cg_sub.command_group_submission_iterations:
+                    if cg_sub_iter.iteration.status == IterationStatus('pending'):
+                        continue
+                    recommendations.append({
+                        'workflow_id': workflow.id_,
+                        'submission_id': sub.id_,
+                        'command_group_submission_id': cg_sub.id_,
+                        'iteration': cg_sub_iter.iteration.order_id,
+                        'contention': cg_sub_iter.get_contention_curve(),
+                        'max_running_tasks': cg_sub_iter.max_running_tasks,
+                        'recommended': cg_sub_iter.recommend_max_running_tasks(max_wait),
+                    })
+
+    session.close()
+
+    return recommendations
+
+
 def save_stats(save_path, dir_path=None, workflow_id=None, config_dir=None):
     """Save task statistics as a JSON file."""
 
@@ -466,6 +837,38 @@ def kill(dir_path=None, workflow_id=None, config_dir=None):
     session.close()
 
 
+def benchmark_copytree(dir_path, num_small=2000, small_size_KB=16, num_large=4,
+                       large_size_MB=1024, max_workers=None, repeats=3, config_dir=None):
+    """Compare the performance of the serial and parallel directory tree copiers used
+    for archiving. See `hpcflow.benchmark.benchmark_copytree` for details."""
+
+    Config.set_config(config_dir)
+    return _benchmark_copytree(dir_path, num_small=num_small, small_size_KB=small_size_KB,
+                               num_large=num_large, large_size_MB=large_size_MB,
+                               max_workers=max_workers, repeats=repeats)
+
+
+def benchmark_cloud_archive(dir_path, num_small=2000, small_size_KB=16, num_large=4,
+                            large_size_MB=64, latency=0.05, bandwidth_MB=50,
+                            config_dir=None):
+    """Time cloud archiving using the mock cloud provider. See
+    `hpcflow.benchmark.benchmark_cloud_archive` for details."""
+
+    Config.set_config(config_dir)
+    return _benchmark_cloud_archive(
+        dir_path, num_small=num_small, small_size_KB=small_size_KB,
+        num_large=num_large, large_size_MB=large_size_MB, latency=latency,
+        bandwidth_MB=bandwidth_MB)
+
+
+def extract_archive(packed_dir, dst_dir, members=None, config_dir=None):
+    """Extract files from a packed archive directory. See
+    `hpcflow.archive.pack.extract_files` for details."""
+
+    Config.set_config(config_dir)
+    return extract_files(packed_dir, dst_dir, members=members)
+
+
 def update_config(name, value, config_dir=None):
     Config.update(name, value, config_dir=config_dir)
 
@@ -488,3 +891,47 @@ def cloud_connect(provider, config_dir=None):
         print('Getting new cloud token.')
         token = provider.get_token()
         update_config(token_key, token, config_dir=config_dir)
+
+
+def release_orphaned_tasks(cmd_group_sub_id, iter_idx, dir_path=None, config_dir=None):
+    """Once all tasks of a command group submission iteration have finished (whether or
+    not they completed), release those held tasks of the downstream (partial hold)
+    command group whose upstream tasks have all finalised their outputs, and delete the
+    remaining held tasks, which would otherwise never be released.
+
+    Parameters
+    ----------
+    cmd_group_sub_id : int
+        ID of the upstream command group submission.
+    iter_idx : int
+        The iteration index.
+    dir_path : str or Path, optional
+        The directory in which the Workflow exists. By default, this is the working
+        (i.e. invoking) directory.
+
+    """
+
+    project = Project(dir_path, config_dir)
+    Session = init_db(project, check_exists=True)
+    session = Session()
+
+    cg_sub = session.query(CommandGroupSubmission).get(cmd_group_sub_id)
+
+    sleep_time = 5
+    block_msg = (f'{{}} api.release_orphaned_tasks: Database locked. Sleeping for '
+                 f'{sleep_time} seconds')
+
+    blocked = True
+    while blocked:
+        try:
+            session.refresh(cg_sub)
+            cg_sub.release_dependent_tasks(iter_idx, delete_orphans=True)
+            session.commit()
+            blocked = False
+        except OperationalError:
+            # Database is likely locked.
+            session.rollback()
+            print(block_msg.format(datetime.now()), flush=True)
+            sleep(sleep_time)
+
+    session.close()
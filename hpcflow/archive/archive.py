@@ -10,37 +10,25 @@ import time
 from datetime import datetime
 from pathlib import Path
 from shutil import ignore_patterns
+from tempfile import TemporaryDirectory
 from time import sleep
 
-from sqlalchemy import (Table, Column, Integer, ForeignKey, String,
-                        UniqueConstraint, Enum, Boolean)
+from sqlalchemy import (Column, Integer, String, UniqueConstraint, Enum, Boolean, DateTime,
+                        Float, ForeignKey, JSON)
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import relationship, Session
-from sqlalchemy.exc import IntegrityError, OperationalError
 
 from hpcflow.config import Config as CONFIG
 from hpcflow.archive.cloud.cloud import CloudProvider
 from hpcflow.archive.cloud.errors import CloudProviderError, CloudCredentialsError
 from hpcflow.archive.errors import ArchiveError
+from hpcflow.archive.journal import copytree_resumable
+from hpcflow.archive.lock import ArchiveLock
+from hpcflow.archive.manifest import copytree_incremental
+from hpcflow.archive.pack import pack_directory
+from hpcflow.archive.store import copytree_dedup
 from hpcflow.base_db import Base
-from hpcflow.copytree import copytree_multi
-
-
-archive_is_active = Table(
-    'archive_is_active',
-    Base.metadata,
-    Column(
-        'archive_id',
-        Integer,
-        ForeignKey('archive.id'),
-        primary_key=True
-    ),
-    Column(
-        'directory_value_id',
-        Integer,
-        ForeignKey('var_value.id'),
-        primary_key=True
-    ),
-)
+from hpcflow.utils import datetime_to_dict
 
 
 class RootDirectoryName(enum.Enum):
@@ -53,6 +41,7 @@ class RootDirectoryName(enum.Enum):
 class TaskArchiveStatus(enum.Enum):
 
     pending = 'pending'
+    queued = 'queued'
     active = 'active'
     complete = 'complete'
 
@@ -70,13 +59,57 @@ class Archive(Base):
     cloud_provider = Column(Enum(CloudProvider))
     root_directory_name = Column(Enum(RootDirectoryName))
     root_directory_increment = Column(Boolean)
+    incremental = Column(Boolean)
+    hash_files = Column(Boolean)
+    delete = Column(Boolean)
+    packed = Column(Boolean)
+    compression = Column(String(255))
+    segment_size_MB = Column(Integer)
+    dedup = Column(Boolean)
 
     command_groups = relationship('CommandGroup', back_populates='archive')
-    directories_archiving = relationship('VarValue', secondary=archive_is_active)
     workflow = relationship('Workflow', back_populates='root_archive', uselist=False)
 
     def __init__(self, name, path, host='', cloud_provider='', root_directory_name='',
-                 root_directory_increment=True):
+                 root_directory_increment=True, incremental=False, hash_files=False,
+                 delete=False, packed=False, compression='', segment_size_MB=1024,
+                 dedup=False):
+        """
+        Parameters
+        ----------
+        incremental : bool, optional
+            If True, only copy files that are new or have changed since the previous
+            archive to the same destination directory, according to a manifest that is
+            stored in the destination directory. Only applies to local archives (i.e.
+            with no `cloud_provider`).
+        hash_files : bool, optional
+            Applies if `incremental` is True. If True, a content hash of each archived
+            file is recorded, so files whose modification time changes but whose
+            content does not are not recopied. For non-incremental local archives, if
+            True, files completed by an interrupted previous archive are only skipped
+            on resuming if their content hashes match (see `hpcflow.archive.journal`).
+        delete : bool, optional
+            Applies if `incremental` is True. If True, previously archived files that
+            no longer exist in the source directory are deleted from the destination.
+        packed : bool, optional
+            If True, instead of copying files individually, pack them into tar segments
+            in the destination directory, along with an index file that locates each
+            file within the segments (see `hpcflow.archive.pack`). For cloud archives,
+            the segments are generated in a local temporary directory and then
+            uploaded. Takes precedence over `incremental`.
+        compression : str, optional
+            Applies if `packed` is True. One of "" (no compression), "gz", "bz2" or
+            "xz".
+        segment_size_MB : int, optional
+            Applies if `packed` is True. Approximate maximum size of the contents of
+            each segment in megabytes.
+        dedup : bool, optional
+            If True, archived files are stored once per distinct content in a store
+            within the archive directory (see `hpcflow.archive.store`), and each
+            archived file is a hard link to the stored file. Only applies to local
+            archives. Takes precedence over `incremental`.
+
+        """
 
         self.name = name
         self._path = path
@@ -84,14 +117,28 @@ class Archive(Base):
         self.cloud_provider = CloudProvider(cloud_provider)
         self.root_directory_name = RootDirectoryName(root_directory_name)
         self.root_directory_increment = root_directory_increment
-
-        if not self.check_exists(self.path):
-            raise ValueError('Archive path "{}" does not exist.'.format(self.path))
+        self.incremental = incremental
+        self.hash_files = hash_files
+        self.delete = delete
+        self.packed = packed
+        self.compression = compression
+        self.segment_size_MB = segment_size_MB
+        self.dedup = dedup
+
+        # Cloud archive paths are checked in the root archive process (see
+        # `Workflow.resolve_archive_directories`):
+        if self.cloud_provider == CloudProvider.null:
+            self.check_path()
 
     @property
     def path(self):
         return Path(self._path)
 
+    def check_path(self):
+        """Check the archive path exists."""
+        if not self.check_exists(self.path):
+            raise ValueError('Archive path "{}" does not exist.'.format(self.path))
+
     def get_directories(self):
         """Get sub directories currently on the archive path.
 
@@ -163,17 +210,47 @@ class Archive(Base):
         ----------
         exclude : list of str
 
+        Returns
+        -------
+        bool
+            True if the archive completed without errors.
+
         """
 
-        self._copy(self.workflow.directory, self.path.joinpath(archive_dir), exclude)
+        stats = self._copy(self.workflow.directory, self.path.joinpath(archive_dir),
+                           exclude)
+        return stats['success']
+
+    def get_lock(self, directory_value):
+        """Get the lock that serialises archiving of a given working directory to this
+        archive."""
+        root_dir = self.command_groups[0].workflow.directory
+        lock_path = root_dir.joinpath(
+            CONFIG.get('hpcflow_directory'),
+            CONFIG.get('archive_locks_dir'),
+            '{}_{}.lock'.format(self.id_, directory_value.id_),
+        )
+        return ArchiveLock(lock_path)
 
     def execute_with_lock(self, task):
-        """Execute the archive process of a given working directory.
+        """Archive the working directory of a given task, coalescing the archive requests
+        of tasks that share the working directory.
+
+        The task first enqueues an archive request (i.e. its archive status is set to
+        "queued"). If the archive lock on the working directory is free, this task
+        becomes the archive worker: after a debounce period (the `archive_debounce`
+        configuration item), it claims all queued requests for the working directory
+        and archives the directory once. Otherwise, the request is left in the queue
+        and the current lock holder processes it: each worker checks for newly queued
+        requests after releasing the lock.
+
+        Requests that are "active" when the lock is acquired were claimed by a worker
+        that died before completing them (since the lock was free), so they are claimed
+        again, along with any requests that worker would have processed.
 
         Parameters
         ----------
-        directory_value : VarValue
-        exclude : list of str
+        task : Task
 
         """
 
@@ -191,76 +268,187 @@ class Archive(Base):
         src_dir = root_dir.joinpath(directory_value.value)
         dst_dir = self.path.joinpath(archive_dir, directory_value.value)
 
-        sleep_time = 5
         context = 'Archive.execute_with_lock'
-        block_msg = ('{{}} {}: Archiving blocked. Sleeping for {} '
-                     'seconds'.format(context, sleep_time))
-        unblock_msg = ('{{}} {}: Archiving available. Archiving from source directory: '
-                       '"{}" to destination directory: "{}".'.format(
-                           context, src_dir, dst_dir))
+        queued_msg = ('{{}} {}: Archive lock on directory {} is held by another task; '
+                      'archive request queued.'.format(context, directory_value))
+        unblock_msg = ('{{}} {}: Archiving from source directory: "{}" to destination '
+                       'directory: "{}" for tasks: {{}}.'.format(context, src_dir,
+                                                                  dst_dir))
         apply_block_msg = ('{{}} {}: Applying archive lock to directory: {}.'.format(
             context, directory_value))
         remove_block_msg = ('{{}} {}: Removing archive lock from directory: {}'.format(
             context, directory_value))
         arch_done_msg = ('{{}} {}: Archive of the working directory {} performed by '
                          'another task.'.format(context, directory_value))
+        stale_msg = ('{{}} {}: Claiming archive requests of tasks {{}} that were left '
+                     'active by an archive worker that did not complete them.'.format(
+                         context))
 
-        if task.is_archive_required():
+        if not task.is_archive_required():
+            print(arch_done_msg.format(datetime.now()), flush=True)
 
-            blocked = True
-            while blocked:
+            def set_complete():
+                task.archive_status = TaskArchiveStatus('complete')
+
+            self._commit_with_retries(set_complete, context)
+            return
+
+        queue_time = datetime.now()
+
+        def set_queued():
+            task.archive_status = TaskArchiveStatus('queued')
+            task.archive_queue_time = queue_time
+
+        self._commit_with_retries(set_queued, context)
+
+        def get_queued(claim_stale=False):
+            session.expire_all()
+            statuses = [TaskArchiveStatus('queued')]
+            if claim_stale:
+                statuses.append(TaskArchiveStatus('active'))
+            queued = [i for i in [task] + task.get_same_directory_tasks()
+                      if i.archive_status in statuses]
+            stale = [i.order_id for i in queued
+                     if i.archive_status == TaskArchiveStatus('active')]
+            if stale:
+                print(stale_msg.format(datetime.now(), stale), flush=True)
+            return queued
+
+        lock = self.get_lock(directory_value)
+        while True:
+
+            if not lock.acquire(blocking=False):
+                print(queued_msg.format(datetime.now()), flush=True)
+                break
+
+            lock_time = datetime.now()
+            print(apply_block_msg.format(lock_time), flush=True)
+            try:
+                # Allow other tasks that are finishing to enqueue their requests:
+                sleep(CONFIG.get('archive_debounce'))
+                queued = get_queued(claim_stale=True)
+                if queued:
+                    self._archive_queued(queued, task, lock_time, src_dir, dst_dir,
+                                         exclude, unblock_msg)
+            finally:
+                lock.release()
+                print(remove_block_msg.format(datetime.now()), flush=True)
+
+            # Requests may have been queued after our check, by tasks that failed to
+            # acquire the lock:
+            if not get_queued():
+                break
+
+    def _commit_with_retries(self, update, context):
+        """Apply changes to database objects with the function `update`, and commit
+        them, retrying (and applying the changes again) while the database is
+        locked."""
 
-                session.refresh(self)
-                if not task.is_archive_required():
-                    print(arch_done_msg.format(datetime.now()), flush=True)
-                    task.archive_status = TaskArchiveStatus('complete')
-                    session.commit()
-                    return
+        session = Session.object_session(self)
 
-                if directory_value in self.directories_archiving:
-                    print(block_msg.format(datetime.now()), flush=True)
-                    sleep(sleep_time)
-                else:
-                    try:
-                        self.directories_archiving.append(directory_value)
-                        session.commit()
-                        print(apply_block_msg.format(datetime.now()), flush=True)
-                        blocked = False
-
-                    except IntegrityError:
-                        # Another process has already set `directories_archiving`
-                        session.rollback()
-                        print(block_msg.format(datetime.now()), flush=True)
-                        sleep(sleep_time)
-
-                    except OperationalError:
-                        # Database is likely locked.
-                        session.rollback()
-                        print(block_msg.format(datetime.now()), flush=True)
-                        sleep(sleep_time)
-
-                    if not blocked:
-
-                        start_time = datetime.now()
-                        print(unblock_msg.format(start_time), flush=True)
-                        task.archive_status = TaskArchiveStatus('active')
-                        task.archive_start_time = start_time
-                        session.commit()
-
-                        self._copy(src_dir, dst_dir, exclude)
-
-                        end_time = datetime.now()
-                        task.archive_status = TaskArchiveStatus('complete')
-                        task.archive_end_time = end_time
-                        self.directories_archiving.remove(directory_value)
-                        session.commit()
-
-                        print(remove_block_msg.format(end_time), flush=True)
+        sleep_time = 5
+        block_msg = ('{{}} {}: Database locked. Sleeping for {} seconds'.format(
+            context, sleep_time))
+
+        blocked = True
+        while blocked:
+            try:
+                update()
+                session.commit()
+                blocked = False
+            except OperationalError:
+                # Database is likely locked.
+                session.rollback()
+                print(block_msg.format(datetime.now()), flush=True)
+                sleep(sleep_time)
+
+    def _archive_queued(self, queued, task, lock_time, src_dir, dst_dir, exclude,
+                        unblock_msg):
+        """Archive a working directory on behalf of a list of queued tasks, where the
+        archive lock was acquired at `lock_time`."""
+
+        context = 'Archive._archive_queued'
+
+        # The archive is attributed to a single task, which is the invoking task, if its
+        # request is queued:
+        archiving_task = task if task in queued else queued[0]
+
+        start_time = datetime.now()
+        print(unblock_msg.format(start_time, [i.order_id for i in queued]), flush=True)
+
+        # Waits are measured from the archiving task's own request, which may have been
+        # queued (by another task) before the lock was acquired, or during the debounce
+        # period:
+        queue_time = archiving_task.archive_queue_time or lock_time
+        lock_wait = max((lock_time - queue_time).total_seconds(), 0)
+        debounce_wait = (start_time - max(lock_time, queue_time)).total_seconds()
+
+        def set_active():
+            for i in queued:
+                i.archive_status = TaskArchiveStatus('active')
+                if i is not archiving_task:
+                    i.archived_task = archiving_task
+            archiving_task.archive_start_time = start_time
+            archiving_task.archive_wait = lock_wait
+
+        self._commit_with_retries(set_active, context)
+
+        stats = self._copy(src_dir, dst_dir, exclude)
+        end_time = datetime.now()
+
+        def set_complete():
+            archiving_task.archive_end_time = end_time
+            for i in queued:
+                i.archive_status = TaskArchiveStatus('complete')
+            Session.object_session(self).add(ArchiveRun(
+                task=archiving_task,
+                archive=self,
+                num_tasks=len(queued),
+                start_time=start_time,
+                end_time=end_time,
+                lock_wait=lock_wait,
+                debounce_wait=debounce_wait,
+                **stats,
+            ))
+
+        self._commit_with_retries(set_complete, context)
+
+    def _pack(self, src_dir, dst_dir, ignore):
+        """Pack the source directory into tar segments in the destination directory,
+        and return the archive statistics."""
+
+        kwargs = {
+            'ignore': ignore_patterns(*ignore),
+            'segment_size': self.segment_size_MB * 2**20,
+            'compression': self.compression,
+        }
+
+        api_calls = {}
+        if self.cloud_provider == CloudProvider.null:
+            packed = pack_directory(str(src_dir), str(dst_dir), **kwargs)
 
         else:
-            print(arch_done_msg.format(datetime.now()), flush=True)
-            task.archive_status = TaskArchiveStatus('complete')
-            session.commit()
+            with TemporaryDirectory() as tmp_dir:
+                try:
+                    packed = pack_directory(str(src_dir), tmp_dir, **kwargs)
+                finally:
+                    # Upload segments even if some files could not be packed:
+                    uploaded = self.cloud_provider.archive_directory(tmp_dir, dst_dir, [])
+                    api_calls = uploaded['api_calls']
+
+        msg = ('Packed archive: packed {files} files ({bytes} bytes) into {segments} '
+               'segments.')
+        print(msg.format(**packed), flush=True)
+
+        stats = {
+            'files_considered': packed['files'],
+            'files_skipped': 0,
+            'files_copied': packed['files'],
+            'bytes_copied': packed['bytes'],
+            'api_calls': api_calls,
+        }
+
+        return stats
 
     def _copy(self, src_dir, dst_dir, exclude):
         """Do the actual copying.
@@ -273,32 +461,221 @@ class Archive(Base):
 
         TODO: later (safely) copy the database to archive as well?
 
+        Returns
+        -------
+        dict
+            Archive statistics, with keys: "files_considered", "files_skipped",
+            "files_copied", "bytes_copied", "api_calls" (numbers of calls to each
+            method of the cloud provider API, if applicable), "copy_duration" (seconds)
+            and "success" (False if there were any errors, in which case the numbers
+            of files and bytes are not known).
+
         """
 
         ignore = [CONFIG.get('hpcflow_directory')] + (exclude or [])
         start = datetime.now()
+        stats = {}
 
         try:
 
-            if self.cloud_provider != CloudProvider.null:
+            if self.packed:
                 try:
-                    self.cloud_provider.archive_directory(src_dir, dst_dir, ignore)
+                    stats = self._pack(src_dir, dst_dir, ignore)
+                except (shutil.Error, CloudProviderError, CloudCredentialsError) as err:
+                    raise ArchiveError(err)
+
+            elif self.cloud_provider != CloudProvider.null:
+                try:
+                    uploaded = self.cloud_provider.archive_directory(
+                        src_dir, dst_dir, ignore)
                 except (CloudProviderError, CloudCredentialsError, ArchiveError) as err:
                     raise ArchiveError(err)
+                stats = {
+                    'files_considered': uploaded['considered'],
+                    'files_skipped': uploaded['skipped'],
+                    'files_copied': uploaded['copied'],
+                    'bytes_copied': uploaded['bytes_copied'],
+                    'api_calls': uploaded['api_calls'],
+                }
             else:
                 if ignore:
                     ignore_func = ignore_patterns(*ignore)
                 else:
                     ignore_func = None
                 try:
-                    copytree_multi(str(src_dir), str(dst_dir), ignore=ignore_func)
+                    if self.dedup:
+                        copied = copytree_dedup(
+                            str(src_dir),
+                            str(dst_dir),
+                            self.path.joinpath(CONFIG.get('archive_store_dir')),
+                            ignore=ignore_func,
+                        )
+                        msg = ('Deduplicated archive: archived {files} files; stored '
+                               '{stored} new files ({bytes_stored} bytes).')
+                        print(msg.format(**copied), flush=True)
+                        # Files that are already stored are only linked:
+                        stats = {
+                            'files_considered': copied['files'],
+                            'files_skipped': copied['files'] - copied['stored'],
+                            'files_copied': copied['stored'],
+                            'bytes_copied': copied['bytes_stored'],
+                        }
+                    elif self.incremental:
+                        copied = copytree_incremental(
+                            str(src_dir),
+                            str(dst_dir),
+                            ignore=ignore_func,
+                            hash_files=self.hash_files,
+                            delete=self.delete,
+                        )
+                        msg = ('Incremental archive: copied {copied} files '
+                               '({bytes_copied} bytes); skipped {skipped} unchanged '
+                               'files; deleted {deleted} files.')
+                        print(msg.format(**copied), flush=True)
+                        stats = {
+                            'files_considered': copied['copied'] + copied['skipped'],
+                            'files_skipped': copied['skipped'],
+                            'files_copied': copied['copied'],
+                            'bytes_copied': copied['bytes_copied'],
+                        }
+                    else:
+                        copied = copytree_resumable(
+                            str(src_dir),
+                            str(dst_dir),
+                            ignore=ignore_func,
+                            verify_hash=self.hash_files,
+                        )
+                        if copied['skipped']:
+                            msg = ('Resumed archive: copied {copied} files '
+                                   '({bytes_copied} bytes); skipped {skipped} files '
+                                   'completed by a previous attempt.')
+                            print(msg.format(**copied), flush=True)
+                        stats = {
+                            'files_considered': copied['copied'] + copied['skipped'],
+                            'files_skipped': copied['skipped'],
+                            'files_copied': copied['copied'],
+                            'bytes_copied': copied['bytes_copied'],
+                        }
                 except shutil.Error as err:
                     raise ArchiveError(err)
 
+            success = True
+
         except ArchiveError as err:
             print('Archive copying error: {}'.format(err))
+            success = False
 
         end = datetime.now()
         copy_seconds = (end - start).total_seconds()
         print('Archive to "{}" took {} seconds'.format(
             self.name, copy_seconds), flush=True)
+
+        stats.update({
+            'copy_duration': copy_seconds,
+            'success': success,
+        })
+
+        return stats
+
+
+class ArchiveRun(Base):
+    """Class to represent the statistics of a single archive of a task's working
+    directory, which may be on behalf of several tasks that share the directory."""
+
+    __tablename__ = 'archive_run'
+
+    id_ = Column('id', Integer, primary_key=True)
+    task_id = Column(Integer, ForeignKey('task.id'))
+    archive_id = Column(Integer, ForeignKey('archive.id'))
+    num_tasks = Column(Integer)
+    start_time = Column(DateTime)
+    end_time = Column(DateTime)
+    lock_wait = Column(Float)
+    debounce_wait = Column(Float, nullable=True)
+    copy_duration = Column(Float)
+    files_considered = Column(Integer, nullable=True)
+    files_skipped = Column(Integer, nullable=True)
+    files_copied = Column(Integer, nullable=True)
+    bytes_copied = Column(Integer, nullable=True)
+    api_calls = Column(JSON, nullable=True)
+    success = Column(Boolean)
+
+    task = relationship('Task', back_populates='archive_runs', uselist=False)
+    archive = relationship('Archive', uselist=False)
+
+    def __init__(self, task, archive, num_tasks, start_time, end_time, lock_wait,
+                 copy_duration, success, files_considered=None, files_skipped=None,
+                 files_copied=None, bytes_copied=None, api_calls=None,
+                 debounce_wait=None):
+        """
+        Parameters
+        ----------
+        lock_wait : float
+            Time in seconds between the archive request of the archiving task and the
+            acquisition of the archive lock (zero if the request was queued after the
+            lock was acquired).
+        copy_duration : float
+            Time in seconds spent copying.
+        api_calls : dict of (str: int), optional
+            For cloud archives, the number of calls made to each method of the cloud
+            provider API.
+        debounce_wait : float, optional
+            Time in seconds between the later of the archive request of the archiving
+            task and the acquisition of the archive lock, and the start of copying
+            (i.e. the part of the debounce period that the request waited for).
+
+        """
+
+        self.task = task
+        self.archive = archive
+        self.num_tasks = num_tasks
+        self.start_time = start_time
+        self.end_time = end_time
+        self.lock_wait = lock_wait
+        self.debounce_wait = debounce_wait
+        self.copy_duration = copy_duration
+        self.success = success
+        self.files_considered = files_considered
+        self.files_skipped = files_skipped
+        self.files_copied = files_copied
+        self.bytes_copied = bytes_copied
+        self.api_calls = api_calls
+
+    @property
+    def bytes_per_second(self):
+        if self.bytes_copied is not None and self.copy_duration:
+            return self.bytes_copied / self.copy_duration
+        else:
+            return None
+
+    def get_stats(self, jsonable=True, datetime_dicts=False):
+        """Get statistics for this archive run."""
+
+        out = {
+            'archive_run_id': self.id_,
+            'archive': self.archive.name,
+            'num_tasks': self.num_tasks,
+            'start_time': self.start_time,
+            'end_time': self.end_time,
+            'lock_wait': self.lock_wait,
+            'debounce_wait': self.debounce_wait,
+            'copy_duration': self.copy_duration,
+            'files_considered': self.files_considered,
+            'files_skipped': self.files_skipped,
+            'files_copied': self.files_copied,
+            'bytes_copied': self.bytes_copied,
+            'bytes_per_second': self.bytes_per_second,
+            'api_calls': self.api_calls,
+            'success': self.success,
+        }
+
+        if datetime_dicts:
+            out['start_time'] = datetime_to_dict(out['start_time'])
+            out['end_time'] = datetime_to_dict(out['end_time'])
+
+        elif jsonable:
+            dt_fmt = r'%Y.%m.%d %H:%M:%S'
+            out['start_time'] = out['start_time'].strftime(dt_fmt)
+            out['end_time'] = out['end_time'].strftime(dt_fmt)
+
+        return out
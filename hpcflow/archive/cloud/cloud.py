@@ -7,38 +7,76 @@ the provider-specific `upload_file` functions.
 """
 
 import enum
+import threading
 
-from hpcflow.archive.cloud.providers import dropbox
+from hpcflow.archive.cloud.providers import dropbox, local
+
+
+class APICallCounter(object):
+    """Wrapper of a cloud provider API client that counts the calls made to each of
+    the client's public methods."""
+
+    def __init__(self, client):
+        self._client = client
+        self._lock = threading.Lock()
+        self.counts = {}
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        def counted(*args, **kwargs):
+            with self._lock:
+                self.counts[name] = self.counts.get(name, 0) + 1
+            return attr(*args, **kwargs)
+
+        return counted
 
 
 class CloudProvider(enum.Enum):
 
     dropbox = 'dropbox'
     onedrive = 'onedrive'
+    local = 'local'
     null = ''
 
+    def get_client(self):
+        """Get a client for the provider's API. The `local` (mock) provider emulates
+        the Dropbox API."""
+        if self.name == 'dropbox':
+            return dropbox.get_dropbox()
+        elif self.name == 'local':
+            return local.get_client()
+
     def check_access(self):
         if self.name == 'dropbox':
             dropbox.check_access()
+        elif self.name == 'local':
+            local.check_access()
 
     def archive_directory(self, local_path, remote_path, exclude):
-        if self.name == 'dropbox':
-            dropbox.archive_directory(
-                dropbox.get_dropbox(), local_path, remote_path, exclude)
+        """Archive a local directory to the cloud storage, and return the numbers of
+        files considered, skipped and copied, the number of bytes copied, and the
+        number of calls made to each API method."""
+
+        if self.name in ['dropbox', 'local']:
+            client = APICallCounter(self.get_client())
+            out = dropbox.archive_directory(client, local_path, remote_path, exclude)
+            out['api_calls'] = client.counts
+            return out
 
     def get_directories(self, path):
         """Get sub directories within a path"""
 
-        if self.name == 'dropbox':
-            dbx = dropbox.get_dropbox()
-            return dropbox.get_folders(dbx, path)
+        if self.name in ['dropbox', 'local']:
+            return dropbox.get_folders(self.get_client(), path)
 
     def check_exists(self, directory):
         """Check a given directory exists on the cloud storage."""
-        if self.name == 'dropbox':
+        if self.name in ['dropbox', 'local']:
             directory = dropbox.normalise_path(directory)
-            dbx = dropbox.get_dropbox()
-            return dropbox.is_folder(dbx, directory)
+            return dropbox.is_folder(self.get_client(), directory)
 
     def get_token(self):
         if self.name == 'dropbox':
@@ -5,18 +5,32 @@ This module provides interactivity with a Dropbox account for archiving.
 """
 
 import os
+import hashlib
 import posixpath
 import fnmatch
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime
 from textwrap import dedent
+from time import sleep
 
 import dropbox as dropbox_api
+import requests
 
 from hpcflow.config import Config
 from hpcflow.archive.errors import ArchiveError
+from hpcflow.archive.manifest import HashCache, get_directory_key
 from hpcflow.archive.cloud.errors import CloudProviderError, CloudCredentialsError
 
+# Size of the blocks that are hashed to compute the Dropbox content hash of a file:
+CONTENT_HASH_BLOCK_SIZE = 4 * 2**20
+
+# Maximum number of entries that may be committed by `files_upload_session_finish_batch`:
+UPLOAD_BATCH_MAX_ENTRIES = 1000
+
+# Clients keyed by access token, such that connections are reused:
+_CLIENTS = {}
+
 
 def get_token():
 
@@ -53,7 +67,13 @@ def get_dropbox():
                f'"{env_var_name}", or in the config file as "dropbox_token".')
         raise CloudCredentialsError(msg)
 
-    dbx = dropbox_api.Dropbox(token)
+    if token not in _CLIENTS:
+        # Allow one connection per concurrent upload:
+        session = dropbox_api.create_session(
+            max_connections=Config.get('cloud_upload_workers'))
+        _CLIENTS.update({token: dropbox_api.Dropbox(token, session=session)})
+
+    dbx = _CLIENTS[token]
 
     return dbx
 
@@ -87,6 +107,45 @@ def get_folders(dbx, path):
     return out
 
 
+def get_file_index(dbx, path):
+    """Get the metadata of all files within a Dropbox directory and its
+    sub-directories, using a single (paginated) recursive listing.
+
+    Parameters
+    ----------
+    dbx: Dropbox
+    path : str or Path
+        Directory on Dropbox to list.
+
+    Returns
+    -------
+    dict of (str: FileMetadata)
+        File metadata keyed by the lower-cased Dropbox path of each file (i.e. the
+        `path_lower` attribute). If the directory does not exist, the dict is empty.
+
+    """
+
+    path = normalise_path(path)
+    index = {}
+
+    try:
+        result = _call_with_retries(dbx.files_list_folder, path, recursive=True)
+    except dropbox_api.exceptions.ApiError as err:
+        if err.error.is_path() and err.error.get_path().is_not_found():
+            return index
+        raise
+
+    while True:
+        for i in result.entries:
+            if isinstance(i, dropbox_api.files.FileMetadata):
+                index.update({i.path_lower: i})
+        if not result.has_more:
+            break
+        result = _call_with_retries(dbx.files_list_folder_continue, result.cursor)
+
+    return index
+
+
 def is_file(dbx, path):
     """Check given path on dropbox is a file."""
     meta = dbx.files_get_metadata(path)
@@ -123,15 +182,34 @@ def normalise_path(path):
     return path
 
 
-def archive_file(dbx, local_path, dropbox_dir, check_modified_time=True):
+def get_content_hash(path):
+    """Compute the Dropbox content hash of a local file.
+
+    The file is split into blocks of 4 MiB, the SHA-256 hash of each block is computed,
+    and the content hash is the SHA-256 hash of the concatenated block hashes.
+
+    Ref: https://www.dropbox.com/developers/reference/content-hash
+
+    """
+
+    block_hashes = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        for block in iter(lambda: handle.read(CONTENT_HASH_BLOCK_SIZE), b''):
+            block_hashes.update(hashlib.sha256(block).digest())
+
+    return block_hashes.hexdigest()
+
+
+def archive_file(dbx, local_path, dropbox_dir, check_modified_time=True,
+                 file_index=None, content_hash=None):
     """Upload a file to a dropbox directory such that if the local file is newer than the
     copy on Dropbox, the newer file overwrites the older file, and if the local file is
     older than the copy on Dropbox, the local file is uploaded with an "auto-incremented"
     name.
 
-    Note that if the modified times are different, the file still won't be uploaded
-    by dropbox if the file contents are identical. The point of checking for the
-    modified times is to save some time by not having Dropbox check file contents.    
+    If the content hash of the local file is the same as that of the copy on Dropbox,
+    the file is not uploaded, regardless of the modified times. If the contents differ
+    but the modified times are the same (to the second), the file is overwritten.
 
     Parameters
     ----------
@@ -140,12 +218,39 @@ def archive_file(dbx, local_path, dropbox_dir, check_modified_time=True):
         Path of file on local computer to upload to dropbox.
     dropbox_dir : str or Path
         Directory on Dropbox into which the file should be uploaded.
+    file_index : dict of (str: FileMetadata), optional
+        Index of existing files on Dropbox, as returned by `get_file_index` for a
+        parent directory of `dropbox_dir`. If specified, the existing file is looked up
+        in the index instead of by requesting its metadata from Dropbox.
+    content_hash : str, optional
+        Dropbox content hash of the local file, if already known. Otherwise, it is
+        computed if there is an existing file on Dropbox.
 
     """
 
     local_path = Path(local_path)
     dropbox_path = normalise_path(Path(dropbox_dir).joinpath(local_path.name))
 
+    write_args = _get_archive_write_args(dbx, local_path, dropbox_path,
+                                         check_modified_time, file_index, content_hash)
+    if write_args:
+        _upload_dropbox_file(dbx, local_path, dropbox_path, **write_args)
+
+
+def _get_archive_write_args(dbx, local_path, dropbox_path, check_modified_time=True,
+                            file_index=None, content_hash=None):
+    """Determine how a file should be uploaded when archiving, according to its
+    content hash and modified time relative to the existing file on Dropbox (see
+    `archive_file`).
+
+    Returns
+    -------
+    dict or None
+        Keyword arguments `overwrite`, `autorename` and `client_modified` to pass to
+        `_upload_dropbox_file`, or `None` if the file should not be uploaded.
+
+    """
+
     if not check_modified_time:
         overwrite = True
         autorename = False
@@ -167,47 +272,47 @@ def archive_file(dbx, local_path, dropbox_dir, check_modified_time=True):
             second=dt.second,
         )
 
-        try:
-            # Check for existing file
-            existing_file = dbx.files_get_metadata(dropbox_path)
-            existing_modified = existing_file.client_modified
+        # Check for existing file
+        if file_index is not None:
+            existing_file = file_index.get(dropbox_path.lower())
+        else:
+            try:
+                existing_file = dbx.files_get_metadata(dropbox_path)
+            except dropbox_api.exceptions.ApiError:
+                # File does not exist.
+                existing_file = None
+            except:
+                msg = 'Unexpected error.'
+                raise CloudProviderError(msg)
+
+        if existing_file is None:
+            overwrite = False
+            autorename = False
 
-            # print('client_modified: {!r}'.format(client_modified))
-            # print('existing_modified: {!r}'.format(existing_modified))
+        else:
+            existing_modified = existing_file.client_modified
+            if content_hash is None:
+                content_hash = get_content_hash(local_path)
 
-            if client_modified == existing_modified:
-                # print('client_modified time same!')
-                return
+            if content_hash == existing_file.content_hash:
+                return None
 
             elif client_modified < existing_modified:
                 overwrite = False
                 autorename = True
-                # print('client file older!')
 
-            elif client_modified > existing_modified:
+            else:
+                # Local file is newer, or was modified within the same second:
                 overwrite = True
                 autorename = False
-                # print('client file newer!')
 
-        except dropbox_api.exceptions.ApiError:
+    write_args = {
+        'overwrite': overwrite,
+        'autorename': autorename,
+        'client_modified': client_modified,
+    }
 
-            # print('File does not exist.')
-
-            overwrite = False
-            autorename = False
-
-        except:
-            msg = 'Unexpected error.'
-            raise CloudProviderError(msg)
-
-    _upload_dropbox_file(
-        dbx,
-        local_path,
-        dropbox_path,
-        overwrite=overwrite,
-        autorename=autorename,
-        client_modified=client_modified
-    )
+    return write_args
 
 
 def upload_dropbox_file(dbx, local_path, dropbox_dir, overwrite=False, autorename=True,
@@ -256,22 +361,26 @@ def _upload_dropbox_file(dbx, local_path, dropbox_path, overwrite=False, autoren
 
     """
 
-    if overwrite:
-        mode = dropbox_api.dropbox.files.WriteMode('overwrite', None)
-    else:
-        mode = dropbox_api.dropbox.files.WriteMode('add', None)
+    commit = _get_commit_info(dropbox_path, overwrite, autorename, client_modified)
+    chunk_size = Config.get('cloud_upload_chunk_size')
 
     try:
         with local_path.open(mode='rb') as handle:
 
             try:
-                dbx.files_upload(
-                    handle.read(),
-                    dropbox_path,
-                    mode=mode,
-                    autorename=autorename,
-                    client_modified=client_modified,
-                )
+                file_size = os.fstat(handle.fileno()).st_size
+                if file_size <= chunk_size:
+                    _call_with_retries(
+                        dbx.files_upload,
+                        handle.read(),
+                        dropbox_path,
+                        mode=commit.mode,
+                        autorename=autorename,
+                        client_modified=client_modified,
+                    )
+                else:
+                    _upload_dropbox_file_session(dbx, handle, file_size, commit,
+                                                 chunk_size)
 
             except dropbox_api.exceptions.ApiError as err:
                 msg = ('Cloud provider error. {}'.format(err))
@@ -284,6 +393,313 @@ def _upload_dropbox_file(dbx, local_path, dropbox_path, overwrite=False, autoren
         raise ArchiveError(err)
 
 
+def _get_commit_info(dropbox_path, overwrite=False, autorename=True,
+                     client_modified=None):
+
+    if overwrite:
+        mode = dropbox_api.dropbox.files.WriteMode('overwrite', None)
+    else:
+        mode = dropbox_api.dropbox.files.WriteMode('add', None)
+
+    commit = dropbox_api.files.CommitInfo(
+        path=dropbox_path,
+        mode=mode,
+        autorename=autorename,
+        client_modified=client_modified,
+    )
+
+    return commit
+
+
+def _upload_dropbox_file_batch_entry(dbx, local_path, commit):
+    """Upload a small file in a single request to a closed upload session, such that
+    it can be committed in a batch by `_finish_upload_batch`.
+
+    Returns
+    -------
+    UploadSessionFinishArg
+
+    """
+
+    try:
+        with local_path.open(mode='rb') as handle:
+            data = handle.read()
+    except FileNotFoundError as err:
+        raise ArchiveError(err)
+
+    try:
+        session_id = _call_with_retries(
+            dbx.files_upload_session_start, data, close=True).session_id
+    except dropbox_api.exceptions.ApiError as err:
+        msg = ('Cloud provider error. {}'.format(err))
+        raise CloudProviderError(msg)
+    except:
+        msg = 'Unexpected error.'
+        raise CloudProviderError(msg)
+
+    cursor = dropbox_api.files.UploadSessionCursor(session_id, len(data))
+    entry = dropbox_api.files.UploadSessionFinishArg(cursor, commit)
+
+    return entry
+
+
+def _finish_upload_batch(dbx, entries):
+    """Commit a batch of files uploaded by `_upload_dropbox_file_batch_entry`.
+
+    Committing files in a batch, rather than individually, reduces contention for the
+    lock on the destination namespace, which Dropbox takes for each commit.
+
+    Returns
+    -------
+    list of bool
+        Whether each file was committed.
+
+    """
+
+    print('Committing {} uploaded files.'.format(len(entries)), flush=True)
+
+    try:
+        launch = _call_with_retries(dbx.files_upload_session_finish_batch, entries)
+        if launch.is_complete():
+            result = launch.get_complete()
+        else:
+            async_job_id = launch.get_async_job_id()
+            while True:
+                status = _call_with_retries(
+                    dbx.files_upload_session_finish_batch_check, async_job_id)
+                if status.is_complete():
+                    result = status.get_complete()
+                    break
+                sleep(1)
+
+    except dropbox_api.exceptions.ApiError as err:
+        print('Cloud provider error: Failed to commit {} files. {}'.format(
+            len(entries), err), flush=True)
+        return [False] * len(entries)
+
+    committed = []
+    for entry, entry_result in zip(entries, result.entries):
+        if entry_result.is_failure():
+            print('Cloud provider error: Failed to commit file {}. {}'.format(
+                entry.commit.path, entry_result.get_failure()), flush=True)
+        committed.append(entry_result.is_success())
+
+    return committed
+
+
+def _upload_dropbox_files(dbx, uploads):
+    """Upload files concurrently, using `cloud_upload_workers` threads.
+
+    Files larger than `cloud_upload_chunk_size` are uploaded individually in chunks.
+    Smaller files are each uploaded in a single request, and then committed together
+    in batches.
+
+    Parameters
+    ----------
+    dbx: Dropbox
+    uploads : list of tuple of (Path, str, dict)
+        For each file: the local path, the Dropbox path, and keyword arguments
+        `overwrite`, `autorename` and `client_modified`.
+
+    Returns
+    -------
+    tuple of (int, int)
+        Number of files and number of bytes uploaded.
+
+    """
+
+    chunk_size = Config.get('cloud_upload_chunk_size')
+
+    def upload(local_path, dropbox_path, write_args):
+
+        try:
+            file_size = local_path.stat().st_size
+        except FileNotFoundError as err:
+            raise ArchiveError(err)
+
+        if file_size > chunk_size:
+            _upload_dropbox_file(dbx, local_path, dropbox_path, **write_args)
+            return None, file_size
+        else:
+            commit = _get_commit_info(dropbox_path, **write_args)
+            entry = _upload_dropbox_file_batch_entry(dbx, local_path, commit)
+            return entry, file_size
+
+    num_files = 0
+    num_bytes = 0
+    batch = []
+    batch_sizes = []
+
+    def finish_batch():
+        nonlocal num_files, num_bytes
+        committed = _finish_upload_batch(dbx, batch)
+        num_files += sum(committed)
+        num_bytes += sum([i for i, j in zip(batch_sizes, committed) if j])
+        batch.clear()
+        batch_sizes.clear()
+
+    with ThreadPoolExecutor(max_workers=Config.get('cloud_upload_workers')) as executor:
+
+        futures = []
+        for i in uploads:
+            print('Uploading file: {}'.format(i[0]), flush=True)
+            futures.append(executor.submit(upload, *i))
+
+        for future in futures:
+
+            try:
+                entry, file_size = future.result()
+
+            except ArchiveError as err:
+                print('Archive error: {}'.format(err), flush=True)
+                continue
+
+            except CloudProviderError as err:
+                print('Cloud provider error: {}'.format(err), flush=True)
+                continue
+
+            if entry:
+                batch.append(entry)
+                batch_sizes.append(file_size)
+                if len(batch) == UPLOAD_BATCH_MAX_ENTRIES:
+                    finish_batch()
+            else:
+                num_files += 1
+                num_bytes += file_size
+
+    if batch:
+        finish_batch()
+
+    return num_files, num_bytes
+
+
+def _get_content_hashes(local_dir, paths):
+    """Get the Dropbox content hashes of files within a local directory, using
+    `cloud_upload_workers` threads.
+
+    Hashes are cached (within the `hash_caches` directory of the configuration
+    directory, rather than the local directory), so unchanged files are not hashed
+    again.
+
+    Returns
+    -------
+    dict of (Path: str)
+        Content hash of each file. Files that could not be read are omitted.
+
+    """
+
+    cache = HashCache(
+        local_dir,
+        'dropbox_content_{}'.format(get_directory_key(local_dir)),
+        hash_func=get_content_hash,
+        cache_dir=Config.get('config_dir').joinpath('hash_caches'),
+    )
+
+    def get_hash(path):
+        try:
+            return path, cache.get_hash(path)
+        except OSError:
+            return path, None
+
+    with ThreadPoolExecutor(max_workers=Config.get('cloud_upload_workers')) as executor:
+        hashes = {path: i for path, i in executor.map(get_hash, paths) if i}
+
+    cache.save()
+
+    return hashes
+
+
+def _upload_dropbox_file_session(dbx, handle, file_size, commit, chunk_size):
+    """Upload a file in chunks using an upload session.
+
+    Only one chunk is held in memory at a time. If Dropbox reports that the session
+    offset differs from ours (e.g. because a chunk was received but the response was
+    lost), the upload resumes from the offset reported by Dropbox. If the file shrinks
+    during the upload, the bytes that were read are committed.
+
+    Parameters
+    ----------
+    dbx: Dropbox
+    handle : file object
+        Binary file handle of the local file.
+    file_size : int
+        Size of the local file in bytes.
+    commit : CommitInfo
+        Destination path and write mode of the uploaded file.
+    chunk_size : int
+        Number of bytes to upload per request.
+
+    """
+
+    session_id = None
+    offset = 0
+
+    while True:
+
+        handle.seek(offset)
+        chunk = handle.read(chunk_size)
+
+        try:
+            if session_id is None:
+                session_id = _call_with_retries(
+                    dbx.files_upload_session_start, chunk).session_id
+
+            else:
+                cursor = dropbox_api.files.UploadSessionCursor(session_id, offset)
+                if not chunk and offset < file_size:
+                    print('File has shrunk during upload; committing {} of {} '
+                          'bytes.'.format(offset, file_size), flush=True)
+                if not chunk or offset + len(chunk) >= file_size:
+                    return _call_with_retries(
+                        dbx.files_upload_session_finish, chunk, cursor, commit)
+                _call_with_retries(dbx.files_upload_session_append_v2, chunk, cursor)
+
+        except dropbox_api.exceptions.ApiError as err:
+            correct_offset = _get_correct_offset(err)
+            if correct_offset is None:
+                raise
+            print('Resuming upload session at offset {} (was {}).'.format(
+                correct_offset, offset), flush=True)
+            offset = correct_offset
+            continue
+
+        offset += len(chunk)
+
+
+def _get_correct_offset(err):
+    """Get the offset expected by Dropbox from an upload session `ApiError`, or `None`
+    if the error is not due to an incorrect offset."""
+
+    error = err.error
+    if hasattr(error, 'is_lookup_failed') and error.is_lookup_failed():
+        error = error.get_lookup_failed()
+    if hasattr(error, 'is_incorrect_offset') and error.is_incorrect_offset():
+        return error.get_incorrect_offset().correct_offset
+
+
+def _call_with_retries(func, *args, **kwargs):
+    """Call a Dropbox API function, retrying with exponential backoff on transient
+    (network, server or rate limit) errors, up to `cloud_upload_retries` times."""
+
+    retries = Config.get('cloud_upload_retries')
+    transient = (
+        dropbox_api.exceptions.InternalServerError,
+        dropbox_api.exceptions.RateLimitError,
+        requests.exceptions.ConnectionError,
+        requests.exceptions.Timeout,
+    )
+    for attempt in range(retries + 1):
+        try:
+            return func(*args, **kwargs)
+        except transient as err:
+            if attempt == retries:
+                raise
+            backoff = getattr(err, 'backoff', None) or min(2 ** attempt, 60)
+            print('Dropbox request failed ({!r}); retrying in {} seconds.'.format(
+                err, backoff), flush=True)
+            sleep(backoff)
+
+
 def archive_directory(dbx, local_dir, dropbox_dir, exclude=None):
     """
     Archive a the contents of a local directory into a directory on dropbox.
@@ -298,13 +714,23 @@ def archive_directory(dbx, local_dir, dropbox_dir, exclude=None):
     dropbox_dir : str or Path
         Directory on dropbox to upload the files to.
 
+    Returns
+    -------
+    dict
+        Numbers of files that were considered, skipped (unchanged) and uploaded, and
+        the number of bytes uploaded.
+
     """
 
     print('hpcflow.archive.cloud.providers.dropbox.archive_directory', flush=True)
 
     local_dir = Path(local_dir)
     dropbox_dir = Path(dropbox_dir)
-    _upload_dropbox_dir(
+
+    # Never archive hpcflow's own files (e.g. archive locks):
+    exclude = (exclude or []) + [Config.get('hpcflow_directory')]
+
+    return _upload_dropbox_dir(
         dbx,
         local_dir,
         dropbox_dir,
@@ -335,7 +761,7 @@ def upload_dropbox_dir(dbx, local_dir, dropbox_dir, overwrite=False, autorename=
 
     local_dir = Path(local_dir)
     dropbox_dir = Path(dropbox_dir)
-    _upload_dropbox_dir(
+    return _upload_dropbox_dir(
         dbx,
         local_dir,
         dropbox_dir,
@@ -365,9 +791,16 @@ def _upload_dropbox_dir(dbx, local_dir, dropbox_dir, overwrite=False, autorename
         files, or compared directly for directories.
     archive : bool, optional
 
+    Returns
+    -------
+    dict
+        Numbers of files that were considered, skipped and uploaded, and the number of
+        bytes uploaded.
+
     Notes
     -----
-    Does not upload empty directories.
+    Does not upload empty directories. Files are uploaded concurrently (see
+    `_upload_dropbox_files`).
 
     """
 
@@ -378,6 +811,18 @@ def _upload_dropbox_dir(dbx, local_dir, dropbox_dir, overwrite=False, autorename
     if not local_dir.is_dir():
         raise ValueError('Specified `local_dir` is not a directory: {}'.format(local_dir))
 
+    if archive:
+        # Retrieve the existing files with one recursive listing, rather than one
+        # metadata request per file:
+        try:
+            file_index = get_file_index(dbx, dropbox_dir)
+        except dropbox_api.exceptions.ApiError as err:
+            msg = ('Cloud provider error. {}'.format(err))
+            raise CloudProviderError(msg)
+        print('Found {} existing files in Dropbox directory: {}'.format(
+            len(file_index), normalise_path(dropbox_dir)), flush=True)
+
+    candidates = []
     for root, dirs, files in os.walk(str(local_dir)):
 
         root_test = Path(root)
@@ -400,28 +845,51 @@ def _upload_dropbox_dir(dbx, local_dir, dropbox_dir, overwrite=False, autorename
 
                 src_file = root_test.joinpath(file_name)
                 rel_path = src_file.relative_to(local_dir)
-                dst_dir = dropbox_dir.joinpath(rel_path.parent)
-
-                print('Uploading file: {}'.format(file_name), flush=True)
-                try:
-                    if archive:
-                        archive_file(
-                            dbx,
-                            src_file,
-                            dst_dir
-                        )
-                    else:
-                        upload_dropbox_file(
-                            dbx,
-                            src_file,
-                            dst_dir,
-                            overwrite=overwrite,
-                            autorename=autorename
-                        )
-                except ArchiveError as err:
-                    print('Archive error: {}'.format(err), flush=True)
-                    continue
-
-                except CloudProviderError as err:
-                    print('Cloud provider error: {}'.format(err), flush=True)
-                    continue
+                dst_path = normalise_path(dropbox_dir.joinpath(rel_path))
+
+                candidates.append((src_file, dst_path))
+
+    if archive:
+        # Only files that already exist on Dropbox need to be hashed:
+        content_hashes = _get_content_hashes(
+            local_dir, [i[0] for i in candidates if i[1].lower() in file_index])
+
+    uploads = []
+    num_skipped = 0
+    for src_file, dst_path in candidates:
+
+        if archive:
+            try:
+                write_args = _get_archive_write_args(
+                    dbx,
+                    src_file,
+                    dst_path,
+                    file_index=file_index,
+                    content_hash=content_hashes.get(src_file),
+                )
+            except FileNotFoundError as err:
+                print('Archive error: {}'.format(err), flush=True)
+                continue
+            if not write_args:
+                num_skipped += 1
+                continue
+        else:
+            write_args = {
+                'overwrite': overwrite,
+                'autorename': autorename,
+                'client_modified': None,
+            }
+
+        uploads.append((src_file, dst_path, write_args))
+
+    print('Uploading {} of {} files.'.format(len(uploads), len(candidates)), flush=True)
+    num_uploaded, num_bytes = _upload_dropbox_files(dbx, uploads)
+
+    out = {
+        'considered': len(candidates),
+        'skipped': num_skipped,
+        'copied': num_uploaded,
+        'bytes_copied': num_bytes,
+    }
+
+    return out
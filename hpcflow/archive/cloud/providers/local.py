@@ -0,0 +1,369 @@
+"""`hpcflow.archive.cloud.providers.local.py`
+
+This module provides a mock cloud provider whose storage is a local directory, for
+testing and benchmarking cloud archiving without network access or credentials.
+
+The client emulates the subset of the Dropbox API that is used by
+`hpcflow.archive.cloud.providers.dropbox`, returning the same metadata types (including
+`client_modified` and `content_hash`), so the Dropbox archiving functions (chunked,
+concurrent uploads and skip logic) can be used unchanged. Request latency and a
+bandwidth limit (shared between all requests) can be injected.
+
+"""
+
+import os
+import shutil
+import threading
+import uuid
+from datetime import datetime
+from pathlib import Path
+from time import perf_counter, sleep
+
+import dropbox as dropbox_api
+
+from hpcflow.config import Config
+from hpcflow.archive.manifest import HashCache
+from hpcflow.archive.cloud.errors import CloudProviderError
+from hpcflow.archive.cloud.providers.dropbox import get_content_hash
+
+# Maximum number of entries returned by each `files_list_folder(_continue)` call:
+LIST_FOLDER_PAGE_SIZE = 2000
+
+# Clients keyed by their parameters, such that upload sessions persist between calls:
+_CLIENTS = {}
+
+
+def get_client():
+
+    root_dir = Config.get('local_cloud_dir')
+    if not root_dir:
+        msg = ('Please set the directory of the mock cloud provider in the config file '
+               'as "local_cloud_dir".')
+        raise CloudProviderError(msg)
+
+    key = (
+        root_dir,
+        Config.get('local_cloud_latency'),
+        Config.get('local_cloud_bandwidth_MB'),
+    )
+    if key not in _CLIENTS:
+        _CLIENTS.update({key: LocalCloudClient(*key)})
+
+    return _CLIENTS[key]
+
+
+def check_access():
+    client = get_client()
+    if not client.root_dir.is_dir():
+        msg = 'Mock cloud provider directory does not exist: {}'
+        raise ValueError(msg.format(client.root_dir))
+
+    print('OK!', flush=True)
+
+
+def _api_error(error):
+    return dropbox_api.exceptions.ApiError(uuid.uuid4().hex, error, None, None)
+
+
+def _to_datetime(timestamp):
+    """Convert a POSIX timestamp to a naive UTC datetime without microseconds, as
+    used by Dropbox."""
+    return datetime.utcfromtimestamp(int(timestamp))
+
+
+class LocalCloudClient(object):
+    """Dropbox-like client whose storage is a local directory.
+
+    Parameters
+    ----------
+    root_dir : str or Path
+        Directory that represents the root of the cloud storage.
+    latency : float, optional
+        Time in seconds added to each request.
+    bandwidth_MB : float, optional
+        Maximum total upload/download rate in megabytes per second, shared by all
+        concurrent requests. By default, unlimited.
+
+    Notes
+    -----
+    Unlike Dropbox, paths are case-sensitive (if the local file system is). The
+    `client_modified` time of a file is stored as its modification time.
+
+    """
+
+    def __init__(self, root_dir, latency=0, bandwidth_MB=None):
+
+        self.root_dir = Path(root_dir)
+        self.latency = latency or 0
+        self.bandwidth = bandwidth_MB * 2**20 if bandwidth_MB else None
+
+        self._hpcflow_dir = self.root_dir.joinpath(Config.get('hpcflow_directory'))
+        self._uploads_dir = self._hpcflow_dir.joinpath('local_cloud_uploads')
+        self._hash_cache = HashCache(self.root_dir, 'local_cloud',
+                                     hash_func=get_content_hash)
+
+        self._link_lock = threading.Lock()
+        self._link_free_at = 0
+        self._commit_lock = threading.Lock()
+        self._sessions = {}
+        self._cursors = {}
+
+    def __repr__(self):
+        return '{}(root_dir={!r}, latency={!r}, bandwidth={!r})'.format(
+            self.__class__.__name__, self.root_dir, self.latency, self.bandwidth)
+
+    def _request(self, num_bytes=0):
+        """Emulate the latency of a request and the time taken to transfer its data
+        over a link that is shared by all requests."""
+
+        delay = self.latency
+        if self.bandwidth and num_bytes:
+            with self._link_lock:
+                now = perf_counter()
+                start = max(now, self._link_free_at)
+                self._link_free_at = start + num_bytes / self.bandwidth
+                delay += self._link_free_at - now
+        if delay:
+            sleep(delay)
+
+    def _get_local_path(self, path):
+        parts = [i for i in str(path).split('/') if i]
+        if '..' in parts:
+            raise _api_error(dropbox_api.files.LookupError('malformed_path', None))
+        return self.root_dir.joinpath(*parts)
+
+    def _get_remote_path(self, local_path):
+        return '/' + local_path.relative_to(self.root_dir).as_posix()
+
+    def _get_metadata(self, local_path):
+
+        remote_path = self._get_remote_path(local_path)
+
+        if local_path.is_dir():
+            return dropbox_api.files.FolderMetadata(
+                name=local_path.name,
+                id='id:{}'.format(local_path.stat().st_ino),
+                path_lower=remote_path.lower(),
+                path_display=remote_path,
+            )
+
+        stat = local_path.stat()
+        return dropbox_api.files.FileMetadata(
+            name=local_path.name,
+            id='id:{}'.format(stat.st_ino),
+            client_modified=_to_datetime(stat.st_mtime),
+            server_modified=_to_datetime(stat.st_ctime),
+            rev='{:x}'.format(stat.st_mtime_ns).zfill(9),
+            size=stat.st_size,
+            path_lower=remote_path.lower(),
+            path_display=remote_path,
+            content_hash=self._hash_cache.get_hash(local_path),
+        )
+
+    def _new_upload_path(self):
+        self._uploads_dir.mkdir(parents=True, exist_ok=True)
+        return self._uploads_dir.joinpath(uuid.uuid4().hex)
+
+    def _commit(self, upload_path, commit):
+        """Move an uploaded file to its destination according to the write mode of a
+        `CommitInfo`, and return its metadata."""
+
+        dst_path = self._get_local_path(commit.path)
+
+        with self._commit_lock:
+
+            if dst_path.exists() and not commit.mode.is_overwrite():
+                if get_content_hash(upload_path) == self._get_metadata(
+                        dst_path).content_hash:
+                    # Dropbox does not modify a file that is uploaded with the same
+                    # contents:
+                    upload_path.unlink()
+                    return self._get_metadata(dst_path)
+
+                elif commit.autorename:
+                    stem, suffix = dst_path.stem, dst_path.suffix
+                    count = 1
+                    while dst_path.exists():
+                        dst_path = dst_path.with_name(
+                            '{} ({}){}'.format(stem, count, suffix))
+                        count += 1
+
+                else:
+                    conflict = dropbox_api.files.WriteError(
+                        'conflict', dropbox_api.files.WriteConflictError('file', None))
+                    failed = dropbox_api.files.UploadWriteFailed(conflict, '')
+                    raise _api_error(dropbox_api.files.UploadError('path', failed))
+
+            dst_path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(upload_path, dst_path)
+
+            if commit.client_modified:
+                mtime = (commit.client_modified - datetime(1970, 1, 1)).total_seconds()
+                os.utime(dst_path, (mtime, mtime))
+
+            return self._get_metadata(dst_path)
+
+    def _get_session(self, cursor):
+        """Get an upload session, or the `UploadSessionLookupError` for its cursor."""
+
+        session = self._sessions.get(cursor.session_id)
+        if session is None:
+            return None, dropbox_api.files.UploadSessionLookupError('not_found', None)
+        elif cursor.offset != session['offset']:
+            offset_error = dropbox_api.files.UploadSessionOffsetError(session['offset'])
+            return None, dropbox_api.files.UploadSessionLookupError('incorrect_offset',
+                                                                    offset_error)
+        return session, None
+
+    def users_get_current_account(self):
+        self._request()
+
+    def files_get_metadata(self, path, **kwargs):
+        self._request()
+        local_path = self._get_local_path(path)
+        if not local_path.exists():
+            not_found = dropbox_api.files.LookupError('not_found', None)
+            raise _api_error(dropbox_api.files.GetMetadataError('path', not_found))
+        return self._get_metadata(local_path)
+
+    def files_list_folder(self, path, recursive=False, **kwargs):
+
+        self._request()
+        local_path = self._get_local_path(path)
+        if not local_path.is_dir():
+            tag = 'not_folder' if local_path.exists() else 'not_found'
+            lookup_error = dropbox_api.files.LookupError(tag, None)
+            raise _api_error(dropbox_api.files.ListFolderError('path', lookup_error))
+
+        paths = []
+        for root, dirs, files in os.walk(str(local_path)):
+            if Path(root) == self.root_dir:
+                dirs[:] = [i for i in dirs if Path(root, i) != self._hpcflow_dir]
+            paths.extend([Path(root, i) for i in sorted(dirs) + sorted(files)])
+            if not recursive:
+                break
+
+        entries = [self._get_metadata(i) for i in paths]
+        self._hash_cache.save()
+
+        cursor = uuid.uuid4().hex
+        self._cursors.update({cursor: entries})
+
+        return self.files_list_folder_continue(cursor, _request=False)
+
+    def files_list_folder_continue(self, cursor, _request=True):
+
+        if _request:
+            self._request()
+        entries = self._cursors.pop(cursor)
+        page, remaining = entries[:LIST_FOLDER_PAGE_SIZE], entries[LIST_FOLDER_PAGE_SIZE:]
+        if remaining:
+            self._cursors.update({cursor: remaining})
+
+        return dropbox_api.files.ListFolderResult(
+            entries=page, cursor=cursor, has_more=bool(remaining))
+
+    def files_upload(self, f, path, mode=dropbox_api.files.WriteMode('add', None),
+                     autorename=False, client_modified=None, **kwargs):
+
+        self._request(len(f))
+        upload_path = self._new_upload_path()
+        upload_path.write_bytes(f)
+        commit = dropbox_api.files.CommitInfo(
+            path=path, mode=mode, autorename=autorename, client_modified=client_modified)
+
+        return self._commit(upload_path, commit)
+
+    def files_upload_session_start(self, f, close=False):
+
+        self._request(len(f))
+        session_id = uuid.uuid4().hex
+        upload_path = self._new_upload_path()
+        upload_path.write_bytes(f)
+        self._sessions.update({
+            session_id: {'path': upload_path, 'offset': len(f), 'closed': close}
+        })
+
+        return dropbox_api.files.UploadSessionStartResult(session_id=session_id)
+
+    def files_upload_session_append_v2(self, f, cursor, close=False):
+
+        self._request(len(f))
+        session, lookup_error = self._get_session(cursor)
+        if lookup_error is None and session['closed']:
+            lookup_error = dropbox_api.files.UploadSessionLookupError('closed', None)
+        if lookup_error:
+            raise _api_error(lookup_error)
+
+        with session['path'].open('ab') as handle:
+            handle.write(f)
+        session['offset'] += len(f)
+        session['closed'] = close
+
+    def files_upload_session_finish(self, f, cursor, commit):
+
+        self._request(len(f))
+        session, lookup_error = self._get_session(cursor)
+        if lookup_error:
+            raise _api_error(
+                dropbox_api.files.UploadSessionFinishError('lookup_failed', lookup_error))
+
+        with session['path'].open('ab') as handle:
+            handle.write(f)
+        self._sessions.pop(cursor.session_id)
+
+        return self._commit(session['path'], commit)
+
+    def files_upload_session_finish_batch(self, entries):
+
+        self._request()
+        results = []
+        for entry in entries:
+
+            session, lookup_error = self._get_session(entry.cursor)
+            if lookup_error is None and not session['closed']:
+                lookup_error = dropbox_api.files.UploadSessionLookupError(
+                    'not_closed', None)
+            if lookup_error:
+                finish_error = dropbox_api.files.UploadSessionFinishError(
+                    'lookup_failed', lookup_error)
+                results.append(dropbox_api.files.UploadSessionFinishBatchResultEntry(
+                    'failure', finish_error))
+                continue
+
+            self._sessions.pop(entry.cursor.session_id)
+            try:
+                metadata = self._commit(session['path'], entry.commit)
+            except dropbox_api.exceptions.ApiError as err:
+                finish_error = dropbox_api.files.UploadSessionFinishError(
+                    'path', err.error.get_path().reason)
+                results.append(dropbox_api.files.UploadSessionFinishBatchResultEntry(
+                    'failure', finish_error))
+                continue
+
+            results.append(dropbox_api.files.UploadSessionFinishBatchResultEntry(
+                'success', metadata))
+
+        return dropbox_api.files.UploadSessionFinishBatchLaunch(
+            'complete', dropbox_api.files.UploadSessionFinishBatchResult(results))
+
+    def files_move_v2(self, from_path, to_path, **kwargs):
+
+        self._request()
+        src_path = self._get_local_path(from_path)
+        dst_path = self._get_local_path(to_path)
+        if not src_path.exists():
+            not_found = dropbox_api.files.LookupError('not_found', None)
+            raise _api_error(dropbox_api.files.RelocationError('from_lookup', not_found))
+        dst_path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(src_path, dst_path)
+
+        return dropbox_api.files.RelocationResult(self._get_metadata(dst_path))
+
+    def files_download_to_file(self, download_path, path, rev=None):
+
+        metadata = self.files_get_metadata(path)
+        self._request(metadata.size)
+        shutil.copyfile(self._get_local_path(path), download_path)
+
+        return metadata
@@ -0,0 +1,300 @@
+"""`hpcflow.archive.journal.py`
+
+This module contains functionality for resumable archiving, where the completion of
+each copied file is recorded in an append-only journal alongside the archived files,
+such that an interrupted archive can be resumed without recopying completed files.
+
+"""
+
+import json
+import os
+import socket
+import threading
+from datetime import datetime
+from pathlib import Path
+from time import monotonic
+
+from hpcflow.config import Config as CONFIG
+from hpcflow.archive.manifest import hash_file
+from hpcflow.copytree import copy2_fast, copytree_parallel
+
+JOURNAL_FILENAME = 'archive_journal.jsonl'
+
+# Buffered journal lines are written once there are this many, or once this many seconds
+# have elapsed since the previous write:
+JOURNAL_FLUSH_LINES = 256
+JOURNAL_FLUSH_INTERVAL = 1
+
+
+class ArchiveJournal(object):
+    """Append-only record of the files that have been copied to a destination
+    directory by an archive that has not yet completed.
+
+    The journal is stored within the `hpcflow_directory` of the destination directory.
+    Each line is a JSON object: the first line of each archive attempt records the
+    hostname and process ID of the archiving process, and subsequent lines record the
+    path (relative to the destination directory), size and modification time (in
+    nanoseconds) and, optionally, SHA-256 hash of each copied file. Lines are buffered
+    and appended in batches (see `JOURNAL_FLUSH_LINES` and `JOURNAL_FLUSH_INTERVAL`), so
+    a process that is killed mid-copy leaves at most a truncated final line, which is
+    ignored. Files whose lines were not written are recognised as complete by their
+    size and modification time (see `is_complete`).
+
+    The journal (and the `hpcflow_directory`, if it is then empty) is removed once the
+    archive completes without errors.
+
+    """
+
+    def __init__(self, dst_dir):
+
+        self.dst_dir = Path(dst_dir)
+        self.path = self.dst_dir.joinpath(CONFIG.get('hpcflow_directory'),
+                                          JOURNAL_FILENAME)
+        self.attempts, self.files = self.load()
+
+        self._lock = threading.Lock()
+        self._fd = None
+        self._buffer = []
+        self._flush_time = monotonic()
+
+    def __repr__(self):
+        return '{}(path={!r}, num_files={})'.format(
+            self.__class__.__name__, self.path, len(self.files))
+
+    @property
+    def is_resuming(self):
+        """True if a previous archive to this destination did not complete."""
+        return bool(self.attempts)
+
+    def load(self):
+        attempts = []
+        files = {}
+        if not self.path.is_file():
+            return attempts, files
+        with self.path.open() as handle:
+            for line in handle:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Truncated line written by a killed process:
+                    continue
+                if 'attempt' in entry:
+                    attempts.append(entry['attempt'])
+                else:
+                    files[entry.pop('path')] = entry
+        return attempts, files
+
+    def _append(self, entry, flush=False):
+        line = json.dumps(entry) + '\n'
+        with self._lock:
+            self._buffer.append(line)
+            if (flush or len(self._buffer) >= JOURNAL_FLUSH_LINES or
+                    monotonic() - self._flush_time >= JOURNAL_FLUSH_INTERVAL):
+                self._flush()
+
+    def _flush(self):
+        """Write buffered lines with a single write; the caller must hold the lock."""
+        if self._buffer:
+            if self._fd is None:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                self._fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+                                   0o666)
+            os.write(self._fd, ''.join(self._buffer).encode())
+            self._buffer = []
+        self._flush_time = monotonic()
+
+    def start(self):
+        """Record the start of an archive attempt by this process."""
+        self._append({
+            'attempt': {
+                'hostname': socket.gethostname(),
+                'pid': os.getpid(),
+                'start_time': str(datetime.now()),
+            }
+        }, flush=True)
+
+    def record(self, rel_path, stat, file_hash=None):
+        """Record that a file has been completely copied."""
+        entry = {
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'hash': file_hash,
+        }
+        self._append(dict(path=rel_path, **entry))
+        self.files[rel_path] = entry
+
+    def is_complete(self, rel_path, src_stat, dst_path, verify_hash=False,
+                    src_path=None):
+        """Check if a source file was completely copied by a previous attempt.
+
+        Parameters
+        ----------
+        rel_path : str
+            Path of the file relative to the source (and destination) directory.
+        src_stat : os.stat_result
+            Current status of the source file.
+        dst_path : str
+            Path of the destination file.
+        verify_hash : bool, optional
+            If True, the destination file must also have the same content hash as the
+            source file.
+        src_path : str, optional
+            Path of the source file; required if `verify_hash` is True.
+
+        Notes
+        -----
+        A file that is not in the journal is also considered complete if the
+        destination file has the same size and modification time as the source file
+        (and the same hash, if `verify_hash` is True), since the modification time is
+        copied after the file contents: this covers files whose copy completed just
+        before the previous attempt was killed, but whose journal entry was not
+        written.
+
+        """
+
+        try:
+            dst_stat = os.stat(dst_path)
+        except FileNotFoundError:
+            return False
+
+        if dst_stat.st_size != src_stat.st_size:
+            return False
+
+        entry = self.files.get(rel_path)
+        if entry:
+            if (entry['size'] != src_stat.st_size or
+                    entry['mtime_ns'] != src_stat.st_mtime_ns):
+                # Source file has changed since it was copied:
+                return False
+        elif dst_stat.st_mtime_ns != src_stat.st_mtime_ns:
+            return False
+
+        if verify_hash:
+            src_hash = hash_file(src_path)
+            if entry and entry.get('hash'):
+                if entry['hash'] != src_hash:
+                    return False
+            if hash_file(dst_path) != src_hash:
+                return False
+
+        return True
+
+    def close(self):
+        with self._lock:
+            self._flush()
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+    def remove(self):
+        """Remove the journal once the archive has completed, and the
+        `hpcflow_directory` in which it is stored, if that is then empty."""
+        with self._lock:
+            self._buffer = []
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
+        try:
+            self.path.parent.rmdir()
+        except OSError:
+            # Not empty (or already removed):
+            pass
+
+
+def copytree_resumable(src, dst, ignore=None, verify_hash=False, max_workers=None):
+    """Copy a directory tree, recording the completion of each copied file in an
+    `ArchiveJournal`, and, if a previous copy to the same destination was
+    interrupted, skipping files that were completely copied by that copy.
+
+    Parameters
+    ----------
+    src : str
+    dst : str
+    ignore : callable, optional
+        As for `shutil.copytree`.
+    verify_hash : bool, optional
+        If True, when resuming, files are only skipped if the content hashes of the
+        source and destination files match (rather than just their sizes and
+        modification times). The hash of each copied file is also recorded in the
+        journal.
+    max_workers : int, optional
+        Passed to `copytree_parallel`.
+
+    Returns
+    -------
+    dict
+        Numbers of files that were copied and skipped (completed by a previous
+        attempt), and the number of bytes copied.
+
+    """
+
+    journal = ArchiveJournal(dst)
+    if journal.is_resuming:
+        last = journal.attempts[-1]
+        msg = ('Resuming interrupted archive (last attempt by process {} on {} at {}); '
+               '{} files were completed.')
+        print(msg.format(last['pid'], last['hostname'], last['start_time'],
+                         len(journal.files)), flush=True)
+    journal.start()
+
+    num_skipped = 0
+    num_copied = 0
+    num_bytes = 0
+    counts_lock = threading.Lock()
+
+    def ignore_complete(src_dir, names):
+
+        nonlocal num_skipped
+
+        ignored = set(ignore(src_dir, names)) if ignore else set()
+        if not journal.is_resuming:
+            return ignored
+
+        dst_dir = os.path.join(dst, os.path.relpath(src_dir, src))
+        for name in names:
+            src_path = os.path.join(src_dir, name)
+            if name in ignored or os.path.isdir(src_path):
+                continue
+            rel_path = Path(os.path.relpath(src_path, src)).as_posix()
+            if journal.is_complete(rel_path, os.stat(src_path),
+                                   os.path.join(dst_dir, name), verify_hash, src_path):
+                ignored.add(name)
+                num_skipped += 1
+
+        return ignored
+
+    def copy_file(src_path, dst_path):
+
+        nonlocal num_copied, num_bytes
+
+        stat = os.stat(src_path)
+        copy2_fast(src_path, dst_path)
+        rel_path = Path(os.path.relpath(src_path, src)).as_posix()
+        journal.record(rel_path, stat, hash_file(dst_path) if verify_hash else None)
+        with counts_lock:
+            num_copied += 1
+            num_bytes += stat.st_size
+
+        return dst_path
+
+    try:
+        copytree_parallel(src, dst, ignore=ignore_complete, copy_function=copy_file,
+                          max_workers=max_workers)
+    except BaseException:
+        # Keep the journal, so the archive can be resumed:
+        journal.close()
+        raise
+
+    journal.remove()
+
+    out = {
+        'copied': num_copied,
+        'skipped': num_skipped,
+        'bytes_copied': num_bytes,
+    }
+
+    return out
@@ -0,0 +1,280 @@
+"""`hpcflow.archive.lock.py`
+
+This module contains an advisory file lock that is used to ensure only one task
+archives a given working directory at a time.
+
+"""
+
+import errno
+import os
+import socket
+import threading
+from datetime import datetime
+from pathlib import Path
+from time import sleep
+
+from hpcflow.archive.errors import ArchiveError
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class ArchiveLock(object):
+    """Exclusive, inter-process (and, on shared file systems, inter-node) lock on a
+    lock file.
+
+    Where available, POSIX record locks (`fcntl.lockf`) are used. Waiting processes
+    block in the kernel (no polling) and are woken as soon as the lock is released.
+    Locks are released by the operating system if the process holding the lock dies,
+    so a crashed task cannot leave a stale lock.
+
+    Otherwise (or if the file system does not support record locks, e.g. NFS mounted
+    without a lock daemon), the lock is represented by the existence of the lock
+    file, which is created exclusively. In this case, waiting processes poll, and a
+    lock file created by a process on the same host that is no longer running is
+    considered stale and is removed.
+
+    Processes only exclude each other if they use the same mode, so the mode is chosen
+    by the first process to use a lock directory, and recorded in a file in that
+    directory (`MODE_FILENAME`). If record locks then fail in a directory whose mode is
+    record locks, an `ArchiveError` is raised, rather than falling back to the other
+    mode.
+
+    In both cases, the hostname and process ID of the lock holder are written to the
+    lock file for diagnostic purposes.
+
+    """
+
+    POLL_INTERVAL = 1  # seconds; only used when record locks are not used
+    MODE_FILENAME = '.lock_mode'
+    MODES = ['fcntl', 'excl']
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._fd = None
+        self._mode = None
+
+    @property
+    def mode_path(self):
+        return self.path.with_name(self.MODE_FILENAME)
+
+    @property
+    def holder_path(self):
+        """Path of the file that contains the hostname and process ID of the lock
+        holder. When record locks are not used, this is also the lock file."""
+        if (self._mode or self._read_mode()) == 'excl':
+            return self.path.with_name(self.path.name + '.excl')
+        else:
+            return self.path
+
+    def __repr__(self):
+        return '{}(path={!r})'.format(self.__class__.__name__, self.path)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    @property
+    def is_locked(self):
+        return self._fd is not None
+
+    def get_holder(self):
+        """Get the (hostname, pid) written to the lock file by the lock holder (or the
+        most recent holder), or `None`."""
+        if self.is_locked:
+            # Note: we must not open and close the lock file while holding a record
+            # lock, since closing any file descriptor releases the process' locks.
+            return socket.gethostname(), os.getpid()
+        try:
+            holder = self.holder_path.read_text().split()
+            return holder[0], int(holder[1])
+        except (OSError, IndexError, ValueError):
+            return None
+
+    def _read_mode(self):
+        """Get the mode recorded for the lock directory, or `None`."""
+        try:
+            mode = self.mode_path.read_text().strip()
+        except FileNotFoundError:
+            return None
+        if mode not in self.MODES:
+            msg = 'Unknown lock mode "{}" in lock mode file: {}'
+            raise ArchiveError(msg.format(mode, self.mode_path))
+        return mode
+
+    def _get_mode(self):
+        """Get the mode of the lock directory, choosing and recording it if no process
+        has done so yet."""
+
+        mode = self._read_mode()
+        if mode:
+            return mode
+
+        # Check if record locks are supported, using a temporary file (rather than the
+        # lock file, since closing it would release any locks this process holds on
+        # the lock file), which is then linked as the mode file, unless another
+        # process has already recorded the mode:
+        tmp_path = self.mode_path.with_name('{}.{}.{}.{}'.format(
+            self.MODE_FILENAME, socket.gethostname(), os.getpid(), threading.get_ident()))
+        fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            mode = 'excl'
+            if fcntl is not None:
+                try:
+                    fcntl.lockf(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    fcntl.lockf(fd, fcntl.LOCK_UN)
+                    mode = 'fcntl'
+                except OSError as err:
+                    if err.errno not in (errno.ENOLCK, errno.EOPNOTSUPP):
+                        raise
+            os.write(fd, (mode + '\n').encode())
+        finally:
+            os.close(fd)
+
+        try:
+            os.link(tmp_path, self.mode_path)
+        except FileExistsError:
+            mode = self._read_mode()
+        finally:
+            tmp_path.unlink()
+
+        return mode
+
+    def _write_holder(self):
+        holder = '{} {} {}\n'.format(socket.gethostname(), os.getpid(), datetime.now())
+        os.ftruncate(self._fd, 0)
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        os.write(self._fd, holder.encode())
+
+    def acquire(self, blocking=True):
+        """Acquire the lock.
+
+        Parameters
+        ----------
+        blocking : bool, optional
+            If False, return immediately if the lock is held by another process.
+
+        Returns
+        -------
+        bool
+            True if the lock was acquired.
+
+        """
+
+        if self.is_locked:
+            raise RuntimeError('{} is already acquired.'.format(self))
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._mode = self._get_mode()
+
+        if self._mode == 'fcntl':
+            if fcntl is None:
+                msg = ('Lock directory uses record locks, which are not supported on '
+                       'this platform: {}')
+                raise ArchiveError(msg.format(self.path.parent))
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.lockf(fd, fcntl.LOCK_EX if blocking else
+                            fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError as err:
+                os.close(fd)
+                if err.errno in (errno.EACCES, errno.EAGAIN):
+                    return False
+                elif err.errno in (errno.ENOLCK, errno.EOPNOTSUPP):
+                    # Falling back to exclusive creation would not exclude processes
+                    # that hold record locks:
+                    msg = ('Record locks failed ({}) in a lock directory that uses '
+                           'record locks: {}')
+                    raise ArchiveError(msg.format(err, self.path.parent))
+                else:
+                    raise
+
+        else:
+            while True:
+                try:
+                    fd = os.open(self.holder_path, os.O_RDWR | os.O_CREAT | os.O_EXCL,
+                                 0o666)
+                    break
+                except FileExistsError:
+                    if self._remove_stale():
+                        continue
+                    if not blocking:
+                        return False
+                    sleep(self.POLL_INTERVAL)
+
+        self._fd = fd
+        self._write_holder()
+
+        return True
+
+    def release(self):
+        if not self.is_locked:
+            return
+        if self._mode == 'fcntl':
+            fcntl.lockf(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+        else:
+            os.close(self._fd)
+            try:
+                self.holder_path.unlink()
+            except FileNotFoundError:
+                pass
+        self._fd = None
+
+    def _remove_stale(self):
+        """Remove the lock file if it was created by a process on this host that is no
+        longer running. Only used when record locks are not used.
+
+        The lock file is first renamed to a name that is unique to this process, and
+        only removed if it is still the stale lock file. Otherwise, another waiting
+        process has removed the stale lock file and acquired the lock in the meantime,
+        and the lock file is restored.
+
+        """
+
+        try:
+            stale_holder = self.holder_path.read_text()
+        except FileNotFoundError:
+            return True
+        holder = stale_holder.split()
+        try:
+            hostname, pid = holder[0], int(holder[1])
+        except (IndexError, ValueError):
+            return False
+        if hostname != socket.gethostname() or os.name == 'nt':
+            # Note: on Windows, `os.kill` cannot be used to check for a process.
+            return False
+
+        try:
+            os.kill(pid, 0)
+            return False
+        except ProcessLookupError:
+            pass
+        except OSError:
+            # e.g. permission error: process exists.
+            return False
+
+        stale_path = self.holder_path.with_name('{}.stale.{}.{}.{}'.format(
+            self.holder_path.name, socket.gethostname(), os.getpid(),
+            threading.get_ident()))
+        try:
+            os.rename(self.holder_path, stale_path)
+        except FileNotFoundError:
+            return True
+
+        try:
+            if stale_path.read_text() != stale_holder:
+                # Not the stale lock file; restore it, unless it has been replaced:
+                try:
+                    os.link(stale_path, self.holder_path)
+                except FileExistsError:
+                    pass
+        finally:
+            stale_path.unlink()
+
+        return True
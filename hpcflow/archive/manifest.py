@@ -0,0 +1,313 @@
+"""`hpcflow.archive.manifest.py`
+
+This module contains functionality for incremental archiving, where a manifest of
+already-archived files is stored alongside the archived files.
+
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+from shutil import Error
+
+from hpcflow.config import Config as CONFIG
+from hpcflow.copytree import copytree_parallel
+
+MANIFEST_FILENAME = 'archive_manifest.json'
+MANIFEST_VERSION = 1
+
+
+def hash_file(path, block_size=2**20):
+    """Get the SHA-256 hash of the contents of a file."""
+    file_hash = hashlib.sha256()
+    with open(path, 'rb') as handle:
+        for block in iter(lambda: handle.read(block_size), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def get_directory_key(path):
+    """Get a short key that identifies a directory by its absolute path, e.g. to name a
+    hash cache that is not stored within the directory."""
+    return hashlib.sha256(str(Path(path).resolve()).encode()).hexdigest()[:16]
+
+
+class ArchiveManifest(object):
+    """Record of the files that have been archived to a destination directory.
+
+    The manifest is stored as a JSON file within the `hpcflow_directory` of the
+    destination directory, and maps the path of each archived file (relative to the
+    destination directory) to the size, modification time (in nanoseconds) and,
+    optionally, SHA-256 hash of the source file at the time it was archived.
+
+    """
+
+    def __init__(self, dst_dir):
+
+        self.dst_dir = Path(dst_dir)
+        self.path = self.dst_dir.joinpath(CONFIG.get('hpcflow_directory'),
+                                          MANIFEST_FILENAME)
+        self.files = self.load()
+
+        # Hashes of changed files computed by `is_changed`, for use by `update`:
+        self._hashes = {}
+
+    def __repr__(self):
+        return '{}(path={!r}, num_files={})'.format(
+            self.__class__.__name__, self.path, len(self.files))
+
+    def load(self):
+        if not self.path.is_file():
+            return {}
+        try:
+            with self.path.open() as handle:
+                manifest = json.load(handle)
+        except ValueError:
+            # Corrupt manifest; all files will be recopied:
+            return {}
+        if manifest.get('version') != MANIFEST_VERSION:
+            return {}
+        return manifest['files']
+
+    def save(self):
+        """Atomically write the manifest file."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name('{}.{}'.format(self.path.name, os.getpid()))
+        with tmp_path.open('w') as handle:
+            json.dump({'version': MANIFEST_VERSION, 'files': self.files}, handle)
+        os.replace(tmp_path, self.path)
+
+    def is_changed(self, rel_path, stat, src_path=None):
+        """Check if a source file has changed since it was archived.
+
+        Parameters
+        ----------
+        rel_path : str
+            Path of the file relative to the source (and destination) directory.
+        stat : os.stat_result
+            Current status of the source file.
+        src_path : str, optional
+            Path to the source file. If specified, and the size or modification time
+            of the file has changed, the file is only considered changed if its
+            content hash differs from the hash in the manifest (if there is one).
+
+        """
+
+        entry = self.files.get(rel_path)
+        if not entry:
+            return True
+
+        if entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            return False
+
+        if src_path and entry.get('hash') and entry['size'] == stat.st_size:
+            file_hash = hash_file(src_path)
+            if file_hash == entry['hash']:
+                # Same content; update the recorded modification time:
+                entry['mtime_ns'] = stat.st_mtime_ns
+                return False
+            self._hashes[rel_path] = (stat.st_mtime_ns, file_hash)
+
+        return True
+
+    def update(self, rel_path, stat, src_path=None):
+        """Record that a source file has been archived. If `src_path` is specified, the
+        content hash of the file is also recorded (reusing the hash computed by
+        `is_changed`, if the file has not since been modified)."""
+
+        file_hash = None
+        if src_path:
+            mtime_ns, file_hash = self._hashes.pop(rel_path, (None, None))
+            if mtime_ns != stat.st_mtime_ns:
+                file_hash = hash_file(src_path)
+
+        self.files[rel_path] = {
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'hash': file_hash,
+        }
+
+
+class HashCache(object):
+    """Cache of the content hashes of files within a directory.
+
+    The cache is stored as a JSON file, and maps the path of each file (relative to the
+    directory) to the size, modification time, inode number, status change time (times
+    in nanoseconds) and hash of the file when the hash was computed. A cached hash is
+    only used if all of these are unchanged, so a file that is rewritten in place
+    within the resolution of its modification time is still hashed again.
+
+    Parameters
+    ----------
+    root_dir : str or Path
+        Directory whose files are hashed.
+    name : str
+        Name of the cache, which is used in the file name of the cache.
+    hash_func : callable, optional
+        Function that returns the hash of the file at a given path. By default,
+        `hash_file`.
+    cache_dir : str or Path, optional
+        Directory in which to store the cache. By default, the `hpcflow_directory` of
+        `root_dir`.
+
+    """
+
+    def __init__(self, root_dir, name, hash_func=hash_file, cache_dir=None):
+
+        self.root_dir = Path(root_dir)
+        if cache_dir is None:
+            cache_dir = self.root_dir.joinpath(CONFIG.get('hpcflow_directory'))
+        self.path = Path(cache_dir).joinpath('{}_hash_cache.json'.format(name))
+        self.hash_func = hash_func
+        self.hashes = self.load()
+        self._is_modified = False
+
+    def __repr__(self):
+        return '{}(path={!r}, num_files={})'.format(
+            self.__class__.__name__, self.path, len(self.hashes))
+
+    def load(self):
+        if not self.path.is_file():
+            return {}
+        try:
+            with self.path.open() as handle:
+                cache = json.load(handle)
+        except ValueError:
+            return {}
+        if cache.get('version') != MANIFEST_VERSION:
+            return {}
+        return cache['hashes']
+
+    def save(self):
+        """Atomically write the cache file, if any hashes have been computed."""
+        if not self._is_modified:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name('{}.{}'.format(self.path.name, os.getpid()))
+        with tmp_path.open('w') as handle:
+            json.dump({'version': MANIFEST_VERSION, 'hashes': self.hashes}, handle)
+        os.replace(tmp_path, self.path)
+        self._is_modified = False
+
+    def get_hash(self, path):
+        """Get the hash of a file within the root directory, computing it only if the
+        file has changed since its hash was cached."""
+
+        stat = os.stat(path)
+        rel_path = Path(os.path.relpath(path, self.root_dir)).as_posix()
+        key = {
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'ino': stat.st_ino,
+            'ctime_ns': stat.st_ctime_ns,
+        }
+        entry = self.hashes.get(rel_path)
+        if entry and all([entry.get(k) == v for k, v in key.items()]):
+            return entry['hash']
+
+        file_hash = self.hash_func(path)
+        self.hashes[rel_path] = dict(key, hash=file_hash)
+        self._is_modified = True
+
+        return file_hash
+
+
+def copytree_incremental(src, dst, ignore=None, hash_files=False, delete=False,
+                         max_workers=None):
+    """Copy a directory tree, only copying files that are new or have changed since
+    the previous copy to the same destination, as recorded in an `ArchiveManifest`.
+
+    Parameters
+    ----------
+    src : str
+    dst : str
+    ignore : callable, optional
+        As for `shutil.copytree`.
+    hash_files : bool, optional
+        If True, record the content hash of each copied file, and do not recopy files
+        whose modification time has changed but whose content has not.
+    delete : bool, optional
+        If True, delete previously archived files from the destination if they no
+        longer exist in the source directory. Only files recorded in the manifest are
+        deleted.
+    max_workers : int, optional
+        Passed to `copytree_parallel`.
+
+    Returns
+    -------
+    dict
+        Numbers of files that were copied, skipped (unchanged) and deleted, and the
+        number of bytes copied.
+
+    """
+
+    manifest = ArchiveManifest(dst)
+    to_copy = {}
+    seen = set()
+    excluded = set()
+
+    def ignore_unchanged(src_dir, names):
+
+        ignored = set(ignore(src_dir, names)) if ignore else set()
+        for name in names:
+            src_path = os.path.join(src_dir, name)
+            rel_path = Path(os.path.relpath(src_path, src)).as_posix()
+            if name in ignored:
+                # Excluded files and directories are not deleted from the destination:
+                excluded.add(rel_path)
+                continue
+            if os.path.isdir(src_path):
+                continue
+            seen.add(rel_path)
+            stat = os.stat(src_path)
+            if manifest.is_changed(rel_path, stat, src_path if hash_files else None):
+                to_copy.update({src_path: (rel_path, stat)})
+            else:
+                ignored.add(name)
+
+        return ignored
+
+    errors = []
+    try:
+        copytree_parallel(src, dst, ignore=ignore_unchanged, max_workers=max_workers)
+    except Error as err:
+        errors = err.args[0]
+
+    failed = set([i[0] for i in errors])
+    num_copied = 0
+    num_bytes = 0
+    for src_path, (rel_path, stat) in to_copy.items():
+        if src_path not in failed:
+            manifest.update(rel_path, stat, src_path if hash_files else None)
+            num_copied += 1
+            num_bytes += stat.st_size
+
+    deleted = []
+    if delete:
+        for rel_path in sorted(set(manifest.files) - seen):
+            if any([rel_path == i or rel_path.startswith(i + '/') for i in excluded]):
+                continue
+            try:
+                os.remove(os.path.join(dst, rel_path))
+            except FileNotFoundError:
+                pass
+            except OSError as why:
+                errors.append((None, os.path.join(dst, rel_path), str(why)))
+                continue
+            deleted.append(rel_path)
+            manifest.files.pop(rel_path)
+
+    manifest.save()
+
+    if errors:
+        raise Error(errors)
+
+    out = {
+        'copied': num_copied,
+        'skipped': len(seen) - len(to_copy),
+        'deleted': len(deleted),
+        'bytes_copied': num_bytes,
+    }
+
+    return out
@@ -0,0 +1,325 @@
+"""`hpcflow.archive.pack.py`
+
+This module contains functionality for packed archiving, where the files of a
+directory are archived into a small number of (optionally compressed) tar segments,
+alongside an index that locates each file within the segments.
+
+"""
+
+import bz2
+import gzip
+import json
+import lzma
+import os
+import tarfile
+import zlib
+from pathlib import Path
+from shutil import Error
+
+INDEX_FILENAME = 'index.json'
+INDEX_VERSION = 1
+READ_BLOCK_SIZE = 2**20
+
+COMPRESSION_EXT = {
+    '': '.tar',
+    'gz': '.tar.gz',
+    'bz2': '.tar.bz2',
+    'xz': '.tar.xz',
+}
+
+
+def _get_compressor(compression):
+    if compression == 'gz':
+        # `wbits=31` produces a gzip (rather than zlib) stream:
+        return zlib.compressobj(6, zlib.DEFLATED, 31)
+    elif compression == 'bz2':
+        return bz2.BZ2Compressor()
+    elif compression == 'xz':
+        return lzma.LZMACompressor()
+
+
+def _open_decompressed(handle, compression):
+    if compression == 'gz':
+        return gzip.GzipFile(fileobj=handle, mode='rb')
+    elif compression == 'bz2':
+        return bz2.BZ2File(handle)
+    elif compression == 'xz':
+        return lzma.LZMAFile(handle)
+    else:
+        return handle
+
+
+class _SegmentWriter(object):
+    """Writer of a single tar segment, in which each member is written as a separate
+    compressed stream (if compressed).
+
+    Concatenated gzip, bzip2 and xz streams are valid files in these formats, so a
+    segment can be read by standard tools (e.g. `tar -xf`), but a member can also be
+    read by seeking to its offset in the segment and decompressing only that member.
+
+    """
+
+    def __init__(self, path, compression):
+        self.path = path
+        self.compression = compression
+        self._handle = path.open('wb')
+
+    @property
+    def size(self):
+        return self._handle.tell()
+
+    def _write_stream(self, blocks):
+        compressor = _get_compressor(self.compression)
+        for block in blocks:
+            self._handle.write(compressor.compress(block) if compressor else block)
+        if compressor:
+            self._handle.write(compressor.flush())
+
+    def add_file(self, src_path, arc_name):
+        """Add a file to the segment and return its offset within the segment."""
+
+        offset = self.size
+        try:
+            self._add_file(src_path, arc_name)
+        except OSError:
+            # Remove any partially written member:
+            self._handle.truncate(offset)
+            self._handle.seek(offset)
+            raise
+
+        return offset
+
+    def _add_file(self, src_path, arc_name):
+
+        with open(src_path, 'rb') as handle:
+
+            tar_info = tarfile.TarInfo(arc_name)
+            stat = os.fstat(handle.fileno())
+            tar_info.size = stat.st_size
+            tar_info.mtime = stat.st_mtime
+            tar_info.mode = stat.st_mode & 0o7777
+
+            def get_blocks():
+                yield tar_info.tobuf(format=tarfile.PAX_FORMAT)
+                remaining = tar_info.size
+                while remaining > 0:
+                    block = handle.read(min(READ_BLOCK_SIZE, remaining))
+                    if not block:
+                        raise OSError('File "{}" was truncated while being '
+                                      'archived.'.format(src_path))
+                    remaining -= len(block)
+                    yield block
+                padding = tar_info.size % tarfile.BLOCKSIZE
+                if padding:
+                    yield tarfile.NUL * (tarfile.BLOCKSIZE - padding)
+
+            self._write_stream(get_blocks())
+
+    def close(self):
+        # End-of-archive marker:
+        self._write_stream([tarfile.NUL * (2 * tarfile.BLOCKSIZE)])
+        self._handle.close()
+
+
+def pack_directory(src, dst, ignore=None, segment_size=2**30, compression=''):
+    """Archive the files within a directory tree into size-capped tar segments.
+
+    Parameters
+    ----------
+    src : str or Path
+        Directory to archive.
+    dst : str or Path
+        Directory in which to write the segments and index file. Segments and an index
+        from a previous packed archive to this directory are replaced.
+    ignore : callable, optional
+        As for `shutil.copytree`.
+    segment_size : int, optional
+        Approximate maximum size in bytes of the (uncompressed) contents of each
+        segment. A file larger than this is written to its own segment.
+    compression : str, optional
+        One of "" (no compression), "gz", "bz2" or "xz".
+
+    Returns
+    -------
+    dict
+        Numbers of files and segments that were written, and the number of bytes
+        archived.
+
+    Raises
+    ------
+    shutil.Error
+        If any files could not be archived. The other files are still archived and
+        indexed.
+
+    Notes
+    -----
+    Only regular files (and files pointed to by symbolic links) are archived; empty
+    directories are not.
+
+    """
+
+    if compression not in COMPRESSION_EXT:
+        msg = 'Compression must be one of: {}, but "{}" was specified.'
+        raise ValueError(msg.format(list(COMPRESSION_EXT), compression))
+
+    src = Path(src)
+    dst = Path(dst)
+    dst.mkdir(parents=True, exist_ok=True)
+
+    old_index = read_index(dst) if dst.joinpath(INDEX_FILENAME).is_file() else None
+
+    segments = []
+    members = {}
+    writer = None
+    seg_contents = 0
+    num_bytes = 0
+    errors = []
+
+    for root, dirs, files in os.walk(str(src)):
+
+        if ignore:
+            ignored = ignore(root, dirs + files)
+            dirs[:] = [i for i in dirs if i not in ignored]
+            files = [i for i in files if i not in ignored]
+        dirs.sort()
+
+        for name in sorted(files):
+
+            src_path = os.path.join(root, name)
+            arc_name = Path(os.path.relpath(src_path, src)).as_posix()
+            try:
+                size = os.path.getsize(src_path)
+            except OSError as why:
+                errors.append((src_path, None, str(why)))
+                continue
+
+            if writer is None or (seg_contents and seg_contents + size > segment_size):
+                if writer:
+                    writer.close()
+                seg_name = 'segment_{}{}.tmp'.format(len(segments),
+                                                    COMPRESSION_EXT[compression])
+                writer = _SegmentWriter(dst.joinpath(seg_name), compression)
+                segments.append(seg_name)
+                seg_contents = 0
+
+            try:
+                offset = writer.add_file(src_path, arc_name)
+            except OSError as why:
+                errors.append((src_path, None, str(why)))
+                continue
+            members.update({
+                arc_name: {
+                    'segment': len(segments) - 1,
+                    'offset': offset,
+                    'size': size,
+                }
+            })
+            seg_contents += size
+            num_bytes += size
+
+    if writer:
+        writer.close()
+
+    # Replace any previous segments:
+    for idx, tmp_name in enumerate(segments):
+        seg_name = tmp_name[:-len('.tmp')]
+        os.replace(dst.joinpath(tmp_name), dst.joinpath(seg_name))
+        segments[idx] = seg_name
+    if old_index:
+        for seg_name in set(old_index['segments']) - set(segments):
+            try:
+                dst.joinpath(seg_name).unlink()
+            except FileNotFoundError:
+                pass
+
+    index = {
+        'version': INDEX_VERSION,
+        'compression': compression,
+        'segments': segments,
+        'members': members,
+    }
+    tmp_path = dst.joinpath('{}.{}'.format(INDEX_FILENAME, os.getpid()))
+    with tmp_path.open('w') as handle:
+        json.dump(index, handle, indent=1)
+    os.replace(tmp_path, dst.joinpath(INDEX_FILENAME))
+
+    if errors:
+        raise Error(errors)
+
+    out = {
+        'files': len(members),
+        'segments': len(segments),
+        'bytes': num_bytes,
+    }
+
+    return out
+
+
+def read_index(packed_dir):
+    """Read the index file of a packed archive directory."""
+
+    index_path = Path(packed_dir).joinpath(INDEX_FILENAME)
+    with index_path.open() as handle:
+        index = json.load(handle)
+
+    if index.get('version') != INDEX_VERSION:
+        msg = 'Unsupported packed archive index version: {}.'
+        raise ValueError(msg.format(index.get('version')))
+
+    return index
+
+
+def extract_files(packed_dir, dst_dir, members=None):
+    """Extract files from a packed archive directory.
+
+    Parameters
+    ----------
+    packed_dir : str or Path
+        Directory containing the segments and index file.
+    dst_dir : str or Path
+        Directory into which files are extracted, at their paths relative to the
+        archived directory.
+    members : list of str, optional
+        Paths (relative to the archived directory, with forward slashes) of the files
+        to extract. By default, all files are extracted. Each file is read directly
+        from its offset in its segment, without reading the rest of the segment.
+
+    Returns
+    -------
+    list of str
+        Paths of the extracted files.
+
+    """
+
+    packed_dir = Path(packed_dir)
+    dst_dir = Path(dst_dir)
+    index = read_index(packed_dir)
+
+    if members is None:
+        members = list(index['members'])
+
+    missing = [i for i in members if i not in index['members']]
+    if missing:
+        raise ValueError('Files not found in packed archive: {}'.format(missing))
+
+    # Group by segment and sort by offset, to read each segment sequentially:
+    locations = sorted([(index['members'][i]['segment'], index['members'][i]['offset'], i)
+                        for i in members])
+
+    extracted = []
+    for seg_idx, offset, name in locations:
+        seg_path = packed_dir.joinpath(index['segments'][seg_idx])
+        with seg_path.open('rb') as handle:
+            handle.seek(offset)
+            stream = _open_decompressed(handle, index['compression'])
+            with tarfile.open(fileobj=stream, mode='r|') as tar:
+                if hasattr(tarfile, 'data_filter'):
+                    tar.extraction_filter = tarfile.data_filter
+                tar_info = tar.next()
+                if tar_info is None or tar_info.name != name:
+                    msg = 'Packed archive index is inconsistent with segment "{}".'
+                    raise ValueError(msg.format(seg_path))
+                tar.extract(tar_info, path=str(dst_dir))
+        extracted.append(name)
+
+    return extracted
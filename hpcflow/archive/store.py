@@ -0,0 +1,173 @@
+"""`hpcflow.archive.store.py`
+
+This module contains a content-addressed store for deduplicating local archives, in
+which each distinct file is stored once and archived files are hard links to stored
+files.
+
+"""
+
+import errno
+import os
+import stat
+import threading
+from pathlib import Path
+
+from hpcflow.archive.manifest import HashCache, get_directory_key, hash_file
+from hpcflow.copytree import copy2_fast, copytree_parallel
+
+# Errors from `os.link` for which archived files are copied instead:
+LINK_UNSUPPORTED_ERRNOS = (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP)
+
+
+class ArchiveStore(object):
+    """Content-addressed store of archived files.
+
+    Each file is stored once, at a path determined by the SHA-256 hash of its contents.
+    Stored files are made read-only, since they may be shared by many archived
+    directories.
+
+    Parameters
+    ----------
+    path : str or Path
+        Root directory of the store. This must be on the same file system as the
+        archived directories for hard links to be used.
+    hash_cache : HashCache, optional
+        Cache of the hashes of source files, such that unchanged files are not hashed
+        again. A file is considered unchanged only if its size, modification time,
+        inode number and status change time are unchanged.
+
+    """
+
+    def __init__(self, path, hash_cache=None):
+
+        self.path = Path(path)
+        self.hash_cache = hash_cache
+
+        self._lock = threading.Lock()
+        self.num_files = 0
+        self.num_stored = 0
+        self.bytes_stored = 0
+
+    def __repr__(self):
+        return '{}(path={!r})'.format(self.__class__.__name__, self.path)
+
+    def get_object_path(self, digest):
+        return self.path.joinpath('objects', digest[:2], digest[2:])
+
+    def add(self, src_path):
+        """Add a file to the store, if its contents are not already stored, and return
+        the path of the stored file."""
+
+        if self.hash_cache:
+            digest = self.hash_cache.get_hash(src_path)
+        else:
+            digest = hash_file(src_path)
+
+        obj_path = self.get_object_path(digest)
+        if obj_path.exists():
+            return obj_path
+
+        # Copy to a temporary file and hash the copy, in case the source file was
+        # modified after it was hashed:
+        tmp_dir = self.path.joinpath('tmp')
+        tmp_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = tmp_dir.joinpath('{}.{}.{}'.format(
+            digest, os.getpid(), threading.get_ident()))
+        copy2_fast(src_path, tmp_path)
+        tmp_digest = hash_file(tmp_path)
+        if tmp_digest != digest:
+            digest = tmp_digest
+            obj_path = self.get_object_path(digest)
+
+        os.chmod(tmp_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        obj_path.parent.mkdir(parents=True, exist_ok=True)
+
+        # The same contents may be stored concurrently by another thread or process. The
+        # first to store them wins, so that the stored file (which may already be hard
+        # linked into archives) is not replaced:
+        try:
+            os.link(tmp_path, obj_path)
+        except FileExistsError:
+            return obj_path
+        except OSError:
+            # Hard links are not supported:
+            if obj_path.exists():
+                return obj_path
+            os.replace(tmp_path, obj_path)
+        finally:
+            if tmp_path.exists():
+                os.remove(tmp_path)
+
+        with self._lock:
+            self.num_stored += 1
+            self.bytes_stored += obj_path.stat().st_size
+
+        return obj_path
+
+    def link(self, obj_path, dst_path):
+        """Materialise a stored file at a destination path, as a hard link if possible,
+        or otherwise as a copy."""
+
+        if os.path.exists(dst_path) and os.path.samefile(obj_path, dst_path):
+            return
+
+        tmp_path = '{}.{}.{}'.format(dst_path, os.getpid(), threading.get_ident())
+        try:
+            os.link(obj_path, tmp_path)
+        except OSError as err:
+            if err.errno not in LINK_UNSUPPORTED_ERRNOS:
+                raise
+            copy2_fast(obj_path, tmp_path)
+        os.replace(tmp_path, dst_path)
+
+    def copy_file(self, src_path, dst_path):
+        """Copy function for `copytree_parallel`, which archives a file via the
+        store."""
+
+        self.link(self.add(src_path), dst_path)
+        with self._lock:
+            self.num_files += 1
+
+        return dst_path
+
+
+def copytree_dedup(src, dst, store_dir, ignore=None, max_workers=None):
+    """Copy a directory tree such that each copied file is a hard link to a file in a
+    content-addressed `ArchiveStore`.
+
+    Parameters
+    ----------
+    src : str
+    dst : str
+    store_dir : str or Path
+        Root directory of the store.
+    ignore : callable, optional
+        As for `shutil.copytree`.
+    max_workers : int, optional
+        Passed to `copytree_parallel`.
+
+    Returns
+    -------
+    dict
+        Numbers of files that were archived and that were added to the store (i.e.
+        that were not already stored), and the number of bytes added to the store.
+
+    """
+
+    # Keep the hash cache in the store, rather than in the source directory:
+    hash_cache = HashCache(src, 'archive_store_{}'.format(get_directory_key(src)),
+                           cache_dir=Path(store_dir).joinpath('hash_caches'))
+    store = ArchiveStore(store_dir, hash_cache=hash_cache)
+    try:
+        copytree_parallel(src, dst, ignore=ignore, copy_function=store.copy_file,
+                          max_workers=max_workers)
+    finally:
+        store.hash_cache.save()
+
+    out = {
+        'files': store.num_files,
+        'stored': store.num_stored,
+        'bytes_stored': store.bytes_stored,
+    }
+
+    return out
@@ -0,0 +1,169 @@
+"""`hpcflow.benchmark.py`
+
+Module containing benchmarks of performance-critical operations.
+
+"""
+
+import io
+import os
+import shutil
+from contextlib import redirect_stdout
+from pathlib import Path
+from time import perf_counter
+
+from hpcflow.archive.cloud.providers import dropbox
+from hpcflow.archive.cloud.providers.local import LocalCloudClient
+from hpcflow.copytree import copytree_multi, copytree_parallel
+from hpcflow.utils import create_file_of_N_MB
+
+
+def make_copytree_benchmark_dirs(dir_path, num_small=2000, small_size_KB=16,
+                                 num_large=4, large_size_MB=1024):
+    """Generate source directory trees for the `copytree` benchmark.
+
+    Parameters
+    ----------
+    dir_path : Path
+        Directory in which to generate the source directories "small_files" and
+        "large_files". Files that already exist are not regenerated.
+    num_small : int, optional
+        Number of small files, which are distributed across sub-directories of 100
+        files each.
+    small_size_KB : float, optional
+        Size of each small file in kilobytes.
+    num_large : int, optional
+        Number of large files.
+    large_size_MB : float, optional
+        Size of each large file in megabytes.
+
+    Returns
+    -------
+    dict of (str: Path)
+        Source directory for each benchmark case.
+
+    """
+
+    small_dir = dir_path.joinpath('small_files')
+    for i in range(num_small):
+        sub_dir = small_dir.joinpath('dir_{}'.format(i // 100))
+        sub_dir.mkdir(parents=True, exist_ok=True)
+        path = sub_dir.joinpath('file_{}.dat'.format(i))
+        if not path.is_file():
+            path.write_bytes(os.urandom(int(small_size_KB * 2**10)))
+
+    large_dir = dir_path.joinpath('large_files')
+    large_dir.mkdir(parents=True, exist_ok=True)
+    for i in range(num_large):
+        path = large_dir.joinpath('file_{}.dat'.format(i))
+        if not path.is_file():
+            create_file_of_N_MB(large_size_MB, path)
+
+    return {'small_files': small_dir, 'large_files': large_dir}
+
+
+def benchmark_copytree(dir_path, num_small=2000, small_size_KB=16, num_large=4,
+                       large_size_MB=1024, max_workers=None, repeats=3):
+    """Compare the time taken to copy directory trees with `copytree_multi` and
+    `copytree_parallel`, for many small files and for a few large files.
+
+    Parameters
+    ----------
+    dir_path : str or Path
+        Directory in which source trees are generated and copied. To benchmark
+        archiving, this should be on (or be a mount point of) the archive file system.
+    max_workers : int, optional
+        Number of worker threads used by `copytree_parallel`. By default, taken from
+        the `archive_copy_workers` configuration item.
+    repeats : int, optional
+        Number of times to repeat each copy. The minimum time is reported.
+
+    Notes
+    -----
+    The source files may be cached in memory after they are generated or first
+    copied, so this benchmark mostly measures the performance of writing to the
+    destination file system.
+
+    Returns
+    -------
+    dict of (str: dict of (str: float))
+        For each benchmark case, the minimum time in seconds taken by each copy
+        function.
+
+    """
+
+    dir_path = Path(dir_path)
+    src_dirs = make_copytree_benchmark_dirs(dir_path, num_small, small_size_KB,
+                                            num_large, large_size_MB)
+    copy_funcs = {
+        'copytree_multi': copytree_multi,
+        'copytree_parallel': lambda src, dst: copytree_parallel(
+            src, dst, max_workers=max_workers),
+    }
+
+    results = {}
+    for case, src_dir in src_dirs.items():
+        results.update({case: {}})
+        for func_name, func in copy_funcs.items():
+            times = []
+            for _ in range(repeats):
+                dst_dir = dir_path.joinpath('{}_copy'.format(case))
+                if dst_dir.exists():
+                    shutil.rmtree(dst_dir)
+                start = perf_counter()
+                func(str(src_dir), str(dst_dir))
+                times.append(perf_counter() - start)
+                shutil.rmtree(dst_dir)
+            results[case].update({func_name: min(times)})
+
+    return results
+
+
+def benchmark_cloud_archive(dir_path, num_small=2000, small_size_KB=16, num_large=4,
+                            large_size_MB=64, latency=0.05, bandwidth_MB=50):
+    """Time cloud archiving of many small files and of a few large files, using the
+    mock (`local`) cloud provider, so no network access is required.
+
+    Parameters
+    ----------
+    dir_path : str or Path
+        Directory in which source trees are generated, and which contains the storage
+        directory of the mock cloud provider.
+    latency : float, optional
+        Time in seconds added to each request to the mock cloud provider.
+    bandwidth_MB : float, optional
+        Maximum total transfer rate to the mock cloud provider in megabytes per second.
+
+    Notes
+    -----
+    The number of concurrent uploads and the upload chunk size are taken from the
+    `cloud_upload_workers` and `cloud_upload_chunk_size` configuration items.
+
+    Returns
+    -------
+    dict of (str: dict of (str: float))
+        For each benchmark case, the time in seconds taken to archive the source
+        directory to an empty destination ("upload"), and to archive it again when all
+        files are unchanged ("skip").
+
+    """
+
+    dir_path = Path(dir_path)
+    src_dirs = make_copytree_benchmark_dirs(dir_path, num_small, small_size_KB,
+                                            num_large, large_size_MB)
+
+    cloud_dir = dir_path.joinpath('local_cloud')
+    if cloud_dir.exists():
+        shutil.rmtree(cloud_dir)
+    cloud_dir.mkdir()
+    client = LocalCloudClient(cloud_dir, latency=latency, bandwidth_MB=bandwidth_MB)
+
+    results = {}
+    for case, src_dir in src_dirs.items():
+        results.update({case: {}})
+        for run in ['upload', 'skip']:
+            start = perf_counter()
+            with redirect_stdout(io.StringIO()):
+                dropbox.archive_directory(client, src_dir, case)
+            results[case].update({run: perf_counter() - start})
+
+    return results
@@ -13,6 +13,7 @@ import click
 
 from hpcflow import __version__
 from hpcflow import api
+from hpcflow.staging import format_transfer
 from hpcflow.utils import create_file_of_N_MB
 
 
@@ -207,6 +208,39 @@ def set_task_end(cmd_group_sub_id, task_idx, iter_idx, directory=None, config_di
     api.set_task_end(cmd_group_sub_id, task_idx, iter_idx, directory, config_dir)
 
 
+@cli.command()
+@click.option('--directory', '-d')
+@click.option('--config-dir', type=click.Path(exists=True))
+@click.argument('cmd_group_sub_id', type=click.INT)
+@click.argument('task_idx', type=click.INT)
+@click.argument('iter_idx', type=click.INT)
+def release(cmd_group_sub_id, task_idx, iter_idx, directory=None, config_dir=None):
+    print('hpcflow.cli.release', flush=True)
+    api.release_dependent_tasks(cmd_group_sub_id, task_idx, iter_idx, directory,
+                                config_dir)
+
+
+@cli.command()
+@click.option('--directory', '-d')
+@click.option('--config-dir', type=click.Path(exists=True))
+@click.argument('cmd_group_sub_id', type=click.INT)
+@click.argument('iter_idx', type=click.INT)
+def release_orphans(cmd_group_sub_id, iter_idx, directory=None, config_dir=None):
+    print('hpcflow.cli.release_orphans', flush=True)
+    api.release_orphaned_tasks(cmd_group_sub_id, iter_idx, directory, config_dir)
+
+
+@cli.command()
+@click.option('--directory', '-d')
+@click.option('--config-dir', type=click.Path(exists=True))
+@click.argument('cmd_group_sub_id', type=click.INT)
+@click.argument('task_idx', type=click.INT)
+@click.argument('iter_idx', type=click.INT)
+def check_loop(cmd_group_sub_id, task_idx, iter_idx, directory=None, config_dir=None):
+    print('hpcflow.cli.check_loop', flush=True)
+    api.check_loop(cmd_group_sub_id, task_idx, iter_idx, directory, config_dir)
+
+
 @cli.command()
 @click.option('--directory', '-d')
 @click.option('--config-dir', type=click.Path(exists=True))
@@ -255,6 +289,97 @@ def root_archive(workflow_id, directory=None, config_dir=None):
     )
 
 
+@cli.command()
+@click.option('--directory', '-d')
+@click.option('--workflow-id', '-w', type=click.INT)
+@click.option('--config-dir', type=click.Path(exists=True))
+def root_archive_status(directory=None, workflow_id=None, config_dir=None):
+    """Show the status of the background root archive process of a Workflow."""
+    status = api.get_root_archive_status(
+        workflow_id=workflow_id,
+        dir_path=directory,
+        config_dir=config_dir,
+    )
+    for key, val in status.items():
+        print('{}: {}'.format(key, val))
+
+
+@cli.command()
+@click.argument('task_log_path', type=click.Path(exists=True, dir_okay=False))
+@click.argument('iter_dir', type=click.Path(exists=True, file_okay=False))
+@click.argument('command_group_order', type=click.INT)
+@click.argument('task_idx', type=click.INT)
+def append_log(task_log_path, iter_dir, command_group_order, task_idx):
+    """Append a task log to the consolidated log of its job array."""
+    api.append_task_log(task_log_path, iter_dir, command_group_order, task_idx)
+
+
+@cli.command()
+@click.option('--exclude-from', type=click.Path(exists=True, dir_okay=False),
+              help='Exclusion list of files that should not be staged.')
+@click.option('--manifest', type=click.Path(dir_okay=False),
+              help='Path at which to write the manifest of staged files.')
+@click.option('--workers', type=click.INT,
+              help='Number of copy workers (default: `stage_copy_workers` config item).')
+@click.option('--input-cache', type=click.Path(file_okay=False),
+              help='Root directory of a shared input cache on the alternate scratch.')
+@click.option('--cache-pattern', multiple=True,
+              help='Pattern of read-only input files to stage via the input cache.')
+@click.option('--config-dir', type=click.Path(exists=True))
+@click.argument('src', type=click.Path(exists=True, file_okay=False))
+@click.argument('dst', type=click.Path(file_okay=False))
+def stage_in(src, dst, exclude_from=None, manifest=None, workers=None, input_cache=None,
+             cache_pattern=None, config_dir=None):
+    """Copy a task working directory to an alternate scratch directory."""
+    stats = api.stage_in(src, dst, exclusion_list_path=exclude_from,
+                         manifest_path=manifest, max_workers=workers,
+                         input_cache_dir=input_cache,
+                         input_cache_patterns=list(cache_pattern or []),
+                         config_dir=config_dir)
+    print(format_transfer('in', stats), flush=True)
+
+
+@cli.command()
+@click.option('--manifest', type=click.Path(dir_okay=False),
+              help='Manifest written by `stage-in`; unchanged files are not copied.')
+@click.option('--workers', type=click.INT,
+              help='Number of copy workers (default: `stage_copy_workers` config item).')
+@click.option('--config-dir', type=click.Path(exists=True))
+@click.argument('src', type=click.Path(exists=True, file_okay=False))
+@click.argument('dst', type=click.Path(file_okay=False))
+def stage_out(src, dst, manifest=None, workers=None, config_dir=None):
+    """Move new or modified files from an alternate scratch directory back to a task
+    working directory."""
+    stats = api.stage_out(src, dst, manifest_path=manifest, max_workers=workers,
+                          config_dir=config_dir)
+    print(format_transfer('out', stats), flush=True)
+
+
+@cli.command()
+@click.option('--directory', '-d')
+@click.option('--workflow-id', '-w', type=click.INT)
+@click.option('--command-group', '-c', type=click.INT, default=0, show_default=True,
+              help='Execution order of the command group.')
+@click.option('--iteration', '-i', type=click.INT, default=0, show_default=True)
+@click.option('--config-dir', type=click.Path(exists=True))
+@click.argument('task_idx', type=click.INT)
+def logs(task_idx, directory=None, workflow_id=None, command_group=0, iteration=0,
+         config_dir=None):
+    """Show the log of a task of the most recent submission of a Workflow."""
+    task_log = api.get_task_log(
+        task_idx,
+        command_group=command_group,
+        iteration=iteration,
+        workflow_id=workflow_id,
+        dir_path=directory,
+        config_dir=config_dir,
+    )
+    if task_log is None:
+        print('Task {} has not yet written a log.'.format(task_idx))
+    else:
+        print(task_log, end='')
+
+
 @cli.command()
 def stat():
     """Show the status of running tasks and the number completed tasks."""
@@ -271,6 +396,92 @@ def show_stats(directory=None, workflow_id=None, config_dir=None):
     print(stats_fmt)
 
 
+@cli.command()
+@click.option('--directory', '-d')
+@click.option('--workflow-id', '-w', type=click.INT)
+@click.option('--max-wait', type=click.FLOAT,
+              help='Maximum acceptable mean lock wait time in seconds.')
+@click.option('--config-dir', type=click.Path(exists=True))
+def show_throttle(directory=None, workflow_id=None, max_wait=None, config_dir=None):
+    """Show the lock contention and recommended maximum running tasks for each job."""
+    recs = api.get_throttle_recommendations(directory, workflow_id, config_dir=config_dir,
+                                            max_wait=max_wait)
+    for i in recs:
+        contention = ', '.join(['{}: {:.1f} s'.format(k, v)
+                                for k, v in i['contention'].items()]) or '-'
+        print('Command group submission ID {} (iteration {}): mean lock wait by running '
+              'tasks: {}; current maximum: {}; recommended maximum: {}'.format(
+                  i['command_group_submission_id'],
+                  i['iteration'],
+                  contention,
+                  i['max_running_tasks'] or '-',
+                  i['recommended'] or '-',
+              ))
+
+
+@cli.command()
+@click.option('--num-small', type=click.INT, default=2000, show_default=True)
+@click.option('--small-size-KB', type=click.FLOAT, default=16, show_default=True)
+@click.option('--num-large', type=click.INT, default=4, show_default=True)
+@click.option('--large-size-MB', type=click.FLOAT, default=1024, show_default=True)
+@click.option('--workers', type=click.INT,
+              help='Number of copy threads (default: `archive_copy_workers`).')
+@click.option('--repeats', type=click.INT, default=3, show_default=True)
+@click.option('--config-dir', type=click.Path(exists=True))
+@click.argument('directory', type=click.Path(exists=True, file_okay=False))
+def benchmark_copytree(directory, num_small, small_size_kb, num_large, large_size_mb,
+                       workers=None, repeats=3, config_dir=None):
+    """Compare serial and parallel archive copying of many small and a few large files
+    within DIRECTORY."""
+    results = api.benchmark_copytree(directory, num_small=num_small,
+                                     small_size_KB=small_size_kb, num_large=num_large,
+                                     large_size_MB=large_size_mb, max_workers=workers,
+                                     repeats=repeats, config_dir=config_dir)
+    for case, times in results.items():
+        serial = times['copytree_multi']
+        parallel = times['copytree_parallel']
+        print('{}: copytree_multi: {:.3f} s; copytree_parallel: {:.3f} s '
+              '(speed-up: {:.2f}x)'.format(case, serial, parallel, serial / parallel))
+
+
+@cli.command()
+@click.option('--num-small', type=click.INT, default=2000, show_default=True)
+@click.option('--small-size-KB', type=click.FLOAT, default=16, show_default=True)
+@click.option('--num-large', type=click.INT, default=4, show_default=True)
+@click.option('--large-size-MB', type=click.FLOAT, default=64, show_default=True)
+@click.option('--latency', type=click.FLOAT, default=0.05, show_default=True,
+              help='Time in seconds added to each request.')
+@click.option('--bandwidth-MB', type=click.FLOAT, default=50, show_default=True,
+              help='Maximum transfer rate in MB per second.')
+@click.option('--config-dir', type=click.Path(exists=True))
+@click.argument('directory', type=click.Path(exists=True, file_okay=False))
+def benchmark_cloud_archive(directory, num_small, small_size_kb, num_large,
+                            large_size_mb, latency, bandwidth_mb, config_dir=None):
+    """Time cloud archiving of many small and a few large files within DIRECTORY, using
+    the mock cloud provider."""
+    results = api.benchmark_cloud_archive(
+        directory, num_small=num_small, small_size_KB=small_size_kb,
+        num_large=num_large, large_size_MB=large_size_mb, latency=latency,
+        bandwidth_MB=bandwidth_mb, config_dir=config_dir)
+    for case, times in results.items():
+        print('{}: upload: {:.3f} s; skip unchanged: {:.3f} s'.format(
+            case, times['upload'], times['skip']))
+
+
+@cli.command()
+@click.option('--member', '-m', multiple=True,
+              help=('Path of a file to extract, relative to the archived directory. May '
+                    'be repeated. By default, all files are extracted.'))
+@click.option('--config-dir', type=click.Path(exists=True))
+@click.argument('packed_dir', type=click.Path(exists=True, file_okay=False))
+@click.argument('dst_dir', type=click.Path(file_okay=False))
+def extract_archive(packed_dir, dst_dir, member=None, config_dir=None):
+    """Extract files from the packed archive in PACKED_DIR into DST_DIR."""
+    extracted = api.extract_archive(packed_dir, dst_dir, members=(list(member) or None),
+                                    config_dir=config_dir)
+    print('Extracted {} files.'.format(len(extracted)))
+
+
 @cli.command()
 @click.option('--directory', '-d')
 @click.option('--workflow-id', '-w', type=click.INT)
@@ -36,6 +36,10 @@ class Config(object):
         'variable_scope',
         'variables',
         'stats',
+        'auto_throttle',
+        'partial_hold',
+        'consolidate_logs',
+        'alternate_scratch_cache',
     ]
     __CMD_GROUP_KEYS_REQ = [
         'commands',
@@ -57,6 +61,10 @@ class Config(object):
         'exec_order',
         'stats',
         'job_name',
+        'auto_throttle',
+        'partial_hold',
+        'consolidate_logs',
+        'alternate_scratch_cache',
     ]
     __CMD_GROUP_DEFAULTS = {
         'is_job_array': True,
@@ -69,18 +77,26 @@ class Config(object):
         'output_dir': None,  # Set in `Config.set_config`
         'error_dir': None,  # Set in `Config.set_config`
         'stats': False,
+        'auto_throttle': False,
+        'partial_hold': False,
+        'consolidate_logs': False,
+        'alternate_scratch_cache': None,
     }
 
     __CONSTANTS = {
         'DB_name': 'workflow.db',
         'alt_scratch_exc_file': 'alt_scratch_exclude',
         'alt_scratch_exc_file_ext': '.txt',
+        'alt_scratch_manifest_file': 'alt_scratch_manifest',
+        'alt_scratch_manifest_file_ext': '.json',
         'profile_keys_required': __PROFILE_KEYS_REQ,
         'profile_keys_allowed': __PROFILE_KEYS_GOOD,
         'cmd_group_keys_required': __CMD_GROUP_KEYS_REQ,
         'cmd_group_keys_allowed': __CMD_GROUP_KEYS_GOOD,
         'cmd_group_defaults': __CMD_GROUP_DEFAULTS,
         'dropbox_app_key': 'g2zt0hmhfjavd2d',
+        'archive_locks_dir': 'archive_locks',
+        'archive_store_dir': '.hpcflow_store',
     }
 
     # These may be customised in the config file:
@@ -91,15 +107,33 @@ class Config(object):
         'profile_filename_fmt': '<<profile_order>>.<<profile_name>>.yml',
         'profile_ext': '.yml',
         'jobscript_ext': '.sh',
-        'variable_file_ext': '.txt',
         'working_dirs_file_ext': '.txt',
+        'working_dir_record_width': 256,  # bytes (minimum)
         'default_output_dir': 'output',
         'default_error_dir': 'output',
         'hpcflow_directory': '.hpcflow',
         'archive_locations': {},
-        'dropbox_token': None
+        'dropbox_token': None,
+        'throttle_max_wait': 10,
+        'kill_batch_size': 100,
+        'archive_copy_workers': 8,
+        'stage_copy_workers': 8,
+        'archive_debounce': 5,
+        'root_archive_heartbeat': 30,  # seconds
+        'root_archive_timeout': 300,  # seconds
+        'cloud_upload_chunk_size': 16 * 2**20,  # bytes
+        'cloud_upload_retries': 5,
+        'cloud_upload_workers': 8,
+        'local_cloud_dir': None,
+        'local_cloud_latency': 0,  # seconds
+        'local_cloud_bandwidth_MB': None,  # MB per second
     }
 
+    # These are no longer used, and are ignored (with a warning) if in the config file:
+    __DEPRECATED = [
+        'variable_file_ext',
+    ]
+
     __conf = {}
 
     is_set = False
@@ -142,6 +176,11 @@ class Config(object):
         with config_file.open() as handle:
             config_dat = yaml.load(handle) or {}
 
+        for key in Config.__DEPRECATED:
+            if key in config_dat:
+                warn(f'Configuration option "{key}" is deprecated and is ignored.')
+                del config_dat[key]
+
         bad_keys = list(set(config_dat.keys()) - set(Config.__ALLOWED.keys()))
         if bad_keys:
             bad_keys_fmt = ', '.join([f'"{i}"' for i in bad_keys])
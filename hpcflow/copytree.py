@@ -1,5 +1,10 @@
-from shutil import copy2, copystat, Error
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from shutil import copy2, copyfile, copystat, Error
+import errno
 import os
+import sys
+
+from hpcflow.config import Config as CONFIG
 
 
 def copytree_multi(src, dst, symlinks=False, ignore=None, copy_function=copy2,
@@ -64,3 +69,175 @@ def copytree_multi(src, dst, symlinks=False, ignore=None, copy_function=copy2,
     if errors:
         raise Error(errors)
     return dst
+
+
+# Errors for which a kernel-side copy is not supported for a given pair of files, in
+# which case we fall back to a different copy method:
+_FAST_COPY_ERRNOS = {
+    errno.EXDEV,
+    errno.ENOSYS,
+    errno.EINVAL,
+    errno.EBADF,
+    errno.EOPNOTSUPP,
+    errno.ETXTBSY,
+    errno.ENOTSUP,
+}
+
+_FAST_COPY_BLOCK_SIZE = 2 ** 27  # 128 MiB
+
+_HAS_COPY_FILE_RANGE = hasattr(os, 'copy_file_range')
+_HAS_SENDFILE = hasattr(os, 'sendfile') and sys.platform.startswith('linux')
+
+
+def _fast_copy(copy_func, fsrc, fdst, size):
+    """Copy the contents of one file descriptor to another using a kernel-side copy
+    function, with the signature of `os.copy_file_range` or `os.sendfile`.
+
+    Returns
+    -------
+    bool
+        False if the copy function is not supported for these files (or copies nothing,
+        as `os.copy_file_range` may on some file systems), and no data has been copied.
+
+    """
+
+    offset = 0
+    while offset < size:
+        try:
+            count = min(_FAST_COPY_BLOCK_SIZE, size - offset)
+            copied = copy_func(fsrc, fdst, offset, count)
+        except OSError as err:
+            if offset == 0 and err.errno in _FAST_COPY_ERRNOS:
+                return False
+            raise
+        if copied == 0:
+            if offset == 0:
+                return False
+            # Source file has shrunk since we checked its size:
+            break
+        offset += copied
+
+    return True
+
+
+def _copy_file_range(fsrc, fdst, offset, count):
+    # Copy to the same offset in the destination (`copy_file_range` advances the file
+    # position of the destination):
+    return os.copy_file_range(fsrc, fdst, count, offset_src=offset)
+
+
+def _sendfile(fsrc, fdst, offset, count):
+    return os.sendfile(fdst, fsrc, offset, count)
+
+
+def copyfile_fast(src, dst):
+    """Copy the contents of a file, using `os.copy_file_range` (which may allow copy
+    offloading on network file systems) or `os.sendfile` where supported, and falling
+    back to `shutil.copyfile`."""
+
+    with open(src, 'rb') as fsrc:
+        size = os.fstat(fsrc.fileno()).st_size
+        with open(dst, 'wb') as fdst:
+            if size == 0:
+                return dst
+            for copy_func, available in ((_copy_file_range, _HAS_COPY_FILE_RANGE),
+                                         (_sendfile, _HAS_SENDFILE)):
+                if available and _fast_copy(copy_func, fsrc.fileno(), fdst.fileno(),
+                                            size):
+                    return dst
+
+    return copyfile(src, dst)
+
+
+def copy2_fast(src, dst):
+    """Like `shutil.copy2`, but using `copyfile_fast` to copy the file contents."""
+    copyfile_fast(src, dst)
+    copystat(src, dst)
+    return dst
+
+
+def copytree_parallel(src, dst, symlinks=False, ignore=None, copy_function=copy2_fast,
+                      ignore_dangling_symlinks=False, max_workers=None):
+    """Parallel version of `copytree_multi`, in which files are copied by a bounded pool
+    of worker threads.
+
+    Directories are created (if they do not exist) as the source tree is walked, and
+    their metadata is copied once all files have been copied. As with `copytree_multi`,
+    errors are collected and raised together as a `shutil.Error`.
+
+    Parameters
+    ----------
+    max_workers : int, optional
+        Maximum number of files to copy concurrently. By default, taken from the
+        `archive_copy_workers` configuration item.
+
+    """
+
+    if max_workers is None:
+        max_workers = CONFIG.get('archive_copy_workers')
+
+    errors = []
+    dir_pairs = []
+
+    def copy_file(srcname, dstname):
+        try:
+            copy_function(srcname, dstname)
+        except Error as err:
+            return err.args[0]
+        except OSError as why:
+            return [(srcname, dstname, str(why))]
+        return []
+
+    def walk(src, dst, futures):
+
+        names = os.listdir(src)
+        if ignore is not None:
+            ignored_names = ignore(src, names)
+        else:
+            ignored_names = set()
+
+        if not os.path.isdir(dst):
+            os.makedirs(dst)
+        dir_pairs.append((src, dst))
+
+        for name in names:
+            if name in ignored_names:
+                continue
+            srcname = os.path.join(src, name)
+            dstname = os.path.join(dst, name)
+            try:
+                if os.path.islink(srcname):
+                    linkto = os.readlink(srcname)
+                    if symlinks:
+                        os.symlink(linkto, dstname)
+                        copystat(srcname, dstname, follow_symlinks=not symlinks)
+                        continue
+                    # ignore dangling symlink if the flag is on
+                    if not os.path.exists(linkto) and ignore_dangling_symlinks:
+                        continue
+                if os.path.isdir(srcname):
+                    walk(srcname, dstname, futures)
+                else:
+                    # Will raise a SpecialFileError for unsupported file types
+                    futures.append(executor.submit(copy_file, srcname, dstname))
+            except OSError as why:
+                errors.append((srcname, dstname, str(why)))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = []
+        walk(src, dst, futures)
+        for future in as_completed(futures):
+            errors.extend(future.result())
+
+    # Copy directory metadata after their contents, deepest first:
+    for src_dir, dst_dir in reversed(dir_pairs):
+        try:
+            copystat(src_dir, dst_dir)
+        except OSError as why:
+            # Copying file access times may fail on Windows
+            if getattr(why, 'winerror', None) is None:
+                errors.append((src_dir, dst_dir, str(why)))
+
+    if errors:
+        raise Error(errors)
+    return dst
@@ -4,15 +4,17 @@
 import re
 import os
 import enum
-from datetime import datetime
+import threading
+from bisect import bisect_right
+from datetime import datetime, timedelta
 from math import ceil, floor
 from pathlib import Path
 from pprint import pprint
-from subprocess import run, PIPE
+from subprocess import run, PIPE, Popen, DEVNULL, STDOUT
 from time import sleep
 
 from sqlalchemy import (Column, Integer, DateTime, JSON, ForeignKey, Boolean,
-                        Enum, String, select, Float)
+                        Enum, String, select, Float, func)
 from sqlalchemy.orm import relationship, deferred, Session, reconstructor
 from sqlalchemy.exc import IntegrityError, OperationalError
 
@@ -22,9 +24,13 @@ from hpcflow.archive.archive import Archive, TaskArchiveStatus
 from hpcflow.base_db import Base
 from hpcflow.archive.cloud.cloud import CloudProvider
 from hpcflow.nesting import NestingType
+from hpcflow.records import (INDEX_RECORD_WIDTH, append_indexed,
+                             write_record)
 from hpcflow.scheduler import SunGridEngine
-from hpcflow.utils import coerce_same_length, zeropad, format_time_delta, get_random_hex, datetime_to_dict, timedelta_to_dict
-from hpcflow.validation import validate_task_multiplicity
+from hpcflow.staging import InputCache
+from hpcflow.task_log import read_task_log
+from hpcflow.utils import coerce_same_length, format_time_delta, get_random_hex, datetime_to_dict, timedelta_to_dict
+from hpcflow.validation import validate_task_multiplicity, validate_working_directory
 from hpcflow.variables import (
     select_cmd_group_var_names, select_cmd_group_var_definitions,
     extract_variable_names, resolve_variable_values, UnresolvedVariableError
@@ -39,9 +45,25 @@ class IterationStatus(enum.Enum):
 
     pending = 'pending'
     active = 'active'
+    continuing = 'continuing'
     complete = 'complete'
 
 
+class RootArchiveStatus(enum.Enum):
+
+    pending = 'pending'
+    active = 'active'
+    complete = 'complete'
+    failed = 'failed'
+
+
+class KillResult(enum.Enum):
+
+    deleted = 'deleted'
+    inactive = 'inactive'
+    failed = 'failed'
+
+
 class Workflow(Base):
     """Class to represent a Workflow."""
 
@@ -54,6 +76,11 @@ class Workflow(Base):
     root_archive_id = Column(Integer, ForeignKey('archive.id'), nullable=True)
     root_archive_excludes = Column(JSON, nullable=True)
     root_archive_directory = Column(String(255), nullable=True)
+    root_archive_status = Column(Enum(RootArchiveStatus), nullable=True)
+    root_archive_pid = Column(Integer, nullable=True)
+    root_archive_start_time = Column(DateTime, nullable=True)
+    root_archive_end_time = Column(DateTime, nullable=True)
+    root_archive_heartbeat = Column(DateTime, nullable=True)
     _profile_files = Column('profile_files', JSON, nullable=True)
     loop = Column(JSON)
     parallel_modes = Column(JSON, nullable=True)
@@ -111,6 +138,13 @@ class Workflow(Base):
                 groups : list of int, optional
                     Which command groups to include in iterations beyond the first. If not
                     specified, all command groups are included in the loop.
+                convergence_command : str, optional
+                    If specified, the loop is submitted dynamically: each iteration is
+                    only submitted once the previous iteration has completed and this
+                    shell command (executed in the workflow directory, with the
+                    environment variable `ITER_IDX` set to the completed iteration) has
+                    returned a non-zero exit code. A zero exit code signifies the loop
+                    has converged, and no further iterations are submitted.
         parallel_modes : dict, optional
             If specified, (case-insensitive) keys are one or more of: 'MPI', 'OpenMP'.
             Each is a dict with allowed keys:
@@ -175,7 +209,11 @@ class Workflow(Base):
             for i in archives:
                 arch_i = Archive(**i)
                 archive_objs.append(arch_i)
-                archive_dir_names.append(arch_i.get_archive_dir(self))
+                if arch_i.cloud_provider == CloudProvider.null:
+                    archive_dir_names.append(arch_i.get_archive_dir(self))
+                else:
+                    # Resolved in the root archive process (see `do_root_archive`):
+                    archive_dir_names.append(None)
 
         if root_archive_idx is not None:
             self.root_archive = archive_objs[root_archive_idx]
@@ -212,7 +250,9 @@ class Workflow(Base):
 
         self.validate(archive_objs)
         self._execute_pre_commands()
-        self.do_root_archive()
+
+        if self.root_archive or None in archive_dir_names:
+            self.root_archive_status = RootArchiveStatus('pending')
 
     def __repr__(self):
         out = ('{}('
@@ -247,6 +287,43 @@ class Workflow(Base):
     def first_iteration(self):
         return self.iterations[0]
 
+    @property
+    def dynamic_loop(self):
+        """Whether loop iterations are submitted one at a time, subject to a
+        convergence check."""
+        return bool(self.loop.get('convergence_command'))
+
+    @property
+    def loop_groups(self):
+        """Get the execution orders of the command groups that are included in each
+        loop iteration."""
+        loop_groups = self.loop.get('groups') or []
+        if not loop_groups and self.dynamic_loop:
+            loop_groups = [i.exec_order for i in self.command_groups]
+        return loop_groups
+
+    def is_loop_converged(self, iteration):
+        """Execute the loop convergence command for a given completed iteration.
+
+        Returns
+        -------
+        bool
+            True if the convergence command returned a zero exit code.
+
+        """
+
+        env = {**os.environ, 'ITER_IDX': str(iteration.order_id)}
+        proc = run(self.loop['convergence_command'], shell=True, stdout=PIPE,
+                   stderr=PIPE, cwd=str(self.directory), env=env)
+        conv_out = proc.stdout.decode().strip()
+        conv_err = proc.stderr.decode().strip()
+        if conv_out:
+            print(conv_out, flush=True)
+        if conv_err:
+            print(conv_err, flush=True)
+
+        return proc.returncode == 0
+
     @property
     def profile_files(self):
         if self._profile_files:
@@ -291,13 +368,6 @@ class Workflow(Base):
             cmd_group.exec_order = i['exec_order']
             cmd_group.nesting = i['nesting']
 
-        # If using an Archive with a cloud provider, check access:
-        for i in archive_objs:
-            if i.cloud_provider != CloudProvider.null:
-                msg = f'Checking access to cloud storage ({i.name})...'
-                print(msg, end='', flush=True)
-                i.cloud_provider.check_access()
-
     def add_submission(self, project, task_range=None):
         """Add a new submission to this Workflow.
 
@@ -468,42 +538,400 @@ class Workflow(Base):
             pre_cmd_out = proc.stdout.decode()
             pre_cmd_err = proc.stderr.decode()
 
+    def start_root_archive(self):
+        """Start the root archive in a detached background process.
+
+        The process invokes `hpcflow root-archive`, whose progress is recorded in the
+        `root_archive_status` column, and whose output is written to a log file in the
+        hpcflow directory. This is a no-op if no root archive (or cloud archive
+        directory resolution) is required. If the process cannot be started, the root
+        archive status is set to "failed".
+
+        """
+
+        if self.root_archive_status != RootArchiveStatus('pending'):
+            return
+
+        session = Session.object_session(self)
+
+        log_path = self.directory.joinpath(
+            CONFIG.get('hpcflow_directory'),
+            'root_archive_{}.log'.format(self.id_),
+        )
+        cmd = [
+            'hpcflow', 'root-archive',
+            '--directory', str(self.directory),
+            '--workflow-id', str(self.id_),
+            '--config-dir', str(CONFIG.get('config_dir')),
+        ]
+        if os.name == 'nt':
+            from subprocess import DETACHED_PROCESS, CREATE_NEW_PROCESS_GROUP
+            kwargs = {'creationflags': DETACHED_PROCESS | CREATE_NEW_PROCESS_GROUP}
+        else:
+            kwargs = {'start_new_session': True}
+
+        # Tasks waiting on the root archive process consider it dead if this (and later
+        # heartbeats) become stale:
+        self.root_archive_heartbeat = datetime.now()
+        session.commit()
+
+        try:
+            with log_path.open('a') as handle:
+                proc = Popen(cmd, stdin=DEVNULL, stdout=handle, stderr=STDOUT,
+                             cwd=str(self.directory), **kwargs)
+        except OSError as err:
+            self.root_archive_status = RootArchiveStatus('failed')
+            self.root_archive_end_time = datetime.now()
+            session.commit()
+            print('Failed to start the root archive background process: {}. The root '
+                  'archive may be retried with `hpcflow root-archive`.'.format(err),
+                  flush=True)
+            return
+
+        print('Started root archive in background process (PID {}); output is written '
+              'to: "{}".'.format(proc.pid, log_path), flush=True)
+
+    def resolve_archive_directories(self):
+        """Check access to, and resolve the archive directories of, any cloud archives.
+
+        This is deferred from Workflow creation, since it involves listing the remote
+        archive path, which may be slow.
+
+        """
+
+        archives = [self.root_archive] if self.root_archive else []
+        for i in self.command_groups:
+            if i.archive and i.archive not in archives:
+                archives.append(i.archive)
+
+        for arch in archives:
+
+            if arch.cloud_provider == CloudProvider.null:
+                continue
+
+            cmd_groups = [i for i in self.command_groups
+                          if i.archive is arch and i.archive_directory is None]
+            is_root = self.root_archive is arch and self.root_archive_directory is None
+            if not cmd_groups and not is_root:
+                continue
+
+            msg = f'Checking access to cloud storage ({arch.name})...'
+            print(msg, end='', flush=True)
+            arch.cloud_provider.check_access()
+            arch.check_path()
+
+            archive_dir = arch.get_archive_dir(self)
+            if is_root:
+                self.root_archive_directory = archive_dir
+            for i in cmd_groups:
+                i.archive_directory = archive_dir
+
+    @staticmethod
+    def beat_root_archive_heartbeat(bind, workflow_id, stop):
+        """Periodically record a heartbeat of the root archive process in a separate
+        database session, until `stop` (a `threading.Event`) is set."""
+
+        session = Session(bind=bind)
+        while not stop.wait(CONFIG.get('root_archive_heartbeat')):
+            try:
+                session.query(Workflow).filter(Workflow.id_ == workflow_id).update(
+                    {'root_archive_heartbeat': datetime.now()},
+                    synchronize_session=False,
+                )
+                session.commit()
+            except OperationalError:
+                # Database is likely locked; try again at the next heartbeat.
+                session.rollback()
+        session.close()
+
     def do_root_archive(self):
-        """Copy the workflow directory to the root archive location."""
+        """Resolve any cloud archive directories and copy the workflow directory to the
+        root archive location, recording progress in the `root_archive_status`
+        column.
+
+        While running, a heartbeat is periodically recorded in the
+        `root_archive_heartbeat` column, so tasks waiting on this process can detect if
+        it has died.
+
+        """
+
+        session = Session.object_session(self)
+
+        sleep_time = 5
+        context = 'Workflow.do_root_archive'
+        block_msg = ('{{}} {}: Database locked. Sleeping for {} seconds'.format(
+            context, sleep_time))
+
+        def commit_status(**values):
+            blocked = True
+            while blocked:
+                try:
+                    for key, val in values.items():
+                        setattr(self, key, val)
+                    session.commit()
+                    blocked = False
+                except OperationalError:
+                    # Database is likely locked.
+                    session.rollback()
+                    print(block_msg.format(datetime.now()), flush=True)
+                    sleep(sleep_time)
+
+        now = datetime.now()
+        commit_status(
+            root_archive_status=RootArchiveStatus('active'),
+            root_archive_pid=os.getpid(),
+            root_archive_start_time=now,
+            root_archive_end_time=None,
+            root_archive_heartbeat=now,
+        )
+
+        stop_heartbeat = threading.Event()
+        heartbeat = threading.Thread(
+            target=Workflow.beat_root_archive_heartbeat,
+            args=(session.bind, self.id_, stop_heartbeat),
+            daemon=True,
+        )
+        heartbeat.start()
+
+        success = False
+        try:
+            blocked = True
+            while blocked:
+                try:
+                    self.resolve_archive_directories()
+                    session.commit()
+                    blocked = False
+                except OperationalError:
+                    # Database is likely locked.
+                    session.rollback()
+                    print(block_msg.format(datetime.now()), flush=True)
+                    sleep(sleep_time)
+            if self.root_archive:
+                success = self.root_archive.execute(self.root_archive_excludes,
+                                                    self.root_archive_directory)
+            else:
+                success = True
+        finally:
+            stop_heartbeat.set()
+            heartbeat.join()
+            if not success:
+                session.rollback()
+            commit_status(
+                root_archive_status=RootArchiveStatus(
+                    'complete' if success else 'failed'),
+                root_archive_end_time=datetime.now(),
+            )
+
+    def wait_for_root_archive(self, archive):
+        """Wait for the root archive process before a task archive to a given archive.
+
+        The root archive process resolves the archive directories of cloud archives, so
+        we wait until these are resolved. If `archive` is the root archive, we also wait
+        until the root archive has completed or failed, since the root archive copies
+        the workflow directory to the same archive location.
+
+        If the root archive process does not record a heartbeat for longer than
+        `root_archive_timeout` seconds (e.g. because it was killed), its status is set
+        to "failed".
+
+        Parameters
+        ----------
+        archive : Archive
+
+        """
+
+        session = Session.object_session(self)
+
+        sleep_time = 5
+        timeout = timedelta(seconds=CONFIG.get('root_archive_timeout'))
+        context = 'Workflow.wait_for_root_archive'
+        block_msg = ('{{}} {}: Waiting for the root archive process. Sleeping for {} '
+                     'seconds'.format(context, sleep_time))
+        dead_msg = ('{} {}: No heartbeat from the root archive process since {}; '
+                    'setting root archive status to "failed".')
+
+        while True:
+            try:
+                session.expire_all()
+                status = self.root_archive_status
+                resolved = all(i.archive_directory is not None
+                               for i in self.command_groups if i.archive)
+                if resolved and (archive is not self.root_archive or status in [
+                        None, RootArchiveStatus('complete'), RootArchiveStatus('failed')]):
+                    return
+                heartbeat = self.root_archive_heartbeat
+                if (status in [RootArchiveStatus('pending'), RootArchiveStatus('active')]
+                        and heartbeat and datetime.now() - heartbeat > timeout):
+                    print(dead_msg.format(datetime.now(), context, heartbeat),
+                          flush=True)
+                    # Only if no other process has updated the status in the meantime:
+                    session.query(Workflow).filter(
+                        Workflow.id_ == self.id_,
+                        Workflow.root_archive_status == status,
+                        Workflow.root_archive_heartbeat == heartbeat,
+                    ).update({
+                        'root_archive_status': RootArchiveStatus('failed'),
+                        'root_archive_end_time': datetime.now(),
+                    }, synchronize_session=False)
+                    session.commit()
+                    status = RootArchiveStatus('failed')
+            except OperationalError:
+                # Database is likely locked.
+                session.rollback()
+                status = None
+
+            if status == RootArchiveStatus('failed'):
+                if resolved:
+                    return
+                msg = ('Cloud archive directories could not be resolved, since the root '
+                       'archive process failed. The root archive may be retried with '
+                       '`hpcflow root-archive`.')
+                raise RuntimeError(msg)
+
+            print(block_msg.format(datetime.now()), flush=True)
+            sleep(sleep_time)
+
+    def get_root_archive_status(self, jsonable=True, datetime_dicts=False):
+        """Get the status and timing of the root archive process."""
+
+        start_time = self.root_archive_start_time
+        duration = None
+        if start_time:
+            duration = (self.root_archive_end_time or datetime.now()) - start_time
+
+        out = {
+            'status': self.root_archive_status,
+            'pid': self.root_archive_pid,
+            'directory': self.root_archive_directory,
+            'start_time': start_time,
+            'end_time': self.root_archive_end_time,
+            'duration': duration,
+        }
+
+        if datetime_dicts:
+            if duration:
+                out['duration'] = timedelta_to_dict(out['duration'])
+            if start_time:
+                out['start_time'] = datetime_to_dict(out['start_time'])
+            if self.root_archive_end_time:
+                out['end_time'] = datetime_to_dict(out['end_time'])
+
+        if jsonable:
 
-        if self.root_archive:
-            self.root_archive.execute(self.root_archive_excludes,
-                                      self.root_archive_directory)
+            if not datetime_dicts:
+
+                if duration:
+                    out['duration'] = format_time_delta(out['duration'])
+
+                dt_fmt = r'%Y.%m.%d %H:%M:%S'
+
+                if start_time:
+                    out['start_time'] = out['start_time'].strftime(dt_fmt)
+                if self.root_archive_end_time:
+                    out['end_time'] = out['end_time'].strftime(dt_fmt)
+
+            if self.root_archive_status:
+                out['status'] = self.root_archive_status.value
+
+        return out
 
     def get_stats(self, jsonable=True, datetime_dicts=False):
         """Get task statistics for this workflow."""
         out = {
             'workflow_id': self.id_,
+            'root_archive': self.get_root_archive_status(jsonable=jsonable,
+                                                         datetime_dicts=datetime_dicts),
             'submissions': [i.get_stats(jsonable=jsonable, datetime_dicts=datetime_dicts)
                             for i in self.submissions]
         }
         return out
 
     def kill_active(self):
-        """Kill any active scheduled jobs associated with the workflow."""
+        """Kill any active scheduled jobs associated with the workflow.
+
+        The states of the jobs are queried with a single scheduler call (per scheduler),
+        and only those jobs that are still queued or running are deleted, in batches
+        whose size is set by the `kill_batch_size` configuration item. If the job states
+        cannot be queried, deletion of all jobs is attempted, and jobs that the
+        scheduler reports as not existing are considered inactive. The outcome is
+        recorded on each `CommandGroupSubmissionIteration`.
+
+        Killed tasks never end, so the alternate scratch input caches of each submission
+        whose jobs were all deleted (or were already inactive) are removed here.
+
+        """
+
+        context = 'Workflow.kill_active'
+        no_state_msg = ('{} {}: Could not query the states of {} jobs; attempting to '
+                        'delete all jobs.')
+        start_time = datetime.now()
+        batch_size = CONFIG.get('kill_batch_size')
 
-        kill_scheduler_ids = []
+        # Group job IDs by scheduler:
+        sched_jobs = {}
         for sub in self.submissions:
             for cg_sub in sub.command_group_submissions:
-                for iteration in self.iterations:
-                    cg_sub_iter = cg_sub.get_command_group_submission_iteration(iteration)
-                    if cg_sub_iter:
-                        if cg_sub_iter.scheduler_job_id is not None:
-                            kill_scheduler_ids.append(cg_sub_iter.scheduler_job_id)
-                        if cg_sub_iter.scheduler_stats_job_id is not None:
-                            kill_scheduler_ids.append(cg_sub_iter.scheduler_stats_job_id)
-
-        print('Need to kill: {}'.format(kill_scheduler_ids))
-        del_cmd = ['qdel'] + [str(i) for i in kill_scheduler_ids]
-        proc = run(del_cmd, stdout=PIPE, stderr=PIPE)
-        qdel_out = proc.stdout.decode()
-        qdel_err = proc.stderr.decode()
-        print(qdel_out)
+                scheduler = cg_sub.command_group.scheduler
+                for cg_sub_iter in cg_sub.command_group_submission_iterations:
+                    job_ids = [i for i in (cg_sub_iter.scheduler_job_id,
+                                           cg_sub_iter.scheduler_stats_job_id,
+                                           cg_sub_iter.scheduler_release_job_id)
+                               if i is not None]
+                    if job_ids:
+                        sched_jobs.setdefault(scheduler._NAME, (scheduler, {}))
+                        sched_jobs[scheduler._NAME][1].update({cg_sub_iter: job_ids})
+
+        num_jobs = 0
+        num_active = 0
+        num_deleted = 0
+        for scheduler, cg_sub_iter_jobs in sched_jobs.values():
+
+            active_ids = scheduler.get_active_job_ids()
+            if active_ids is None:
+                print(no_state_msg.format(datetime.now(), context, scheduler._NAME),
+                      flush=True)
+
+            kill_ids = []
+            for job_ids in cg_sub_iter_jobs.values():
+                num_jobs += len(job_ids)
+                kill_ids += [i for i in job_ids
+                             if active_ids is None or i in active_ids]
+
+            deleted_ids = set()
+            failed_ids = set()
+            for batch_idx in range(0, len(kill_ids), batch_size):
+                batch = kill_ids[batch_idx:batch_idx + batch_size]
+                for job_id, outcome in scheduler.delete_jobs(batch).items():
+                    if outcome == 'deleted':
+                        deleted_ids.add(job_id)
+                    elif outcome == 'failed':
+                        failed_ids.add(job_id)
+
+            num_active += len(deleted_ids) + len(failed_ids)
+            num_deleted += len(deleted_ids)
+
+            kill_time = datetime.now()
+            for cg_sub_iter, job_ids in cg_sub_iter_jobs.items():
+                if any([i in failed_ids for i in job_ids]):
+                    kill_result = KillResult('failed')
+                elif any([i in deleted_ids for i in job_ids]):
+                    kill_result = KillResult('deleted')
+                else:
+                    kill_result = KillResult('inactive')
+                cg_sub_iter.kill_time = kill_time
+                cg_sub_iter.kill_result = kill_result
+
+        msg = ('{} {}: Deleted {} of {} active jobs (out of {} jobs associated with '
+               'workflow {}) in {}.')
+        print(msg.format(datetime.now(), context, num_deleted, num_active, num_jobs,
+                         self.id_, format_time_delta(datetime.now() - start_time)),
+              flush=True)
+
+        for sub in self.submissions:
+            kill_results = [j.kill_result for i in sub.command_group_submissions
+                            for j in i.command_group_submission_iterations]
+            if KillResult('failed') not in kill_results:
+                sub.evict_input_caches()
 
 
 class CommandGroup(Base):
@@ -531,6 +959,10 @@ class CommandGroup(Base):
     archive_directory = Column(String(255), nullable=True)
     _alternate_scratch = Column('alternate_scratch', String(255), nullable=True)
     stats = Column(Boolean)
+    auto_throttle = Column(Boolean)
+    partial_hold = Column(Boolean)
+    consolidate_logs = Column(Boolean)
+    alternate_scratch_cache = Column(JSON, nullable=True)
 
     archive = relationship('Archive', back_populates='command_groups')
     workflow = relationship('Workflow', back_populates='command_groups')
@@ -560,7 +992,9 @@ class CommandGroup(Base):
                  exec_order=None, nesting=None, environment=None, scheduler=None,
                  profile_name=None, profile_order=None, archive=None,
                  archive_excludes=None, archive_directory=None, alternate_scratch=None,
-                 stats=None, name=None, stats_name=None):
+                 stats=None, name=None, stats_name=None, auto_throttle=False,
+                 partial_hold=False, consolidate_logs=False,
+                 alternate_scratch_cache=None):
         """Method to initialise a new CommandGroup.
 
         Parameters
@@ -610,6 +1044,31 @@ class CommandGroup(Base):
             Name of the directory in which the archive for this command group will reside.
         alternate_scratch : str, optional
             Location of alternate scratch in which to run commands.
+        auto_throttle : bool, optional
+            If True, the maximum number of concurrently running tasks of the job array
+            (e.g. the SGE `tc` option) is set from the lock contention observed in
+            previous iterations and submissions. False by default.
+        partial_hold : bool, optional
+            If True, tasks of this command group are submitted with a user hold and are
+            released individually, once the tasks of the previous command group on which
+            they depend have completed, rather than waiting (in the case of `nesting`
+            "hold") for all tasks of the previous command group. A task depends on those
+            tasks of the previous command group that share its working directory, if
+            any, otherwise on all tasks. False by default.
+        consolidate_logs : bool, optional
+            If True, each task's log (and all other output) is appended to a single log
+            file for the job array (with an index, from which the log of a given task
+            can be read) when the task exits, and the scheduler's per-task output and
+            error files are discarded. If a task is killed without running its exit
+            trap (e.g. by SIGKILL), its log is left at the usual task log path. False by
+            default.
+        alternate_scratch_cache : list of str, optional
+            Patterns (as for an `rsync` exclusion list) of read-only input files that
+            are staged to the alternate scratch via an input cache shared by the tasks
+            of a submission, such that each distinct file is copied to the alternate
+            scratch once, and is hard linked into task working directories. The cache
+            is removed once the tasks of the submission have completed. Requires
+            `alternate_scratch`.
 
         TODO: document how `nesting` interacts with `is_job_array`.
 
@@ -627,6 +1086,10 @@ class CommandGroup(Base):
         self.stats = stats
         self.name = name
         self.stats_name = stats_name
+        self.auto_throttle = auto_throttle
+        self.partial_hold = partial_hold
+        self.consolidate_logs = consolidate_logs
+        self.alternate_scratch_cache = alternate_scratch_cache
 
         self.archive = archive
         self.archive_excludes = archive_excludes
@@ -655,6 +1118,13 @@ class CommandGroup(Base):
                 msg = 'Alternate scratch "{}" is not an existing directory.'
                 raise ValueError(msg.format(self.alternate_scratch))
 
+        if self.alternate_scratch_cache:
+            if not self.alternate_scratch:
+                msg = '`alternate_scratch_cache` requires `alternate_scratch`.'
+                raise ValueError(msg)
+            if isinstance(self.alternate_scratch_cache, str):
+                self.alternate_scratch_cache = [self.alternate_scratch_cache]
+
     @staticmethod
     def get_command_lines(commands):
         """Get all lines in the commands list."""
@@ -938,6 +1408,7 @@ class Submission(Base):
     workflow_id = Column(Integer, ForeignKey('workflow.id'))
     submit_time = Column(DateTime)
     alt_scratch_dir_name = Column(String(255), nullable=True)
+    working_dir_record_width = Column(Integer, nullable=True)
 
     workflow = relationship('Workflow', back_populates='submissions')
     command_group_submissions = relationship(
@@ -958,6 +1429,11 @@ class Submission(Base):
 
         self.resolve_variable_values(self.workflow.directory, self.first_iteration)
 
+        # The record width of the working directories files, which is written into the
+        # jobscripts, must fit the working directories resolved so far; those resolved
+        # later are validated against it:
+        self.working_dir_record_width = self.get_working_dir_record_width()
+
         cg_subs = []
         for i in self.workflow.command_groups:
             task_range = [1, -1, 1]  # TEMP
@@ -1027,6 +1503,74 @@ class Submission(Base):
 
         self.alt_scratch_dir_name = alt_dirname
 
+    def is_input_cache_in_use(self):
+        """Check if any task that stages files via an alternate scratch input cache may
+        yet run.
+
+        Tasks of pending iterations of a dynamic loop are not considered, since these
+        iterations may never run. If they do run, the input cache is repopulated.
+
+        The numbers of tasks and of ended tasks (see `set_task_end`) of each command
+        group submission iteration are retrieved with a single query, rather than by
+        loading every task.
+
+        """
+
+        cg_sub_iters = [j for i in self.command_group_submissions if i.input_cache_dir
+                        for j in i.command_group_submission_iterations]
+        if not cg_sub_iters:
+            return False
+
+        session = Session.object_session(self)
+        counts = session.query(
+            CommandGroupSubmissionIteration.id_,
+            CommandGroupSubmissionIteration.num_tasks_ended,
+            func.count(Task.id_),
+        ).join(
+            CommandGroupSubmissionIteration.tasks
+        ).filter(
+            CommandGroupSubmissionIteration.id_.in_([i.id_ for i in cg_sub_iters])
+        ).group_by(CommandGroupSubmissionIteration.id_)
+        num_ended = {id_: (ended or 0, total) for id_, ended, total in counts}
+
+        for cg_sub_iter in cg_sub_iters:
+            if cg_sub_iter.iteration.status == IterationStatus('pending'):
+                if self.workflow.dynamic_loop:
+                    continue
+                return True
+            ended, total = num_ended.get(cg_sub_iter.id_, (0, 0))
+            if ended < total:
+                return True
+
+        return False
+
+    def evict_input_caches(self):
+        """Remove the alternate scratch input caches of this submission."""
+
+        context = 'Submission.evict_input_caches'
+        msg = ('{} {}: Removed input cache "{}": {} cached files ({:.1f} MB), of which {} '
+               'are still linked by task working directories.')
+        err_msg = '{} {}: Failed to remove input cache "{}": {}'
+
+        cache_dirs = set([i.input_cache_dir for i in self.command_group_submissions
+                          if i.input_cache_dir])
+        for cache_dir in sorted(cache_dirs):
+            if not cache_dir.is_dir():
+                continue
+            try:
+                evicted = InputCache(cache_dir).evict()
+            except OSError as err:
+                # Eviction is only a clean up, so must not cause the task to fail:
+                print(err_msg.format(datetime.now(), context, cache_dir, err), flush=True)
+                continue
+            if evicted is None:
+                # Already evicted by another task:
+                continue
+            print(msg.format(datetime.now(), context, cache_dir,
+                             evicted['referenced'] + evicted['unreferenced'],
+                             evicted['bytes'] / 2**20, evicted['referenced']),
+                  flush=True)
+
     def get_working_directories(self, iteration):
         dirs = []
         for cg_sub in self.command_group_submissions:
@@ -1100,6 +1644,16 @@ class Submission(Base):
 
         return False
 
+    def get_working_dir_record_width(self):
+        """Get the width in bytes of each record of the working directories files:
+        the longest resolved working directory (plus a newline), and at least the
+        `working_dir_record_width` configuration item."""
+
+        dir_vals = [j.value for i in self.workflow.command_groups
+                    for j in i.directory_variable.variable_values]
+        return max([CONFIG.get('working_dir_record_width')] +
+                   [len(i.encode()) + 1 for i in dir_vals])
+
     def resolve_variable_values(self, root_directory, iteration):
         """Attempt to resolve as many variable values in the Workflow as
         possible."""
@@ -1150,6 +1704,8 @@ class Submission(Base):
 
                 # Add VarVals:
                 for val_idx, val in enumerate(dir_var_vals_dat_new):
+                    if self.working_dir_record_width:
+                        validate_working_directory(val, self.working_dir_record_width)
                     cg_dirs_var_vals.append(
                         VarValue(
                             value=val,
@@ -1211,6 +1767,13 @@ class Submission(Base):
                             )
                             session.commit()
 
+    def get_submit_path(self, hf_dir):
+        """Get the directory in which the jobscripts of this submission are written."""
+        return hf_dir.joinpath(
+            'workflow_{}'.format(self.workflow_id),
+            'submit_{}'.format(self.order_id),
+        )
+
     def write_submit_dirs(self, hf_dir):
         """Write the directory structure necessary for this submission."""
 
@@ -1230,75 +1793,69 @@ class Submission(Base):
             wf_path.mkdir()
 
         # Make the submit directory:
-        submit_path = wf_path.joinpath('submit_{}'.format(self.order_id))
+        submit_path = self.get_submit_path(hf_dir)
         submit_path.mkdir()
 
-        num_dir_vals_first_iter = {}  # keys are cg_sub_idx
-        for iteration in self.workflow.iterations:
+        # Directories of subsequent iterations are made when they become active:
+        self.write_iteration_dirs(hf_dir, self.first_iteration)
 
-            # Make the iteration directory for each iteration:
-            iter_path = submit_path.joinpath('iter_{}'.format(iteration.order_id))
-            iter_path.mkdir()
+    def write_iteration_dirs(self, hf_dir, iteration):
+        """Write the directory structure necessary for a given iteration of this
+        submission, if it does not already exist."""
 
-            for idx, i in enumerate(self.scheduler_groups):
+        # Make the iteration directory (the jobscript may already have made it):
+        iter_path = self.get_submit_path(hf_dir).joinpath(
+            'iter_{}'.format(iteration.order_id))
+        iter_path.mkdir(parents=True, exist_ok=True)
 
-                max_num_tasks = i.get_max_num_tasks(self.first_iteration)
-                step_size = i.get_step_size(self.first_iteration)
+        # Make the scheduler group directory for each scheduler group:
+        for idx in range(len(self.scheduler_groups)):
+            iter_path.joinpath('scheduler_group_{}'.format(idx)).mkdir(exist_ok=True)
 
-                # Make the scheduler group directory for each scheduler group:
-                sg_path = iter_path.joinpath('scheduler_group_{}'.format(idx))
-                sg_path.mkdir()
-
-                # Loop through cmd groups in this scheduler group:
-                for cg_sub_idx, cg_sub in enumerate(i.command_group_submissions):
-
-                    cg_sub_iter = cg_sub.get_command_group_submission_iteration(iteration)
-                    if not cg_sub_iter:
-                        continue
-
-                    cg_sub_first_iter = cg_sub.get_command_group_submission_iteration(
-                        self.first_iteration
-                    )
-                    num_dir_vals = cg_sub_first_iter.num_directories
-                    all_dir_slots = [''] * max_num_tasks
-
-                    # Distribute dirs over num_dir_slots:
-                    for k in range(0, max_num_tasks, step_size[cg_sub_idx]):
-                        dir_idx = round((k / max_num_tasks) * num_dir_vals)
-                        all_dir_slots[k] = 'REPLACE_WITH_DIR_{}'.format(dir_idx)
-
-                    wk_dirs_path = iter_path.joinpath('working_dirs_{}{}'.format(
-                        cg_sub.command_group_exec_order, CONFIG.get('working_dirs_file_ext')))
-
-                    # Make the working directory template files for each cmd group:
-                    with wk_dirs_path.open('w') as handle:
-                        for dir_path in all_dir_slots:
-                            handle.write('{}\n'.format(dir_path))
-
-                # Make the variable values directories for each scheduler group:
-                var_values_path = sg_path.joinpath('var_values')
-                var_values_path.mkdir()
-                for j in range(1, max_num_tasks + 1):
-                    j_fmt = zeropad(j, max_num_tasks)
-                    vv_j_path = var_values_path.joinpath(j_fmt)
-                    vv_j_path.mkdir()
+        # Working directories files and variable values files are created when they
+        # are first written (see `CommandGroupSubmission.write_working_directory` and
+        # `CommandGroupSubmission.write_variable_files`).
 
     def write_jobscripts(self, hf_dir):
 
-        wf_path = hf_dir.joinpath('workflow_{}'.format(self.workflow_id))
-        submit_path = wf_path.joinpath('submit_{}'.format(self.order_id))
+        submit_path = self.get_submit_path(hf_dir)
         js_paths = []
         js_stats_paths = []
+        js_release_paths = []
         for cg_sub in self.command_group_submissions:
             js_paths_i = cg_sub.write_jobscript(dir_path=submit_path)
             js_paths.append(js_paths_i['jobscript'])
             js_stats_paths.append(js_paths_i['stats_jobscript'])
+            js_release_paths.append(js_paths_i['release_jobscript'])
+
+        return js_paths, js_stats_paths, js_release_paths
+
+    def get_jobscript_paths(self, hf_dir):
+        """Get the paths of the (previously written) jobscripts of this submission, in
+        the same format as returned by `write_jobscripts`."""
+
+        submit_path = self.get_submit_path(hf_dir)
+        js_paths = []
+        js_stats_paths = []
+        js_release_paths = []
+        for cg_sub in self.command_group_submissions:
+            scheduler = cg_sub.command_group.scheduler
+            exec_order = cg_sub.command_group_exec_order
+            js_paths.append(scheduler.get_jobscript_path(submit_path, exec_order))
+            js_stats_paths.append(
+                scheduler.get_stats_jobscript_path(submit_path, exec_order)
+                if cg_sub.command_group.stats else None
+            )
+            js_release_paths.append(
+                scheduler.get_release_jobscript_path(submit_path, exec_order)
+                if cg_sub.is_release_required() else None
+            )
 
-        return js_paths, js_stats_paths
+        return js_paths, js_stats_paths, js_release_paths
 
     def submit_jobscripts(self, jobscript_paths):
 
-        loop_groups = self.workflow.loop['groups']
+        loop_groups = self.workflow.loop_groups
         cmd_group_idx = range(len(self.workflow.command_groups))
 
         if loop_groups:
@@ -1311,18 +1868,39 @@ class Submission(Base):
             js_submissions = [(i, 0) for i in pre_loop_idx]
 
             for iteration in self.workflow.iterations:
+                if self.workflow.dynamic_loop and iteration.order_id > 0:
+                    # Submitted if and when the loop has not converged:
+                    break
                 for i in loop_groups:
                     js_submissions.append((i, iteration.order_id))
 
-            for i in post_loop_idx:
-                js_submissions.append((i, 0))
+            if not self.workflow.dynamic_loop:
+                for i in post_loop_idx:
+                    js_submissions.append((i, 0))
 
         else:
             js_submissions = [(i, 0) for i in cmd_group_idx]
 
+        self._submit_jobscripts(js_submissions, jobscript_paths)
+
+    def _submit_jobscripts(self, js_submissions, jobscript_paths, last_submit_id=None):
+        """Submit jobscripts in order, each holding on the previously submitted job.
+
+        Parameters
+        ----------
+        js_submissions : list of tuple of (int, int)
+            Each tuple maps a jobscript path index (i.e. command group order id) to an
+            iteration index.
+        jobscript_paths : tuple of (list of Path, list of Path, list of Path)
+            Jobscript, stats jobscript and release jobscript paths, as returned by
+            `write_jobscripts`.
+        last_submit_id : str, optional
+            Scheduler job ID on which the first submitted jobscript should hold.
+
+        """
+
         sumbit_cmd = os.getenv('HPCFLOW_QSUB_CMD', 'qsub')
-        last_submit_id = None
-        js_paths, js_stat_paths = jobscript_paths
+        js_paths, js_stat_paths, js_release_paths = jobscript_paths
 
         for cg_sub_idx, iter_idx in js_submissions:
 
@@ -1334,7 +1912,11 @@ class Submission(Base):
 
             qsub_cmd = [sumbit_cmd]
 
-            if last_submit_id:
+            if cg_sub.is_partial_hold:
+                # Tasks are released individually as their upstream tasks complete:
+                qsub_cmd += ['-h']
+
+            elif last_submit_id:
 
                 # Add conditional submission:
                 if iteration.order_id > 0:
@@ -1354,6 +1936,27 @@ class Submission(Base):
             cg_sub_iter.scheduler_job_id = int(job_id_str)
             last_submit_id = job_id_str
 
+            if cg_sub.is_partial_hold:
+                # Upstream tasks that finalised before the job ID was committed could not
+                # release their dependent tasks, so release them now:
+                upstream = cg_sub.upstream_command_group_submission
+                session = Session.object_session(self)
+                session.commit()
+                upstream.release_dependent_tasks(iter_idx)
+                session.commit()
+
+                # Once all upstream tasks have finished, whether or not they completed
+                # (e.g. if killed by the scheduler), release or delete any tasks that
+                # are still held:
+                up_cg_sub_iter = upstream.get_command_group_submission_iteration(
+                    iteration)
+                js_release_path_i = js_release_paths[
+                    self.command_group_submissions.index(upstream)]
+                rl_cmd = [sumbit_cmd, '-hold_jid', str(up_cg_sub_iter.scheduler_job_id),
+                          '-v', iter_idx_var, str(js_release_path_i)]
+                job_id_str = self.submit_jobscript(rl_cmd, js_release_path_i, iteration)
+                up_cg_sub_iter.scheduler_release_job_id = int(job_id_str)
+
             # Submit the stats jobscript:
             if js_stat_path_i:
                 st_cmd = [sumbit_cmd, '-hold_jid_ad', last_submit_id, '-v', iter_idx_var]
@@ -1363,6 +1966,55 @@ class Submission(Base):
                 cg_sub_iter.scheduler_stats_job_id = int(job_id_str)
                 last_submit_id = job_id_str
 
+    def continue_loop(self, hf_dir, iteration):
+        """For a dynamic loop, evaluate the loop convergence command once a given
+        iteration is complete, and then submit either the next iteration or the
+        command groups that follow the loop.
+
+        Parameters
+        ----------
+        hf_dir : Path
+        iteration : Iteration
+            The iteration that has just completed.
+
+        """
+
+        context = 'Submission.continue_loop'
+        converged_msg = '{} {}: Loop converged after iteration {}.'
+        max_iter_msg = '{} {}: Maximum number of loop iterations reached.'
+        next_iter_msg = '{} {}: Loop not converged; submitting iteration {}.'
+
+        loop_groups = self.workflow.loop_groups
+        cmd_group_idx = range(len(self.workflow.command_groups))
+        jobscript_paths = self.get_jobscript_paths(hf_dir)
+
+        # Hold on the final job of the completed iteration:
+        last_cg_sub = self.command_group_submissions[max(loop_groups)]
+        last_cg_sub_iter = last_cg_sub.get_command_group_submission_iteration(iteration)
+        last_submit_id = str(last_cg_sub_iter.scheduler_stats_job_id or
+                             last_cg_sub_iter.scheduler_job_id)
+
+        next_iteration = None
+        if self.workflow.is_loop_converged(iteration):
+            print(converged_msg.format(datetime.now(), context, iteration.order_id),
+                  flush=True)
+        elif iteration.order_id + 1 < len(self.workflow.iterations):
+            next_iteration = self.workflow.iterations[iteration.order_id + 1]
+        else:
+            print(max_iter_msg.format(datetime.now(), context), flush=True)
+
+        if next_iteration:
+            print(next_iter_msg.format(datetime.now(), context, next_iteration.order_id),
+                  flush=True)
+            self.write_iteration_dirs(hf_dir, next_iteration)
+            next_iteration.status = IterationStatus('active')
+            js_submissions = [(i, next_iteration.order_id) for i in loop_groups]
+
+        else:
+            js_submissions = [(i, 0) for i in cmd_group_idx if i > max(loop_groups)]
+
+        self._submit_jobscripts(js_submissions, jobscript_paths, last_submit_id)
+
     def submit_jobscript(self, cmd, js_path, iteration):
 
         cwd = str(self.workflow.directory)
@@ -1516,6 +2168,54 @@ class CommandGroupSubmission(Base):
         """Get the scheduler group to which this command group belongs."""
         return self.submission.get_scheduler_group(self)
 
+    @property
+    def upstream_command_group_submission(self):
+        """Get the command group submission on whose tasks the tasks of this command
+        group submission depend within the same iteration.
+
+        Returns
+        -------
+        CommandGroupSubmission or None
+            The command group submission with the previous execution order, or `None`
+            if this is the first command group submission, or if the previous command
+            group submission is on the other side of a loop boundary (in which case
+            tasks depend on a different iteration).
+
+        """
+
+        cg_subs = self.submission.command_group_submissions
+        idx = cg_subs.index(self)
+        if idx == 0:
+            return None
+
+        upstream = cg_subs[idx - 1]
+        loop_groups = self.submission.workflow.loop_groups
+        if loop_groups:
+            if ((upstream.command_group_exec_order in loop_groups) !=
+                    (self.command_group_exec_order in loop_groups)):
+                return None
+
+        return upstream
+
+    @property
+    def downstream_command_group_submission(self):
+        """Get the command group submission whose tasks depend on the tasks of this
+        command group submission within the same iteration, if any."""
+
+        cg_subs = self.submission.command_group_submissions
+        idx = cg_subs.index(self)
+        if idx < len(cg_subs) - 1:
+            downstream = cg_subs[idx + 1]
+            if downstream.upstream_command_group_submission is self:
+                return downstream
+
+    @property
+    def is_partial_hold(self):
+        """Check if tasks of this command group submission are held individually and
+        released by the tasks of the upstream command group submission."""
+        return bool(self.command_group.partial_hold and
+                    self.upstream_command_group_submission)
+
     def get_command_group_submission_iteration(self, iteration):
 
         for i in self.command_group_submission_iterations:
@@ -1530,6 +2230,16 @@ class CommandGroupSubmission(Base):
         else:
             return None
 
+    @property
+    def input_cache_dir(self):
+        """Get the root directory of the alternate scratch input cache shared by the
+        tasks of this submission, if used by this command group."""
+        if self.command_group.alternate_scratch_cache:
+            return self.command_group.alternate_scratch.joinpath(
+                '{}_input_cache'.format(self.submission.alt_scratch_dir_name))
+        else:
+            return None
+
     def get_var_definition_by_name(self, var_name):
         """"""
 
@@ -1555,6 +2265,13 @@ class CommandGroupSubmission(Base):
             alternate_scratch_dir=self.alternate_scratch_dir,
             command_group_submission_id=self.id_,
             name=self.command_group.name,
+            max_running_tasks=self.get_previous_max_running_tasks(),
+            loop_check=self.is_loop_check_required(),
+            consolidate_logs=bool(self.command_group.consolidate_logs),
+            input_cache_dir=self.input_cache_dir,
+            input_cache_patterns=self.command_group.alternate_scratch_cache,
+            release_dependents=self.is_release_required(),
+            wk_dirs_record_width=self.submission.working_dir_record_width,
         )
 
         js_stats_path = None
@@ -1570,9 +2287,20 @@ class CommandGroupSubmission(Base):
                 name=self.command_group.stats_name,
             )
 
+        js_release_path = None
+        if self.is_release_required():
+            js_release_path = self.command_group.scheduler.write_release_jobscript(
+                dir_path=dir_path,
+                workflow_directory=self.submission.workflow.directory,
+                command_group_order=self.command_group_exec_order,
+                command_group_submission_id=self.id_,
+                name=self.command_group.name,
+            )
+
         out = {
             'jobscript': js_path,
             'stats_jobscript': js_stats_path,
+            'release_jobscript': js_release_path,
         }
 
         return out
@@ -1580,6 +2308,7 @@ class CommandGroupSubmission(Base):
     def write_runtime_files(self, project, task_idx, iter_idx):
         iteration = self.get_iteration(iter_idx)
         self.queue_write_command_file(project, task_idx, iteration)
+        self.write_working_directory(project, task_idx, iteration)
         self.write_variable_files(project, task_idx, iteration)
 
     def queue_write_command_file(self, project, task_idx, iteration):
@@ -1597,13 +2326,12 @@ class CommandGroupSubmission(Base):
                        'command file.'.format(context))
         written_msg = '{{}} {}: Command files already written.'.format(context)
         refresh_vals_msg = '{{}} {}: Refreshing resolved variable values.'.format(context)
-        write_dirs_msg = ('{{}} {}: Writing working directory files for '
-                          'iteration {}').format(context, iteration)
         write_as_msg = ('{{}} {}: Writing alternate scratch exclusion list for '
                         'task_idx {}.').format(context, task_idx)
         make_alt_msg = ('{{}} {}: Making alternate scratch working '
                         'directories.'.format(context))
 
+        wait_start = datetime.now()
         blocked = True
         while blocked:
 
@@ -1639,7 +2367,11 @@ class CommandGroupSubmission(Base):
 
                 if not blocked:
 
+                    lock_time = datetime.now()
+
                     if iteration.status == IterationStatus('pending'):
+                        # This is the first task of this iteration to run:
+                        self.submission.write_iteration_dirs(project.hf_dir, iteration)
                         iteration.status = IterationStatus('active')
 
                     # This needs to happen once *per task* per CGS:
@@ -1657,9 +2389,6 @@ class CommandGroupSubmission(Base):
 
                         # These need to happen once *per iteration* per CGS:
 
-                        print(write_dirs_msg.format(datetime.now()), flush=True)
-                        cg_sub_iter.write_working_directories(project)
-
                         if self.command_group.alternate_scratch:
                             print(make_alt_msg.format(datetime.now()), flush=True)
                             self.make_alternate_scratch_dirs(project, iteration)
@@ -1674,10 +2403,55 @@ class CommandGroupSubmission(Base):
                     else:
                         print(written_msg.format(datetime.now()), flush=True)
 
+                    task = self.get_task(task_idx, iteration)
+                    task.launch_time = wait_start
+                    task.runtime_files_wait = (lock_time - wait_start).total_seconds()
+                    task.runtime_files_duration = (
+                        datetime.now() - lock_time).total_seconds()
+
                     self.is_command_writing = None
                     session.commit()
 
+    def write_working_directory(self, project, task_idx, iteration):
+        """Write the working directory of a given task to the working directories file.
+
+        Each task's working directory (relative to the workflow directory) is written
+        in place to a fixed-width record, whose position is determined by the task's
+        scheduler ID, such that the jobscript can read it with a single seek.
+
+        """
+
+        task = self.get_task(task_idx, iteration)
+        wk_dirs_path = project.hf_dir.joinpath(
+            'workflow_{}'.format(self.submission.workflow.id_),
+            'submit_{}'.format(self.submission.order_id),
+            'iter_{}'.format(iteration.order_id),
+            'working_dirs_{}{}'.format(
+                self.command_group_exec_order, CONFIG.get('working_dirs_file_ext')),
+        )
+        write_record(wk_dirs_path, task.scheduler_id - 1,
+                     task.get_working_directory_value(),
+                     self.submission.working_dir_record_width)
+
+    def get_var_values_file_names(self):
+        """Get the names of the data and index files of packed variable values for this
+        command group submission, which are within the scheduler group directory of
+        each iteration."""
+        base = 'var_values_{}'.format(self.command_group_exec_order)
+        return base + '.dat', base + '.idx'
+
     def write_variable_files(self, project, task_idx, iteration):
+        """Write the variable values of a given task to the packed variable values
+        files.
+
+        The values of all tasks (for this command group submission and iteration) are
+        appended to a single data file. The offset and length of the values of each
+        variable are written to a fixed-width record in an index file, whose position
+        is determined by the task's scheduler ID and the position of the variable in
+        the command group's variable definitions. The command file reads the values by
+        seeking to this record (see `write_command_file`).
+
+        """
 
         task = self.get_task(task_idx, iteration)
         var_vals_normed = task.get_variable_values_normed()
@@ -1686,24 +2460,23 @@ class CommandGroupSubmission(Base):
         print('CGS.write_variable_files: var_vals_normed: {}'.format(
             var_vals_normed), flush=True)
 
-        max_num_tasks = self.scheduler_group.get_max_num_tasks(
-            self.submission.first_iteration)
-
-        var_values_task_dir = project.hf_dir.joinpath(
+        sg_path = project.hf_dir.joinpath(
             'workflow_{}'.format(self.submission.workflow.id_),
             'submit_{}'.format(self.submission.order_id),
             'iter_{}'.format(iteration.order_id),
             'scheduler_group_{}'.format(self.scheduler_group_index[0]),
-            'var_values',
-            zeropad(task.scheduler_id, max_num_tasks),
         )
+        data_fn, index_fn = self.get_var_values_file_names()
 
+        var_names = [i.name for i in self.command_group.variable_definitions]
         for var_name, var_val_all in var_vals_normed.items():
-            var_fn = 'var_{}{}'.format(var_name, CONFIG.get('variable_file_ext'))
-            var_file_path = var_values_task_dir.joinpath(var_fn)
-            with var_file_path.open('w') as handle:
-                for i in var_val_all:
-                    handle.write('{}\n'.format(i))
+            if var_name not in var_names:
+                continue
+            record_idx = ((task.scheduler_id - 1) * len(var_names) +
+                          var_names.index(var_name))
+            data = ''.join(['{}\n'.format(i) for i in var_val_all]).encode()
+            append_indexed(sg_path.joinpath(data_fn), sg_path.joinpath(index_fn),
+                           record_idx, data)
 
     @staticmethod
     def get_formatted_commands(commands, num_cores, parallel_modes, indent=''):
@@ -1753,33 +2526,39 @@ class CommandGroupSubmission(Base):
         about_msg = ['# --- commands file generated by `hpcflow` (version: {}) '
                      'on {} ---'.format(__version__, dt_stamp)]
 
-        max_num_tasks = self.scheduler_group.get_max_num_tasks(
-            self.submission.first_iteration)
-
-        lns_task_id_pad = [
-            'MAX_NUM_TASKS={}'.format(max_num_tasks),
-            'MAX_NUM_DIGITS="${#MAX_NUM_TASKS}"',
-            'ZEROPAD_TASK_ID=$(printf "%0${MAX_NUM_DIGITS}d" $SGE_TASK_ID)',
+        var_names = [i.name for i in self.command_group.variable_definitions]
+        sg_dir = '$ITER_DIR/scheduler_group_{}'.format(self.scheduler_group_index[0])
+        data_fn, index_fn = self.get_var_values_file_names()
+
+        # Each variable's values are read from the packed variable values files by
+        # seeking to the index record for this task and variable:
+        lns_read_func = [
+            'VAR_VALUES_DATA={}/{}'.format(sg_dir, data_fn),
+            'VAR_VALUES_INDEX={}/{}'.format(sg_dir, index_fn),
+            'read_var_values() {',
+            '\tlocal RECORD_IDX=$(( ($SGE_TASK_ID - 1) * {} + $1 ))'.format(
+                len(var_names)),
+            '\tlocal OFFSET LENGTH',
+            ('\tread OFFSET LENGTH < <(dd if="$VAR_VALUES_INDEX" bs={} skip=$RECORD_IDX '
+             'count=1 2>/dev/null)').format(INDEX_RECORD_WIDTH),
+            '\t[ -n "$LENGTH" ] || return',
+            '\ttail -c +$(( OFFSET + 1 )) "$VAR_VALUES_DATA" | head -c $LENGTH',
+            '}',
         ]
 
         lns_read = []
         lns_fds = []
 
-        for idx, i in enumerate(self.command_group.variable_definitions):
+        for idx, var_name in enumerate(var_names):
 
             fd_idx = idx + 3
 
-            var_fn = 'var_{}{}'.format(i.name, CONFIG.get('variable_file_ext'))
-            var_file_path = ('$ITER_DIR/scheduler_group_{}/var_values'
-                             '/$ZEROPAD_TASK_ID/{}').format(
-                                 self.scheduler_group_index[0], var_fn)
-
-            lns_read.append('\tread -u{} {} || break'.format(fd_idx, i.name))
+            lns_read.append('\tread -u{} {} || break'.format(fd_idx, var_name))
 
             if idx > 0:
                 lns_fds[-1] += ' \\'
 
-            lns_fds.append('\t{}< {}'.format(fd_idx, var_file_path))
+            lns_fds.append('\t{}< <(read_var_values {})'.format(fd_idx, idx))
 
         lns_cmd_print = ['printf "Running command: \\"{}\\"\\n" >> $LOG_PATH 2>&1'.format(
             i.strip('\t').replace('"', r'\\\\\"')) for i in lns_cmd]
@@ -1787,7 +2566,7 @@ class CommandGroupSubmission(Base):
         if self.command_group.variable_definitions:
             lns_cmd_print = ['\t{}'.format(i) for i in lns_cmd_print]
             cmd_lns = (about_msg + [''] +
-                       lns_task_id_pad + [''] +
+                       lns_read_func + [''] +
                        lns_while_start + [''] +
                        lns_read + [''] +
                        lns_cmd_print + [''] +
@@ -1810,7 +2589,7 @@ class CommandGroupSubmission(Base):
             handle.write(cmd_lns)
 
     def write_alt_scratch_exclusion_list(self, project, task, iteration):
-        """Write alternate scratch exclusion files (for e.g. rsync)"""
+        """Write alternate scratch exclusion files (for `hpcflow stage-in`)"""
 
         # List of Paths to exclude, relative to `self.submission.workflow.directory`:
         excluded_paths = [
@@ -1883,7 +2662,28 @@ class CommandGroupSubmission(Base):
             if i.order_id == task_idx and i.iteration == iteration:
                 return i
 
-    def set_task_start(self, task_idx, iter_idx):
+    def get_task_log(self, hf_dir, task_idx, iteration):
+        """Get the log of a task, from the consolidated log of its job array if it has
+        been appended there, or otherwise from the task's own log file. Returns `None`
+        if the task has not yet written a log."""
+
+        iter_path = self.submission.get_submit_path(hf_dir).joinpath(
+            'iter_{}'.format(iteration.order_id))
+
+        task_log = read_task_log(iter_path, self.command_group_exec_order, task_idx)
+        if task_log is None:
+            task = self.get_task(task_idx, iteration)
+            if task is None:
+                msg = 'No task with index {} exists in iteration {}.'
+                raise ValueError(msg.format(task_idx, iteration.order_id))
+            log_path = iter_path.joinpath('log_{}.{}'.format(
+                self.command_group_exec_order, task.scheduler_id))
+            if log_path.is_file():
+                task_log = log_path.read_text(errors='replace')
+
+        return task_log
+
+    def set_task_start(self, task_idx, iter_idx, start_wait=None):
         context = 'CommandGroupSubmission.set_task_start'
         msg = '{{}} {}: Task index {} started.'.format(context, task_idx)
         start_time = datetime.now()
@@ -1891,26 +2691,251 @@ class CommandGroupSubmission(Base):
         iteration = self.get_iteration(iter_idx)
         task = self.get_task(task_idx, iteration)
         task.start_time = start_time
+        task.start_wait = start_wait
         print('task: {}'.format(task))
 
     def set_task_end(self, task_idx, iter_idx):
+        """Set the end time of a task, returning True if it is the last task of its
+        iteration to end.
+
+        The number of ended tasks of each iteration is incremented in the database (not
+        from the value loaded in this session), so exactly one task is the last to end,
+        even if several tasks end concurrently.
+
+        """
         context = 'CommandGroupSubmission.set_task_end'
         msg = '{{}} {}: Task index {} ended.'.format(context, task_idx)
         end_time = datetime.now()
         print(msg.format(end_time), flush=True)
         iteration = self.get_iteration(iter_idx)
         task = self.get_task(task_idx, iteration)
+        cg_sub_iter = task.command_group_submission_iteration
+        session = Session.object_session(self)
+        if task.end_time is None:
+            session.query(CommandGroupSubmissionIteration).filter(
+                CommandGroupSubmissionIteration.id_ == cg_sub_iter.id_
+            ).update({
+                'num_tasks_ended': CommandGroupSubmissionIteration.num_tasks_ended + 1,
+            }, synchronize_session=False)
         task.end_time = end_time
         print('task: {}'.format(task))
 
+        session.refresh(cg_sub_iter, ['num_tasks_ended'])
+        num_tasks = session.query(Task).filter(
+            Task.command_group_submission_iteration_id == cg_sub_iter.id_).count()
+        return cg_sub_iter.num_tasks_ended == num_tasks
+
+    def throttle_next_iteration(self, iter_idx):
+        """Set the maximum number of concurrently running tasks of the next iteration's
+        (already submitted) job array from the lock contention observed in a given
+        iteration. This should be called once, by the last task of the iteration to end
+        (see `set_task_end`)."""
+
+        context = 'CommandGroupSubmission.throttle_next_iteration'
+        msg = '{} {}: Setting maximum running tasks of {} to {}.'
+        fail_msg = '{} {}: Failed to set maximum running tasks of {}.'
+
+        iteration = self.get_iteration(iter_idx)
+        next_iteration = self.get_iteration(iter_idx + 1)
+        if not next_iteration:
+            return
+
+        cg_sub_iter = self.get_command_group_submission_iteration(iteration)
+        next_cg_sub_iter = self.get_command_group_submission_iteration(next_iteration)
+        if not next_cg_sub_iter or next_cg_sub_iter.scheduler_job_id is None:
+            return
+
+        max_running = cg_sub_iter.recommend_max_running_tasks()
+        if max_running and max_running != next_cg_sub_iter.max_running_tasks:
+            print(msg.format(datetime.now(), context, next_cg_sub_iter, max_running),
+                  flush=True)
+            if self.command_group.scheduler.set_max_running_tasks(
+                    next_cg_sub_iter.scheduler_job_id, max_running):
+                next_cg_sub_iter.max_running_tasks = max_running
+            else:
+                print(fail_msg.format(datetime.now(), context, next_cg_sub_iter),
+                      flush=True)
+
+    def set_task_outputs_finalised(self, task_idx, iter_idx):
+        """Mark the outputs of a task as finalised (i.e. staged out from alternate
+        scratch and archived), so its dependent tasks may be released."""
+        iteration = self.get_iteration(iter_idx)
+        task = self.get_task(task_idx, iteration)
+        task.outputs_finalised = True
+
+    def release_dependent_tasks(self, iter_idx, delete_orphans=False):
+        """Release those held tasks of the downstream (partial hold) command group
+        submission whose upstream tasks have all finalised their outputs.
+
+        Tasks are released in batches whose size is set by the `kill_batch_size`
+        configuration item.
+
+        Parameters
+        ----------
+        iter_idx : int
+        delete_orphans : bool, optional
+            If True, held tasks with any upstream task that has not finalised its outputs
+            are deleted. This should only be set once all tasks of this command group
+            submission iteration have finished (whether or not they completed), since
+            such held tasks would otherwise never be released.
+
+        """
+
+        context = 'CommandGroupSubmission.release_dependent_tasks'
+        msg = '{} {}: Releasing tasks {} of {}.'
+        fail_msg = '{} {}: Failed to release tasks {} of {}; will retry on next release.'
+        orphan_msg = ('{} {}: Deleting held tasks {} of {}, since their upstream tasks '
+                      'did not finalise their outputs.')
+        orphan_fail_msg = '{} {}: Failed to delete held tasks {} of {}.'
+
+        downstream = self.downstream_command_group_submission
+        if not downstream or not downstream.is_partial_hold:
+            return
+
+        iteration = self.get_iteration(iter_idx)
+        cg_sub_iter = downstream.get_command_group_submission_iteration(iteration)
+        if not cg_sub_iter or cg_sub_iter.scheduler_job_id is None:
+            return
+
+        release = []
+        orphans = []
+        for task, upstream_tasks in cg_sub_iter.get_dependency_map().items():
+            if task.dependency_released:
+                continue
+            if all([i.outputs_finalised for i in upstream_tasks]):
+                release.append(task)
+            elif delete_orphans:
+                orphans.append(task)
+
+        scheduler = downstream.command_group.scheduler
+        batch_size = CONFIG.get('kill_batch_size')
+        for batch_idx in range(0, len(release), batch_size):
+            batch = release[batch_idx:batch_idx + batch_size]
+            scheduler_ids = [i.scheduler_id for i in batch]
+            print(msg.format(datetime.now(), context, scheduler_ids, cg_sub_iter),
+                  flush=True)
+            if scheduler.release_tasks(cg_sub_iter.scheduler_job_id, scheduler_ids):
+                for i in batch:
+                    i.dependency_released = True
+            else:
+                print(fail_msg.format(datetime.now(), context, scheduler_ids,
+                                      cg_sub_iter), flush=True)
+
+        for batch_idx in range(0, len(orphans), batch_size):
+            scheduler_ids = [i.scheduler_id
+                             for i in orphans[batch_idx:batch_idx + batch_size]]
+            print(orphan_msg.format(datetime.now(), context, scheduler_ids, cg_sub_iter),
+                  flush=True)
+            if not scheduler.delete_tasks(cg_sub_iter.scheduler_job_id, scheduler_ids):
+                print(orphan_fail_msg.format(datetime.now(), context, scheduler_ids,
+                                             cg_sub_iter), flush=True)
+
+    def is_release_required(self):
+        """Check if tasks of this command group submission must release the held tasks
+        of a downstream (partial hold) command group submission."""
+        downstream = self.downstream_command_group_submission
+        return bool(downstream and downstream.is_partial_hold)
+
+    def is_loop_check_required(self):
+        """Check if tasks of this command group submission must check for completion
+        of a dynamic loop iteration (i.e. if this is the final command group in the
+        loop)."""
+        workflow = self.submission.workflow
+        if not workflow.dynamic_loop:
+            return False
+        return self.command_group_exec_order == max(workflow.loop_groups)
+
+    def check_loop(self, project, task_idx, iter_idx):
+        """If all tasks of a given iteration have completed, continue the (dynamic) loop
+        and mark the iteration as complete.
+
+        Only one task may continue the loop, so the iteration status is changed from
+        active to continuing in a single database update, and only the task whose update
+        succeeds continues. The iteration is marked as complete in the same transaction
+        as the resulting submission of jobscripts; if the loop cannot be continued, the
+        iteration status is reverted to active, so the loop check may be retried.
+
+        """
+
+        session = Session.object_session(self)
+
+        context = 'CommandGroupSubmission.check_loop'
+        not_done_msg = '{} {}: Iteration {} is not yet complete.'
+        done_msg = '{} {}: Iteration {} already completed by another task.'
+        fail_msg = ('{} {}: Failed to continue the loop after iteration {}; reverting '
+                    'iteration status to active.')
+
+        iteration = self.get_iteration(iter_idx)
+        cg_sub_iter = self.get_command_group_submission_iteration(iteration)
+
+        if not all([i.end_time for i in cg_sub_iter.tasks]):
+            print(not_done_msg.format(datetime.now(), context, iter_idx), flush=True)
+            return
+
+        num_updated = session.query(Iteration).filter(
+            Iteration.id_ == iteration.id_,
+            Iteration.status == IterationStatus('active'),
+        ).update({'status': IterationStatus('continuing')}, synchronize_session='fetch')
+        session.commit()
+
+        if not num_updated:
+            print(done_msg.format(datetime.now(), context, iter_idx), flush=True)
+            return
+
+        try:
+            self.submission.continue_loop(project.hf_dir, iteration)
+            iteration.status = IterationStatus('complete')
+            session.commit()
+        except Exception:
+            print(fail_msg.format(datetime.now(), context, iter_idx), flush=True)
+            blocked = True
+            while blocked:
+                try:
+                    session.rollback()
+                    session.query(Iteration).filter(
+                        Iteration.id_ == iteration.id_,
+                        Iteration.status == IterationStatus('continuing'),
+                    ).update({'status': IterationStatus('active')},
+                             synchronize_session='fetch')
+                    session.commit()
+                    blocked = False
+                except OperationalError:
+                    # Database is likely locked.
+                    sleep(5)
+            raise
+
+    def get_previous_max_running_tasks(self):
+        """Get the recommended maximum number of concurrently running tasks for this
+        command group submission, given the contention observed in the most recent
+        previous submission of the same command group.
+
+        Returns
+        -------
+        int or None
+            `None` is returned if `auto_throttle` is not set for the command group, or
+            if there is not sufficient information to make a recommendation.
+
+        """
+
+        if not self.command_group.auto_throttle:
+            return None
+
+        prev_cg_subs = [i for i in self.command_group.command_group_submissions
+                        if i.submission.order_id < self.submission.order_id]
+        for cg_sub in sorted(prev_cg_subs, key=lambda x: x.submission.order_id,
+                             reverse=True):
+            cg_sub_iters = sorted(cg_sub.command_group_submission_iterations,
+                                  key=lambda x: x.iteration.order_id, reverse=True)
+            for cg_sub_iter in cg_sub_iters:
+                max_running = cg_sub_iter.recommend_max_running_tasks()
+                if max_running:
+                    return max_running
+
     def do_archive(self, task_idx, iter_idx):
         """Archive the working directory associated with a given task in this command
         group submission."""
 
-        # Adding a small delay increases the chance that `Task.is_archive_required` will
-        # be False (and so save some time overall), in the case where all tasks start at
-        # roughly the same time:
-        sleep(10)
+        self.command_group.workflow.wait_for_root_archive(self.command_group.archive)
 
         iteration = self.get_iteration(iter_idx)
         task = self.get_task(task_idx, iteration)
@@ -2029,9 +3054,17 @@ class Task(Base):
     hostname = Column(String(255))
     wallclock = Column(Integer)
     archive_status = Column(Enum(TaskArchiveStatus), nullable=True)
+    archive_queue_time = Column(DateTime, nullable=True)
     _archive_start_time = Column('archive_start_time', DateTime, nullable=True)
     _archive_end_time = Column('archive_end_time', DateTime, nullable=True)
     archived_task_id = Column(Integer, ForeignKey('task.id'), nullable=True)
+    launch_time = Column(DateTime, nullable=True)
+    runtime_files_wait = Column(Float, nullable=True)
+    runtime_files_duration = Column(Float, nullable=True)
+    start_wait = Column(Float, nullable=True)
+    archive_wait = Column(Float, nullable=True)
+    dependency_released = Column(Boolean, default=False)
+    outputs_finalised = Column(Boolean, default=False)
 
     command_group_submission_iteration_id = Column(
         Integer, ForeignKey('command_group_submission_iteration.id'))
@@ -2040,6 +3073,8 @@ class Task(Base):
         'CommandGroupSubmissionIteration', back_populates='tasks', uselist=False)
 
     archived_task = relationship('Task', uselist=False, remote_side=id_)
+    archive_runs = relationship('ArchiveRun', back_populates='task',
+                                order_by='ArchiveRun.id_')
 
     def __init__(self, command_group_submission_iteration, order_id):
         self.order_id = order_id
@@ -2118,6 +3153,17 @@ class Task(Base):
         else:
             return None
 
+    @property
+    def lock_wait(self):
+        """Get the total time in seconds this task spent waiting for locks, or `None`
+        if no waits have been recorded."""
+        waits = [self.runtime_files_wait, self.start_wait, self.archive_wait]
+        waits = [i for i in waits if i is not None]
+        if waits:
+            return sum(waits)
+        else:
+            return None
+
     def get_working_directory(self):
         """Get the "working directory" of this task."""
         dir_vals = self.command_group_submission_iteration.get_directories()
@@ -2149,7 +3195,14 @@ class Task(Base):
             'wallclock': self.wallclock,
             'working_directory': self.get_working_directory_value(),
             'archive_status': self.archive_status,
+            'archive_queue_time': self.archive_queue_time,
             'iteration': self.iteration.order_id,
+            'runtime_files_wait': self.runtime_files_wait,
+            'runtime_files_duration': self.runtime_files_duration,
+            'start_wait': self.start_wait,
+            'archive_wait': self.archive_wait,
+            'archive_runs': [i.get_stats(jsonable=jsonable, datetime_dicts=datetime_dicts)
+                             for i in self.archive_runs],
         }
 
         if datetime_dicts:
@@ -2161,6 +3214,8 @@ class Task(Base):
                 out['start_time'] = datetime_to_dict(out['start_time'])
             if self.end_time:
                 out['end_time'] = datetime_to_dict(out['end_time'])
+            if self.archive_queue_time:
+                out['archive_queue_time'] = datetime_to_dict(out['archive_queue_time'])
             if self.archive_start_time:
                 out['archive_start_time'] = datetime_to_dict(out['archive_start_time'])
             if self.archive_end_time:
@@ -2181,6 +3236,8 @@ class Task(Base):
                     out['start_time'] = out['start_time'].strftime(dt_fmt)
                 if self.end_time:
                     out['end_time'] = out['end_time'].strftime(dt_fmt)
+                if self.archive_queue_time:
+                    out['archive_queue_time'] = out['archive_queue_time'].strftime(dt_fmt)
                 if self.archive_start_time:
                     out['archive_start_time'] = out['archive_start_time'].strftime(dt_fmt)
                 if self.archive_end_time:
@@ -2336,6 +3393,11 @@ class CommandGroupSubmissionIteration(Base):
     iteration_id = Column(Integer, ForeignKey('iteration.id'))
     scheduler_job_id = Column(Integer, nullable=True)
     scheduler_stats_job_id = Column(Integer, nullable=True)
+    scheduler_release_job_id = Column(Integer, nullable=True)
+    max_running_tasks = Column(Integer, nullable=True)
+    num_tasks_ended = Column(Integer, default=0)
+    kill_time = Column(DateTime, nullable=True)
+    kill_result = Column(Enum(KillResult), nullable=True)
     command_group_submission_id = Column(
         Integer, ForeignKey('command_group_submission.id'))
 
@@ -2453,34 +3515,122 @@ class CommandGroupSubmissionIteration(Base):
     def num_tasks(self):
         return len(self.tasks)
 
-    def write_working_directories(self, project):
-        """Replace lines in the working_dirs files with actual directory paths."""
+    @property
+    def upstream_command_group_submission_iteration(self):
+        upstream = self.command_group_submission.upstream_command_group_submission
+        if upstream:
+            return upstream.get_command_group_submission_iteration(self.iteration)
 
-        dir_vals = self.get_directories()
+    def get_dependency_map(self):
+        """Get the tasks of the upstream command group submission iteration on which
+        each task of this command group submission iteration depends.
 
-        cg_sub = self.command_group_submission
+        Returns
+        -------
+        dict of (Task: list of Task)
 
-        wk_dirs_path = project.hf_dir.joinpath(
-            'workflow_{}'.format(cg_sub.submission.workflow.id_),
-            'submit_{}'.format(cg_sub.submission.order_id),
-            'iter_{}'.format(self.iteration.order_id),
-            'working_dirs_{}{}'.format(
-                cg_sub.command_group_exec_order, CONFIG.get('working_dirs_file_ext')),
-        )
+        Notes
+        -----
+        For `nesting` "nest" or `None`, the upstream command group belongs to the same
+        scheduler group, so tasks are matched by their scheduler task IDs. For `nesting`
+        "hold", a task depends on the upstream tasks that share its working directory;
+        if there are none (or the working directories are not yet resolved), it
+        depends on all upstream tasks.
+
+        """
+
+        upstream = self.upstream_command_group_submission_iteration
+        if not upstream:
+            return {i: [] for i in self.tasks}
+
+        up_tasks = sorted(upstream.tasks, key=lambda i: i.order_id)
+        nesting = self.command_group_submission.command_group.nesting
+
+        dep_map = {}
+        if nesting == NestingType('hold'):
+
+            up_tasks_by_dir = {}
+            if upstream.get_directories():
+                for i in up_tasks:
+                    up_tasks_by_dir.setdefault(i.get_working_directory_value(), []).append(i)
+
+            has_dirs = bool(self.get_directories())
+            for i in self.tasks:
+                deps = None
+                if has_dirs:
+                    deps = up_tasks_by_dir.get(i.get_working_directory_value())
+                dep_map.update({i: deps or up_tasks})
+
+        else:
+            step = self.step_size
+            up_step = upstream.step_size
+            for i in self.tasks:
+                # Scheduler task IDs are `1 + order_id * step`:
+                first = (i.order_id * step) // up_step
+                last = ((i.order_id + 1) * step - 1) // up_step
+                dep_map.update({i: up_tasks[first:last + 1]})
+
+        return dep_map
+
+    def get_contention_curve(self):
+        """Get the mean task lock wait time as a function of the number of tasks that
+        were running concurrently when each task was launched.
+
+        Returns
+        -------
+        dict of (int: float)
+            Keys are the number of concurrently running tasks and values are the mean
+            lock wait time in seconds of tasks that were launched at that concurrency.
+
+        """
+
+        launched = [i for i in self.tasks if i.launch_time]
+        launch_times = sorted(i.launch_time for i in launched)
+        end_times = sorted(i.end_time for i in launched if i.end_time)
+
+        waits = {}
+        for task in launched:
+            if task.lock_wait is None:
+                continue
+            # Tasks launched at or before this task, less those that had ended by then:
+            concurrency = (bisect_right(launch_times, task.launch_time) -
+                           bisect_right(end_times, task.launch_time))
+            waits.setdefault(concurrency, []).append(task.lock_wait)
+
+        curve = {k: sum(v) / len(v) for k, v in sorted(waits.items())}
 
-        with wk_dirs_path.open() as handle:
-            file_lns = handle.readlines()
+        return curve
 
-        for idx, i in enumerate(file_lns):
-            new_val = i.strip()
-            if 'REPLACE_WITH_DIR_' in i:
-                dir_idx = int(i.split('REPLACE_WITH_DIR_')[1])
-                new_val = dir_vals[dir_idx].value
-            file_lns[idx] = new_val
+    def recommend_max_running_tasks(self, max_wait=None):
+        """Recommend a maximum number of concurrently running tasks, such that the
+        mean lock wait time should not exceed `max_wait`.
+
+        Parameters
+        ----------
+        max_wait : float, optional
+            Maximum acceptable mean lock wait time in seconds. By default, taken from
+            the `throttle_max_wait` configuration item.
+
+        Returns
+        -------
+        int or None
+            The recommended maximum number of running tasks, or `None` if no contention
+            (or no timing information) has been observed.
+
+        """
+
+        if max_wait is None:
+            max_wait = CONFIG.get('throttle_max_wait')
+
+        max_running = None
+        prev_concurrency = 0
+        for concurrency, mean_wait in self.get_contention_curve().items():
+            if mean_wait > max_wait:
+                max_running = max(prev_concurrency, 1)
+                break
+            prev_concurrency = concurrency
 
-        with wk_dirs_path.open('w') as handle:
-            for i in file_lns:
-                handle.write(i + '\n')
+        return max_running
 
 
 class SchedulerGroup(object):
@@ -0,0 +1,111 @@
+"""`hpcflow.records.py`
+
+This module contains functions for writing and reading record files, in which each
+record has a fixed width, so that a given record can be written in place, and read
+by seeking (e.g. with `dd` in a jobscript), rather than by rewriting or scanning the
+whole file.
+
+"""
+
+import os
+from pathlib import Path
+
+from hpcflow.archive.lock import ArchiveLock
+
+# Width in bytes of each record of an index file (see `append_indexed`):
+INDEX_RECORD_WIDTH = 32
+
+
+def write_record(path, record_idx, record, width):
+    """Write a fixed-width record in place.
+
+    Parameters
+    ----------
+    path : str or Path
+        Record file, which is created if it does not exist.
+    record_idx : int
+        Zero-based index of the record to write.
+    record : str
+        Record to write, which is padded with spaces (before a final newline) to
+        `width` bytes.
+    width : int
+        Width in bytes of each record, including the final newline.
+
+    """
+
+    data = record.encode()
+    if len(data) > width - 1:
+        msg = 'Record "{}" is longer than the record width ({} bytes).'
+        raise ValueError(msg.format(record, width - 1))
+    data = data.ljust(width - 1) + b'\n'
+
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o666)
+    try:
+        os.pwrite(fd, data, record_idx * width)
+    finally:
+        os.close(fd)
+
+
+def read_record(path, record_idx, width):
+    """Read a fixed-width record written by `write_record`, without trailing padding,
+    or `None` if the record has not been written."""
+
+    with Path(path).open('rb') as handle:
+        handle.seek(record_idx * width)
+        data = handle.read(width)
+
+    if len(data) < width or data.startswith(b'\0'):
+        return None
+
+    return data.decode().rstrip()
+
+
+def append_indexed(data_path, index_path, record_idx, data):
+    """Append data to a data file, and write its offset and length to a given record of
+    an index file.
+
+    Several processes may append to the same data file concurrently. The offset and
+    length are written right-aligned in two space-separated fields, such that they can
+    be read in a jobscript with, for example:
+
+        read OFFSET LENGTH < <(dd if=$INDEX bs=32 skip=$RECORD_IDX count=1)
+        tail -c +$((OFFSET + 1)) $DATA | head -c $LENGTH
+
+    Parameters
+    ----------
+    data_path : Path
+    index_path : Path
+    record_idx : int
+        Zero-based index of the index record to write.
+    data : bytes
+
+    """
+
+    lock_path = data_path.with_name(data_path.name + '.lock')
+    with ArchiveLock(lock_path):
+        fd = os.open(data_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o666)
+        try:
+            offset = os.fstat(fd).st_size
+            view = memoryview(data)
+            while view:
+                view = view[os.write(fd, view):]
+        finally:
+            os.close(fd)
+
+    field_width = (INDEX_RECORD_WIDTH - 2) // 2
+    record = '{:>{w}} {:>{w}}'.format(offset, len(data), w=field_width)
+    write_record(index_path, record_idx, record, INDEX_RECORD_WIDTH)
+
+
+def read_indexed(data_path, index_path, record_idx):
+    """Read data appended by `append_indexed`, or `None` if the index record has not
+    been written."""
+
+    record = read_record(index_path, record_idx, INDEX_RECORD_WIDTH)
+    if record is None:
+        return None
+
+    offset, length = [int(i) for i in record.split()]
+    with Path(data_path).open('rb') as handle:
+        handle.seek(offset)
+        return handle.read(length)
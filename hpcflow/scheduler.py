@@ -1,18 +1,36 @@
 """`hpcflow.scheduler.py`"""
 
+import re
+import shlex
 from datetime import datetime
+from string import Template
 from subprocess import run, PIPE
 
 from hpcflow.config import Config as CONFIG
 from hpcflow._version import __version__
 
 
+class JobscriptTemplate(Template):
+    """Jobscript template, whose placeholder delimiter does not clash with shell
+    syntax."""
+    delimiter = '@@'
+
+
 class Scheduler(object):
 
     options = None
     output_dir = None
     error_dir = None
 
+    SHEBANG = '#!/bin/bash'
+    TASK_ID_VAR = None
+
+    # Jobscript variables that are written to the task log file:
+    LOG_VARIABLES = []
+
+    # Compiled templates, keyed by scheduler name, template name and enabled features:
+    _templates = {}
+
     def __repr__(self):
         out = ('{}('
                'options={!r}, '
@@ -32,11 +50,129 @@ class Scheduler(object):
         self.error_dir = error_dir or CONFIG.get('default_error_dir')
         self.options = options
 
+    def get_template(self, name, **features):
+        """Get a compiled jobscript template.
+
+        Parameters
+        ----------
+        name : str
+            Template name. The template text is generated by the scheduler method
+            `build_<name>_template`, to which `features` are passed.
+        features : dict of (str: bool)
+            Features (e.g. `archive`, `alternate_scratch`) that determine the
+            template text.
+
+        Returns
+        -------
+        JobscriptTemplate
+
+        Notes
+        -----
+        Each template is only built once per process, scheduler, name and set of enabled
+        features, and is then cached in memory. Templates are not cached on disk, since
+        the text of a template depends on the code that builds it.
+
+        """
+
+        enabled = sorted([k for k, v in features.items() if v])
+        key = (self._NAME, name, tuple(enabled))
+
+        template = Scheduler._templates.get(key)
+        if template is None:
+            build_template = getattr(self, 'build_{}_template'.format(name))
+            template = JobscriptTemplate(build_template(**features))
+            Scheduler._templates[key] = template
+
+        return template
+
+    def get_template_values(self, dir_path, workflow_directory, command_group_order,
+                            task_step_size, command_group_submission_id):
+        """Get the values of placeholders common to all jobscript templates."""
+
+        dt_stamp = datetime.now().strftime(r'%Y.%m.%d at %H:%M:%S')
+        about_msg = ('# --- jobscript generated by `hpcflow` (version: {}) '
+                     'on {} ---'.format(__version__, dt_stamp))
+
+        values = {
+            'about_msg': about_msg,
+            'submit_dir': dir_path.relative_to(workflow_directory).as_posix(),
+            'command_group_order': command_group_order,
+            'task_step_size': task_step_size,
+            'command_group_submission_id': command_group_submission_id,
+            'config_dir': CONFIG.get('config_dir'),
+        }
+
+        return values
+
+    def get_define_dirs_lines(self):
+        """Get template lines that define jobscript directory variables, and make the
+        iteration directory, which is not made at submit time for later iterations."""
+
+        lines = [
+            'ROOT_DIR=`pwd`',
+            'SUBMIT_DIR=$ROOT_DIR/@@submit_dir',
+            'ITER_DIR=$SUBMIT_DIR/iter_$ITER_IDX',
+            'LOG_PATH=$ITER_DIR/log_@@command_group_order.${}'.format(self.TASK_ID_VAR),
+            'TASK_IDX=$(((${} - 1)/@@task_step_size))'.format(self.TASK_ID_VAR),
+            'mkdir -p $ITER_DIR',
+        ]
+        return lines
+
+    @staticmethod
+    def get_log_lines(variables, end_line=True):
+        """Get template lines that write the values of jobscript variables to the task
+        log file."""
+
+        lines = [r'printf "Jobscript variables:\n" >> $LOG_PATH 2>&1']
+        lines += [r'printf "{0}:\t ${{{0}}}\n" >> $LOG_PATH 2>&1'.format(i)
+                  for i in variables]
+        if end_line:
+            lines.append(r'printf "\n" >> $LOG_PATH 2>&1')
+
+        return lines
+
+    @staticmethod
+    def get_hpcflow_command(command, append=True):
+        """Get a template line that invokes an hpcflow runtime command for the current
+        task."""
+
+        line = ('hpcflow {} --directory $ROOT_DIR --config-dir @@config_dir '
+                '@@command_group_submission_id $TASK_IDX $ITER_IDX {} $LOG_PATH '
+                '2>&1').format(command, '>>' if append else '>')
+
+        return line
+
+    @staticmethod
+    def get_jobscript_path(dir_path, command_group_order):
+        js_fn = 'js_{}{}'.format(command_group_order, CONFIG.get('jobscript_ext'))
+        return dir_path.joinpath(js_fn)
+
+    @staticmethod
+    def get_stats_jobscript_path(dir_path, command_group_order):
+        js_fn = 'st_{}{}'.format(command_group_order, CONFIG.get('jobscript_ext'))
+        return dir_path.joinpath(js_fn)
+
+    @staticmethod
+    def get_release_jobscript_path(dir_path, command_group_order):
+        js_fn = 'rl_{}{}'.format(command_group_order, CONFIG.get('jobscript_ext'))
+        return dir_path.joinpath(js_fn)
+
 
 class SunGridEngine(Scheduler):
 
     _NAME = 'sge'
     SHEBANG = '#!/bin/bash --login'
+    TASK_ID_VAR = 'SGE_TASK_ID'
+
+    LOG_VARIABLES = [
+        'ITER_IDX',
+        'ROOT_DIR',
+        'SUBMIT_DIR',
+        'ITER_DIR',
+        'LOG_PATH',
+        'SGE_TASK_ID',
+        'TASK_IDX',
+    ]
 
     STATS_DELIM = '==============================================================\n'
 
@@ -71,17 +207,22 @@ class SunGridEngine(Scheduler):
         super().__init__(options=options, output_dir=output_dir, error_dir=error_dir)
 
     def get_formatted_options(self, max_num_tasks, task_step_size, user_opt=True,
-                              name=None):
+                              name=None, max_running_tasks=None, discard_output=False):
 
         opts = ['#$ -{}'.format(i) for i in SunGridEngine.REQ_OPT]
-        opts.append('#$ -{} {}'.format(
-            SunGridEngine.STDOUT_OPT,
-            SunGridEngine.STDOUT_OPT_FMT.format(self.output_dir)),
-        )
-        opts.append('#$ -{} {}'.format(
-            SunGridEngine.STDERR_OPT,
-            SunGridEngine.STDERR_OPT_FMT.format(self.error_dir)),
-        )
+        if discard_output:
+            # Output is instead redirected to the task log by the jobscript:
+            opts.append('#$ -{} /dev/null'.format(SunGridEngine.STDOUT_OPT))
+            opts.append('#$ -{} /dev/null'.format(SunGridEngine.STDERR_OPT))
+        else:
+            opts.append('#$ -{} {}'.format(
+                SunGridEngine.STDOUT_OPT,
+                SunGridEngine.STDOUT_OPT_FMT.format(self.output_dir)),
+            )
+            opts.append('#$ -{} {}'.format(
+                SunGridEngine.STDERR_OPT,
+                SunGridEngine.STDERR_OPT_FMT.format(self.error_dir)),
+            )
         opts += ['#$ -{} {}'.format(i, j)
                  for i, j in SunGridEngine.REQ_PARAMETRISED_OPT.items()]
 
@@ -89,153 +230,237 @@ class SunGridEngine(Scheduler):
             opts += [f'#$ -N {name}']
 
         if user_opt:
+            user_opts = dict(self.options)
+            if max_running_tasks:
+                # Overrides any user-specified `tc`:
+                user_opts['tc'] = max_running_tasks
             opts += ['#$ -{} {}'.format(k, v).strip()
-                     for k, v in sorted(self.options.items())]
+                     for k, v in sorted(user_opts.items())]
 
         opts += ['', '#$ -t 1-{}:{}'.format(max_num_tasks, task_step_size)]
 
         return opts
 
-    def write_jobscript(self, dir_path, workflow_directory, command_group_order,
-                        max_num_tasks, task_step_size, environment, archive,
-                        alternate_scratch_dir, command_group_submission_id, name):
-        """Write the jobscript.
-
-        Parameters
-        ----------
-        archive : bool
-
-        """
-
-        js_ext = CONFIG.get('jobscript_ext')
-        js_name = 'js_{}'.format(command_group_order)
-        js_fn = js_name + js_ext
-        js_path = dir_path.joinpath(js_fn)
-
-        cmd_name = 'cmd_{}'.format(command_group_order)
-        cmd_fn = cmd_name + js_ext
-
-        submit_dir_relative = dir_path.relative_to(workflow_directory).as_posix()
-
-        wk_dirs_path = ('${{ITER_DIR}}/working_dirs_{}{}').format(
-            command_group_order, CONFIG.get('working_dirs_file_ext'))
-
-        dt_stamp = datetime.now().strftime(r'%Y.%m.%d at %H:%M:%S')
-        about_msg = ['# --- jobscript generated by `hpcflow` (version: {}) '
-                     'on {} ---'.format(__version__, dt_stamp)]
-
-        define_dirs_A = [
-            'ROOT_DIR=`pwd`',
-            'SUBMIT_DIR=$ROOT_DIR/{}'.format(submit_dir_relative),
-            'ITER_DIR=$SUBMIT_DIR/iter_$ITER_IDX',
-            'LOG_PATH=$ITER_DIR/log_{}.$SGE_TASK_ID'.format(command_group_order),
-            'TASK_IDX=$((($SGE_TASK_ID - 1)/{}))'.format(task_step_size),
-        ]
-
-        write_cmd_exec = [(
-            f'hpcflow write-runtime-files --directory $ROOT_DIR '
-            f'--config-dir {CONFIG.get("config_dir")} '
-            f'{command_group_submission_id} $TASK_IDX $ITER_IDX > $LOG_PATH 2>&1'
-        )]
+    def build_jobscript_template(self, archive=False, alternate_scratch=False,
+                                 loop_check=False, consolidate_logs=False,
+                                 release_dependents=False):
+        """Build the text of the jobscript template for a given set of features."""
+
+        consolidate_lns = []
+        if consolidate_logs:
+            # Write the task log (and all other output) to the usual task log path, and
+            # append it to the consolidated log of the job array on exit. If the task is
+            # killed (e.g. by SIGKILL, which cannot be trapped), or the append fails,
+            # the task log is left in place:
+            append_log = ('hpcflow append-log $LOG_PATH $ITER_DIR @@command_group_order '
+                          '$TASK_IDX > /dev/null 2>&1')
+            consolidate_lns = [
+                'exec >> $LOG_PATH 2>&1',
+                "trap '{}' EXIT".format(append_log),
+                '',
+            ]
 
         define_dirs_B = [
-            'INPUTS_DIR_REL=`sed -n "${{SGE_TASK_ID}}p" {}`'.format(wk_dirs_path),
+            ('read -r INPUTS_DIR_REL < <(dd if=@@wk_dirs_path bs=@@wk_dirs_record_width '
+             'skip=$((${} - 1)) count=1 2>/dev/null)').format(self.TASK_ID_VAR),
             'INPUTS_DIR=$ROOT_DIR/$INPUTS_DIR_REL',
         ]
+        log_vars = self.LOG_VARIABLES + [
+            'INPUTS_DIR_REL',
+            'INPUTS_DIR',
+            'INPUTS_DIR_SCRATCH',
+        ]
 
-        if alternate_scratch_dir:
-            alt_scratch_exc_path = '$ITER_DIR/{}_{}_$TASK_IDX{}'.format(
-                CONFIG.get('alt_scratch_exc_file'),
-                command_group_order,
-                CONFIG.get('alt_scratch_exc_file_ext'),
-            )
-            define_dirs_B.append('ALT_SCRATCH_EXC=' + alt_scratch_exc_path)
-            in_dir_scratch = 'INPUTS_DIR_SCRATCH={}/$INPUTS_DIR_REL'.format(
-                alternate_scratch_dir)
+        if alternate_scratch:
+            define_dirs_B += [
+                'ALT_SCRATCH_EXC=@@alt_scratch_exc_path',
+                'ALT_SCRATCH_MANIFEST=@@alt_scratch_manifest_path',
+                'INPUTS_DIR_SCRATCH=@@alternate_scratch_dir/$INPUTS_DIR_REL',
+            ]
+            log_vars += ['ALT_SCRATCH_EXC', 'ALT_SCRATCH_MANIFEST']
             copy_to_alt = [
-                ('rsync -avviz --exclude-from="${ALT_SCRATCH_EXC}" '
-                 '$INPUTS_DIR/ $INPUTS_DIR_SCRATCH >> $LOG_PATH 2>&1'),
+                ('hpcflow stage-in --config-dir @@config_dir @@input_cache_opts'
+                 '--exclude-from "${ALT_SCRATCH_EXC}" --manifest "${ALT_SCRATCH_MANIFEST}" '
+                 '$INPUTS_DIR $INPUTS_DIR_SCRATCH >> $LOG_PATH 2>&1'),
                 '',
             ]
             move_from_alt = [
                 '',
-                ('rsync -avviz $INPUTS_DIR_SCRATCH/ $INPUTS_DIR --remove-source-files'
-                 ' >> $LOG_PATH 2>&1'),
+                ('hpcflow stage-out --config-dir @@config_dir '
+                 '--manifest "${ALT_SCRATCH_MANIFEST}" '
+                 '$INPUTS_DIR_SCRATCH $INPUTS_DIR >> $LOG_PATH 2>&1'),
                 '',
             ]
         else:
-            in_dir_scratch = 'INPUTS_DIR_SCRATCH=$INPUTS_DIR'
+            define_dirs_B.append('INPUTS_DIR_SCRATCH=$INPUTS_DIR')
             copy_to_alt = []
             move_from_alt = []
 
-        define_dirs_B.append(in_dir_scratch)
-
-        log_stuff = [
-            r'printf "Jobscript variables:\n" >> $LOG_PATH 2>&1',
-            r'printf "ITER_IDX:\t ${ITER_IDX}\n" >> $LOG_PATH 2>&1',
-            r'printf "ROOT_DIR:\t ${ROOT_DIR}\n" >> $LOG_PATH 2>&1',
-            r'printf "SUBMIT_DIR:\t ${SUBMIT_DIR}\n" >> $LOG_PATH 2>&1',
-            r'printf "ITER_DIR:\t ${ITER_DIR}\n" >> $LOG_PATH 2>&1',
-            r'printf "LOG_PATH:\t ${LOG_PATH}\n" >> $LOG_PATH 2>&1',
-            r'printf "SGE_TASK_ID:\t ${SGE_TASK_ID}\n" >> $LOG_PATH 2>&1',
-            r'printf "TASK_IDX:\t ${TASK_IDX}\n" >> $LOG_PATH 2>&1',
-            r'printf "INPUTS_DIR_REL:\t ${INPUTS_DIR_REL}\n" >> $LOG_PATH 2>&1',
-            r'printf "INPUTS_DIR:\t ${INPUTS_DIR}\n" >> $LOG_PATH 2>&1',
-            r'printf "INPUTS_DIR_SCRATCH:\t ${INPUTS_DIR_SCRATCH}\n" >> $LOG_PATH 2>&1',
-        ]
-
-        if alternate_scratch_dir:
-            log_stuff.append(
-                r'printf "ALT_SCRATCH_EXC:\t ${ALT_SCRATCH_EXC}\n" >> $LOG_PATH 2>&1',
-            )
-
-        log_stuff.append(r'printf "\n" >> $LOG_PATH 2>&1')
+        write_cmd_exec = [self.get_hpcflow_command('write-runtime-files', append=False)]
 
-        if environment:
-            loads = [''] + environment + ['']
-        else:
-            loads = []
-
-        set_task_args = (f'--directory $ROOT_DIR '
-                         f'--config-dir {CONFIG.get("config_dir")} '
-                         f'{command_group_submission_id} '
-                         f'$TASK_IDX $ITER_IDX >> $LOG_PATH 2>&1')
         cmd_exec = [
-            f'hpcflow set-task-start {set_task_args}',
-            f'',
-            f'cd $INPUTS_DIR_SCRATCH',
-            f'. $SUBMIT_DIR/{cmd_fn}',
-            f'',
-            f'hpcflow set-task-end {set_task_args}',
+            self.get_hpcflow_command('set-task-start'),
+            '',
+            'cd $INPUTS_DIR_SCRATCH',
+            '. $SUBMIT_DIR/@@cmd_fn',
+            '',
+            self.get_hpcflow_command('set-task-end'),
         ]
 
         arch_lns = []
         if archive:
-            arch_lns = [
-                (f'hpcflow archive --directory $ROOT_DIR '
-                 f'--config-dir {CONFIG.get("config_dir")} '
-                 f'{command_group_submission_id} '
-                 f'$TASK_IDX $ITER_IDX >> $LOG_PATH 2>&1'),
-                ''
-            ]
-
-        js_lines = ([SunGridEngine.SHEBANG, ''] +
-                    about_msg + [''] +
-                    self.get_formatted_options(max_num_tasks, task_step_size, name=name) +
-                    [''] +
-                    define_dirs_A + [''] +
+            arch_lns = [self.get_hpcflow_command('archive'), '']
+
+        # Dependent (partial hold) tasks are released only once outputs are staged out
+        # and archived:
+        release_lns = []
+        if release_dependents:
+            release_lns = [self.get_hpcflow_command('release'), '']
+
+        loop_lns = []
+        if loop_check:
+            loop_lns = [self.get_hpcflow_command('check-loop'), '']
+
+        # `@@environment` is substituted with environment lines (each followed by a new
+        # line), or an empty string:
+        js_lines = ([self.SHEBANG, ''] +
+                    ['@@about_msg', ''] +
+                    ['@@options', ''] +
+                    self.get_define_dirs_lines() + [''] +
+                    consolidate_lns +
                     write_cmd_exec + [''] +
                     define_dirs_B + [''] +
-                    log_stuff + [''] +
-                    loads + [''] +
+                    self.get_log_lines(log_vars) + [''] +
+                    ['@@environment'] +
                     copy_to_alt +
                     cmd_exec +
                     move_from_alt +
-                    arch_lns)
+                    arch_lns +
+                    release_lns +
+                    loop_lns)
+
+        return '\n'.join(js_lines)
+
+    def build_stats_jobscript_template(self):
+        """Build the text of the stats jobscript template."""
+
+        js_lines = ([self.SHEBANG, ''] +
+                    ['@@about_msg', ''] +
+                    ['@@options', ''] +
+                    self.get_define_dirs_lines() + [''] +
+                    self.get_log_lines(self.LOG_VARIABLES, end_line=False) + [''] +
+                    [self.get_hpcflow_command('get-scheduler-stats')])
+
+        return '\n'.join(js_lines)
+
+    def build_release_jobscript_template(self):
+        """Build the text of the release jobscript template. This (single-task) job
+        runs once all tasks of a job array have finished, whether or not they completed,
+        to release or delete the remaining held tasks of the downstream (partial hold)
+        job array."""
+
+        release_cmd = ('hpcflow release-orphans --directory $ROOT_DIR --config-dir '
+                       '@@config_dir @@command_group_submission_id $ITER_IDX >> '
+                       '$LOG_PATH 2>&1')
+
+        js_lines = ([self.SHEBANG, ''] +
+                    ['@@about_msg', ''] +
+                    ['@@options', ''] +
+                    self.get_define_dirs_lines() +
+                    ['LOG_PATH=$ITER_DIR/release_@@command_group_order.log', ''] +
+                    self.get_log_lines(self.LOG_VARIABLES, end_line=False) + [''] +
+                    [release_cmd])
+
+        return '\n'.join(js_lines)
+
+    def write_jobscript(self, dir_path, workflow_directory, command_group_order,
+                        max_num_tasks, task_step_size, environment, archive,
+                        alternate_scratch_dir, command_group_submission_id, name,
+                        max_running_tasks=None, loop_check=False,
+                        consolidate_logs=False, input_cache_dir=None,
+                        input_cache_patterns=None, release_dependents=False,
+                        wk_dirs_record_width=None):
+        """Write the jobscript.
+
+        Parameters
+        ----------
+        archive : bool
+        max_running_tasks : int, optional
+            If specified, overrides the user-specified `tc` option.
+        loop_check : bool, optional
+            If True, each task checks for completion of the (dynamic) loop iteration
+            once it has finished.
+        consolidate_logs : bool, optional
+            If True, each task appends its log to the consolidated log of the job array
+            on exit, and the scheduler's output and error files are discarded. The log
+            of a task that is killed without running its exit trap (e.g. by SIGKILL) is
+            left at the usual task log path.
+        input_cache_dir : Path, optional
+            Root directory of the alternate scratch input cache.
+        input_cache_patterns : list of str, optional
+            Patterns of read-only input files to stage via the input cache.
+        release_dependents : bool, optional
+            If True, each task releases its held dependent tasks once its outputs are
+            staged out and archived.
+        wk_dirs_record_width : int, optional
+            Width in bytes of each record of the working directories file. By default,
+            the `working_dir_record_width` configuration item.
+
+        """
+
+        js_path = self.get_jobscript_path(dir_path, command_group_order)
+
+        template = self.get_template(
+            'jobscript',
+            archive=archive,
+            alternate_scratch=bool(alternate_scratch_dir),
+            loop_check=loop_check,
+            consolidate_logs=consolidate_logs,
+            release_dependents=release_dependents,
+        )
+
+        opts = self.get_formatted_options(max_num_tasks, task_step_size, name=name,
+                                          max_running_tasks=max_running_tasks,
+                                          discard_output=consolidate_logs)
+        alt_scratch_exc_path = '$ITER_DIR/{}_{}_$TASK_IDX{}'.format(
+            CONFIG.get('alt_scratch_exc_file'),
+            command_group_order,
+            CONFIG.get('alt_scratch_exc_file_ext'),
+        )
+        alt_scratch_manifest_path = '$ITER_DIR/{}_{}_$TASK_IDX{}'.format(
+            CONFIG.get('alt_scratch_manifest_file'),
+            command_group_order,
+            CONFIG.get('alt_scratch_manifest_file_ext'),
+        )
+        input_cache_opts = ''
+        if input_cache_dir and input_cache_patterns:
+            input_cache_opts = ''.join(
+                ['--input-cache {} '.format(shlex.quote(str(input_cache_dir)))] +
+                ['--cache-pattern {} '.format(shlex.quote(i))
+                 for i in input_cache_patterns]
+            )
+        wk_dirs_path = '${{ITER_DIR}}/working_dirs_{}{}'.format(
+            command_group_order, CONFIG.get('working_dirs_file_ext'))
+
+        js_text = template.substitute(
+            self.get_template_values(dir_path, workflow_directory, command_group_order,
+                                     task_step_size, command_group_submission_id),
+            options='\n'.join(opts),
+            environment=''.join(['{}\n'.format(i) for i in
+                                 ([''] + environment + [''] if environment else [])]),
+            cmd_fn='cmd_{}{}'.format(command_group_order, CONFIG.get('jobscript_ext')),
+            wk_dirs_path=wk_dirs_path,
+            wk_dirs_record_width=(wk_dirs_record_width or
+                                  CONFIG.get('working_dir_record_width')),
+            alt_scratch_exc_path=alt_scratch_exc_path,
+            alt_scratch_manifest_path=alt_scratch_manifest_path,
+            input_cache_opts=input_cache_opts,
+            alternate_scratch_dir=alternate_scratch_dir,
+        )
 
         # Write jobscript:
         with js_path.open('w') as handle:
-            handle.write('\n'.join(js_lines))
+            handle.write(js_text)
 
         return js_path
 
@@ -243,59 +468,156 @@ class SunGridEngine(Scheduler):
                               max_num_tasks, task_step_size, command_group_submission_id,
                               name):
 
-        js_ext = CONFIG.get('jobscript_ext')
-        js_name = 'st_{}'.format(command_group_order)
-        js_fn = js_name + js_ext
-        js_path = dir_path.joinpath(js_fn)
+        js_path = self.get_stats_jobscript_path(dir_path, command_group_order)
 
-        dt_stamp = datetime.now().strftime(r'%Y.%m.%d at %H:%M:%S')
-        about_msg = ['# --- jobscript generated by `hpcflow` (version: {}) '
-                     'on {} ---'.format(__version__, dt_stamp)]
+        template = self.get_template('stats_jobscript')
 
-        submit_dir_relative = dir_path.relative_to(workflow_directory).as_posix()
+        opts = self.get_formatted_options(max_num_tasks, task_step_size, user_opt=False,
+                                          name=name)
+        opts.append('#$ -l short')  # Temp (should be a profile option)
 
-        define_dirs = [
-            'ROOT_DIR=`pwd`',
-            'SUBMIT_DIR=$ROOT_DIR/{}'.format(submit_dir_relative),
-            'ITER_DIR=$SUBMIT_DIR/iter_$ITER_IDX',
-            'LOG_PATH=$ITER_DIR/log_{}.$SGE_TASK_ID'.format(command_group_order),
-            'TASK_IDX=$((($SGE_TASK_ID - 1)/{}))'.format(task_step_size),
-        ]
+        js_text = template.substitute(
+            self.get_template_values(dir_path, workflow_directory, command_group_order,
+                                     task_step_size, command_group_submission_id),
+            options='\n'.join(opts),
+        )
 
-        log_stuff = [
-            r'printf "Jobscript variables:\n" >> $LOG_PATH 2>&1',
-            r'printf "ITER_IDX:\t ${ITER_IDX}\n" >> $LOG_PATH 2>&1',
-            r'printf "ROOT_DIR:\t ${ROOT_DIR}\n" >> $LOG_PATH 2>&1',
-            r'printf "SUBMIT_DIR:\t ${SUBMIT_DIR}\n" >> $LOG_PATH 2>&1',
-            r'printf "ITER_DIR:\t ${ITER_DIR}\n" >> $LOG_PATH 2>&1',
-            r'printf "LOG_PATH:\t ${LOG_PATH}\n" >> $LOG_PATH 2>&1',
-            r'printf "SGE_TASK_ID:\t ${SGE_TASK_ID}\n" >> $LOG_PATH 2>&1',
-            r'printf "TASK_IDX:\t ${TASK_IDX}\n" >> $LOG_PATH 2>&1',
-        ]
+        # Write jobscript:
+        with js_path.open('w') as handle:
+            handle.write(js_text)
+
+        return js_path
+
+    def write_release_jobscript(self, dir_path, workflow_directory,
+                                command_group_order, command_group_submission_id,
+                                name):
+
+        js_path = self.get_release_jobscript_path(dir_path, command_group_order)
 
-        cmd_exec = [(
-            f'hpcflow get-scheduler-stats --directory $ROOT_DIR '
-            f'--config-dir {CONFIG.get("config_dir")} '
-            f'{command_group_submission_id} $TASK_IDX $ITER_IDX >> $LOG_PATH 2>&1'
-        )]
+        template = self.get_template('release_jobscript')
 
-        opt = self.get_formatted_options(max_num_tasks, task_step_size, user_opt=False,
-                                         name=name)
-        opt.append('#$ -l short')  # Temp (should be a profile option)
+        opts = self.get_formatted_options(1, 1, user_opt=False, name=name)
+        opts.append('#$ -l short')  # Temp (should be a profile option)
 
-        js_lines = ([SunGridEngine.SHEBANG, ''] +
-                    about_msg + [''] +
-                    opt + [''] +
-                    define_dirs + [''] +
-                    log_stuff + [''] +
-                    cmd_exec)
+        js_text = template.substitute(
+            self.get_template_values(dir_path, workflow_directory, command_group_order,
+                                     1, command_group_submission_id),
+            options='\n'.join(opts),
+        )
 
         # Write jobscript:
         with js_path.open('w') as handle:
-            handle.write('\n'.join(js_lines))
+            handle.write(js_text)
 
         return js_path
 
+    def set_max_running_tasks(self, scheduler_job_id, max_running_tasks):
+        """Change the maximum number of concurrently running tasks (`tc`) of a
+        submitted job array, returning True if it was changed successfully."""
+
+        cmd = ['qalter', '-tc', str(max_running_tasks), str(scheduler_job_id)]
+        proc = run(cmd, stdout=PIPE, stderr=PIPE)
+        qalter_out = proc.stdout.decode().strip()
+        qalter_err = proc.stderr.decode().strip()
+        if qalter_out:
+            print(qalter_out, flush=True)
+        if qalter_err:
+            print(qalter_err, flush=True)
+
+        return proc.returncode == 0
+
+    def release_tasks(self, scheduler_job_id, task_ids):
+        """Release the user hold on given tasks of a submitted job array, returning
+        True if the tasks were released successfully."""
+
+        job_tasks = ['{}.{}'.format(scheduler_job_id, i) for i in task_ids]
+        cmd = ['qrls', '-h', 'u'] + job_tasks
+        proc = run(cmd, stdout=PIPE, stderr=PIPE)
+        qrls_out = proc.stdout.decode().strip()
+        qrls_err = proc.stderr.decode().strip()
+        if qrls_out:
+            print(qrls_out, flush=True)
+        if qrls_err:
+            print(qrls_err, flush=True)
+
+        return proc.returncode == 0
+
+    def delete_tasks(self, scheduler_job_id, task_ids):
+        """Delete given tasks of a submitted job array, returning True if the tasks were
+        deleted successfully."""
+
+        job_tasks = ['{}.{}'.format(scheduler_job_id, i) for i in task_ids]
+        cmd = ['qdel'] + job_tasks
+        proc = run(cmd, stdout=PIPE, stderr=PIPE)
+        qdel_out = proc.stdout.decode().strip()
+        qdel_err = proc.stderr.decode().strip()
+        if qdel_out:
+            print(qdel_out, flush=True)
+        if qdel_err:
+            print(qdel_err, flush=True)
+
+        return proc.returncode == 0
+
+    def get_active_job_ids(self):
+        """Get the IDs of the user's jobs that are queued or running, using a single
+        `qstat` call, or `None` if the `qstat` call failed."""
+
+        proc = run(['qstat'], stdout=PIPE, stderr=PIPE)
+        qstat_out = proc.stdout.decode().strip()
+        qstat_err = proc.stderr.decode().strip()
+        if qstat_err:
+            print(qstat_err, flush=True)
+        if proc.returncode != 0:
+            return None
+
+        # Skip header lines; array jobs may appear on multiple lines:
+        job_ids = set()
+        for ln in qstat_out.splitlines():
+            job_id = ln.split(None, 1)[0] if ln.strip() else ''
+            if job_id.isdigit():
+                job_ids.add(int(job_id))
+
+        return job_ids
+
+    def delete_jobs(self, scheduler_job_ids):
+        """Delete jobs using a single `qdel` call.
+
+        The outcome of each job is parsed from the `qdel` output, since `qdel` fails if
+        any one job cannot be deleted (e.g. because it has already finished).
+
+        Returns
+        -------
+        dict of (int: str)
+            The outcome for each job ID: "deleted", "inactive" (the job does not exist)
+            or "failed".
+
+        """
+
+        cmd = ['qdel'] + [str(i) for i in scheduler_job_ids]
+        proc = run(cmd, stdout=PIPE, stderr=PIPE)
+        qdel_out = proc.stdout.decode().strip()
+        qdel_err = proc.stderr.decode().strip()
+        if qdel_out:
+            print(qdel_out, flush=True)
+        if qdel_err:
+            print(qdel_err, flush=True)
+
+        # Jobs not mentioned in the output are assumed deleted only if `qdel` succeeded:
+        outcomes = {i: 'deleted' if proc.returncode == 0 else 'failed'
+                    for i in scheduler_job_ids}
+        for ln in (qdel_out + '\n' + qdel_err).splitlines():
+            match = re.search(r'job(?:-array)?(?: task)? "?(\d+)', ln)
+            if not match or int(match.group(1)) not in outcomes:
+                continue
+            job_id = int(match.group(1))
+            if 'does not exist' in ln:
+                outcomes[job_id] = 'inactive'
+            elif any(i in ln for i in ['has deleted', 'has registered',
+                                        'already in deletion']):
+                outcomes[job_id] = 'deleted'
+
+        return outcomes
+
     def get_scheduler_stats(self, scheduler_job_id, task_id):
 
         cmd = ['/opt/site/sge/bin/lx-amd64/qacct', '-j', str(scheduler_job_id)]
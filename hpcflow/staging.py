@@ -0,0 +1,486 @@
+"""`hpcflow.staging.py`
+
+This module contains functionality for staging task working directories to and from an
+alternate scratch directory. Files are copied (without compression) by a pool of worker
+threads, and a manifest of the files staged in is kept, so that only new or modified
+files are staged out. Read-only input files that are shared by many tasks may be staged
+via a content-addressed input cache on the alternate scratch, such that each distinct
+file is copied once.
+
+"""
+
+import fnmatch
+import json
+import os
+import shutil
+import socket
+import stat as stat_module
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+from shutil import Error
+
+from hpcflow.config import Config as CONFIG
+from hpcflow.archive.lock import ArchiveLock
+from hpcflow.archive.manifest import hash_file
+from hpcflow.archive.store import ArchiveStore
+from hpcflow.copytree import copy2_fast, copytree_parallel
+
+
+def read_exclusion_list(path):
+    """Read the patterns of an exclusion list, as written by
+    `CommandGroupSubmission.write_alt_scratch_exclusion_list`, ignoring comments and
+    blank lines."""
+
+    patterns = []
+    with Path(path).open() as handle:
+        for line in handle:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                patterns.append(line)
+
+    return patterns
+
+
+def match_patterns(rel_path, patterns):
+    """Check if a path matches any of a list of (exclusion) patterns.
+
+    As for the `--exclude-from` option of `rsync`, a pattern that starts with "/" is
+    matched against the whole path (relative to the staged directory), and otherwise
+    against the same number of trailing path components as the pattern has.
+
+    """
+
+    parts = Path(rel_path).parts
+    for pattern in patterns:
+        anchored = pattern.startswith('/')
+        pat_parts = Path(pattern.strip('/')).parts
+        if not pat_parts:
+            continue
+        if anchored:
+            if len(parts) != len(pat_parts):
+                continue
+            candidate = parts
+        else:
+            if len(parts) < len(pat_parts):
+                continue
+            candidate = parts[-len(pat_parts):]
+        if all(fnmatch.fnmatchcase(i, j) for i, j in zip(candidate, pat_parts)):
+            return True
+
+    return False
+
+
+class InputCache(ArchiveStore):
+    """Content-addressed cache of read-only input files on an alternate scratch, shared
+    by the tasks of a submission.
+
+    Each distinct file is copied to the cache once (the copy is made by one task, while
+    other tasks staging the same file wait on a lock), and is then hard linked into the
+    working directory of each task on the alternate scratch. The hard link count of a
+    cached file is therefore the number of references to it (plus one). Cached files are
+    read-only.
+
+    To avoid hashing a source file that has already been cached, the hash of each cached
+    source file is recorded against its device, inode, size and modification time.
+
+    Parameters
+    ----------
+    path : str or Path
+        Root directory of the cache, on the same file system as the task working
+        directories on the alternate scratch.
+
+    """
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.num_linked = 0
+
+    def get_key_path(self, src_stat):
+        return self.path.joinpath('keys', '{}-{}-{}-{}'.format(
+            src_stat.st_dev, src_stat.st_ino, src_stat.st_size, src_stat.st_mtime_ns))
+
+    def get_digest(self, src_path, src_stat):
+        """Get the hash of a source file, from the cache keys if possible."""
+
+        key_path = self.get_key_path(src_stat)
+        try:
+            return key_path.read_text()
+        except FileNotFoundError:
+            pass
+
+        digest = hash_file(src_path)
+        key_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = key_path.with_name('{}.{}.{}'.format(
+            key_path.name, os.getpid(), threading.get_ident()))
+        tmp_path.write_text(digest)
+        os.replace(tmp_path, key_path)
+
+        return digest
+
+    def add(self, src_path):
+        """Add a file to the cache, if its contents are not already cached, and return
+        the path of the cached file, or `None` if the source file was modified while it
+        was being cached."""
+
+        src_stat = os.stat(src_path)
+        digest = self.get_digest(src_path, src_stat)
+        obj_path = self.get_object_path(digest)
+        if obj_path.exists():
+            return obj_path
+
+        with ArchiveLock(self.path.joinpath('locks', digest)):
+
+            if obj_path.exists():
+                # Cached by another task while we waited:
+                return obj_path
+
+            tmp_dir = self.path.joinpath('tmp')
+            tmp_dir.mkdir(parents=True, exist_ok=True)
+            tmp_path = tmp_dir.joinpath('{}.{}.{}'.format(
+                digest, os.getpid(), threading.get_ident()))
+            copy2_fast(src_path, tmp_path)
+
+            new_stat = os.stat(src_path)
+            if (new_stat.st_size, new_stat.st_mtime_ns) != (src_stat.st_size,
+                                                            src_stat.st_mtime_ns):
+                os.unlink(tmp_path)
+                return None
+
+            os.chmod(tmp_path, stat_module.S_IRUSR | stat_module.S_IRGRP |
+                     stat_module.S_IROTH)
+            obj_path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(tmp_path, obj_path)
+
+        with self._lock:
+            self.num_stored += 1
+            self.bytes_stored += src_stat.st_size
+
+        return obj_path
+
+    def copy_file(self, src_path, dst_path):
+        """Stage a file via the cache, or by copying it if it was modified while it was
+        being cached."""
+
+        obj_path = self.add(src_path)
+        if obj_path is None:
+            copy2_fast(src_path, dst_path)
+        else:
+            self.link(obj_path, dst_path)
+            with self._lock:
+                self.num_linked += 1
+
+        return dst_path
+
+    def evict(self):
+        """Remove the cache.
+
+        Files that have been staged to task working directories are hard links (or
+        copies), and so are unaffected. The cache directory is first renamed, so that
+        only one of any concurrently evicting processes removes it.
+
+        Returns
+        -------
+        dict or None
+            Numbers of cached files that were and were not referenced by a task working
+            directory on the alternate scratch, and the number of bytes of cached files.
+            `None` is returned if the cache does not exist (e.g. if it has already been
+            evicted by another process).
+
+        """
+
+        evict_path = self.path.with_name('{}.evicting.{}.{}'.format(
+            self.path.name, socket.gethostname(), os.getpid()))
+        try:
+            os.rename(self.path, evict_path)
+        except FileNotFoundError:
+            return None
+
+        num_referenced = 0
+        num_unreferenced = 0
+        num_bytes = 0
+        for obj_path in evict_path.joinpath('objects').glob('*/*'):
+            try:
+                obj_stat = obj_path.stat()
+            except FileNotFoundError:
+                continue
+            num_bytes += obj_stat.st_size
+            if obj_stat.st_nlink > 1:
+                num_referenced += 1
+            else:
+                num_unreferenced += 1
+
+        def make_writable(func, path, exc_info):
+            if issubclass(exc_info[0], FileNotFoundError):
+                return
+            # Cached files are read-only, which prevents their removal on some systems:
+            try:
+                os.chmod(path, stat_module.S_IWUSR | stat_module.S_IRUSR)
+                func(path)
+            except FileNotFoundError:
+                pass
+
+        shutil.rmtree(evict_path, onerror=make_writable)
+
+        out = {
+            'referenced': num_referenced,
+            'unreferenced': num_unreferenced,
+            'bytes': num_bytes,
+        }
+
+        return out
+
+
+def load_manifest(manifest_path):
+    """Load a staging manifest, which maps the path of each staged-in file (relative to
+    the staged directory) to its size and modification time (in nanoseconds)."""
+
+    manifest_path = Path(manifest_path)
+    if not manifest_path.is_file():
+        return {}
+    try:
+        with manifest_path.open() as handle:
+            return json.load(handle)
+    except ValueError:
+        # Corrupt manifest; all files will be staged out:
+        return {}
+
+
+def save_manifest(manifest_path, manifest):
+    """Atomically write a staging manifest."""
+
+    manifest_path = Path(manifest_path)
+    tmp_path = manifest_path.with_name('{}.{}'.format(manifest_path.name, os.getpid()))
+    with tmp_path.open('w') as handle:
+        json.dump(manifest, handle)
+    os.replace(tmp_path, manifest_path)
+
+
+def format_transfer(direction, stats):
+    """Format the statistics of a staging transfer as a log message."""
+
+    rate = stats['bytes'] / stats['duration'] if stats['duration'] else None
+    msg = ('{} Staged {} {} files ({:.1f} MB) in {:.2f} s ({} MB/s); {} files {}.')
+    msg = msg.format(
+        datetime.now(),
+        direction,
+        stats['files'],
+        stats['bytes'] / 2**20,
+        stats['duration'],
+        '{:.1f}'.format(rate / 2**20) if rate is not None else '-',
+        stats['skipped'],
+        'excluded' if direction == 'in' else 'unchanged',
+    )
+    if stats.get('cache_linked'):
+        msg += ' {} files linked from the input cache ({} added to the cache).'.format(
+            stats['cache_linked'], stats['cache_added'])
+
+    return msg
+
+
+def stage_in(src, dst, exclusion_list_path=None, manifest_path=None, max_workers=None,
+             input_cache_dir=None, input_cache_patterns=None):
+    """Copy a task working directory to an alternate scratch directory.
+
+    Parameters
+    ----------
+    src : str or Path
+        Task working directory.
+    dst : str or Path
+        Task working directory on the alternate scratch.
+    exclusion_list_path : str or Path, optional
+        Exclusion list of files that should not be staged.
+    manifest_path : str or Path, optional
+        If specified, a manifest of the staged files is written to this path, to be
+        used by `stage_out`.
+    max_workers : int, optional
+        Maximum number of files to copy concurrently. By default, taken from the
+        `stage_copy_workers` configuration item.
+    input_cache_dir : str or Path, optional
+        Root directory of an `InputCache`, via which files that match
+        `input_cache_patterns` are staged.
+    input_cache_patterns : list of str, optional
+        Patterns (matched as for the exclusion list) of read-only input files to stage
+        via the input cache.
+
+    Returns
+    -------
+    dict
+        Numbers of files copied (including those linked from the input cache) and
+        excluded, the number of bytes copied (excluding those linked from the input
+        cache), the numbers of files linked from the input cache and added to the
+        cache, and the duration of the transfer in seconds.
+
+    """
+
+    if max_workers is None:
+        max_workers = CONFIG.get('stage_copy_workers')
+
+    src = str(src)
+    dst = str(dst)
+    patterns = read_exclusion_list(exclusion_list_path) if exclusion_list_path else []
+
+    input_cache = None
+    if input_cache_dir and input_cache_patterns:
+        input_cache = InputCache(input_cache_dir)
+
+    manifest = {}
+    num_excluded = 0
+    num_bytes = 0
+    lock = threading.Lock()
+
+    def ignore(src_dir, names):
+
+        nonlocal num_excluded
+
+        if not patterns:
+            return set()
+        rel_dir = os.path.relpath(src_dir, src)
+        ignored = set()
+        for name in names:
+            if match_patterns(os.path.normpath(os.path.join(rel_dir, name)), patterns):
+                ignored.add(name)
+        num_excluded += len(ignored)
+
+        return ignored
+
+    def copy_file(src_path, dst_path):
+
+        nonlocal num_bytes
+
+        rel_path = Path(os.path.relpath(src_path, src)).as_posix()
+        if input_cache and match_patterns(rel_path, input_cache_patterns):
+            input_cache.copy_file(src_path, dst_path)
+            stat = os.stat(dst_path)
+            cached = stat.st_nlink > 1
+        else:
+            copy2_fast(src_path, dst_path)
+            stat = os.stat(dst_path)
+            cached = False
+
+        with lock:
+            manifest[rel_path] = [stat.st_size, stat.st_mtime_ns]
+            if not cached:
+                num_bytes += stat.st_size
+
+        return dst_path
+
+    start = datetime.now()
+    copytree_parallel(src, dst, symlinks=True, ignore=ignore, copy_function=copy_file,
+                      max_workers=max_workers)
+    duration = (datetime.now() - start).total_seconds()
+
+    if manifest_path:
+        save_manifest(manifest_path, manifest)
+
+    out = {
+        'files': len(manifest),
+        'skipped': num_excluded,
+        'bytes': num_bytes,
+        'cache_linked': input_cache.num_linked if input_cache else 0,
+        'cache_added': input_cache.num_stored if input_cache else 0,
+        'duration': duration,
+    }
+
+    return out
+
+
+def stage_out(src, dst, manifest_path=None, max_workers=None):
+    """Move new or modified files from a task working directory on an alternate scratch
+    back to the task working directory.
+
+    Parameters
+    ----------
+    src : str or Path
+        Task working directory on the alternate scratch.
+    dst : str or Path
+        Task working directory.
+    manifest_path : str or Path, optional
+        Manifest written by `stage_in`. Files whose size and modification time are
+        unchanged since they were staged in are not copied. If not specified, all files
+        are copied.
+    max_workers : int, optional
+        Maximum number of files to copy concurrently. By default, taken from the
+        `stage_copy_workers` configuration item.
+
+    Returns
+    -------
+    dict
+        Numbers of files copied and unchanged, the number of bytes copied, and the
+        duration of the transfer in seconds.
+
+    Notes
+    -----
+    As with the `--remove-source-files` option of `rsync`, files (but not directories)
+    are removed from the alternate scratch once they have been staged out. Unchanged
+    files are also removed.
+
+    """
+
+    if max_workers is None:
+        max_workers = CONFIG.get('stage_copy_workers')
+
+    manifest = load_manifest(manifest_path) if manifest_path else {}
+
+    def move_file(src_path, dst_path):
+        # As for `rsync`, copy to a temporary file first, so the existing file is
+        # replaced rather than overwritten:
+        tmp_path = '{}.{}.{}'.format(dst_path, os.getpid(), threading.get_ident())
+        copy2_fast(src_path, tmp_path)
+        os.replace(tmp_path, dst_path)
+        os.unlink(src_path)
+        return os.stat(dst_path).st_size
+
+    num_files = 0
+    num_unchanged = 0
+    num_bytes = 0
+    errors = []
+
+    start = datetime.now()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {}
+        for root, dirs, files in os.walk(src):
+            rel_root = os.path.relpath(root, src)
+            dst_root = os.path.normpath(os.path.join(dst, rel_root))
+            os.makedirs(dst_root, exist_ok=True)
+            # Symbolic links to directories are not followed by `os.walk`:
+            links = [i for i in dirs if os.path.islink(os.path.join(root, i))]
+            for name in files + links:
+                src_path = os.path.join(root, name)
+                rel_path = Path(os.path.normpath(os.path.join(rel_root, name))).as_posix()
+                stat = os.lstat(src_path)
+                if manifest.get(rel_path) == [stat.st_size, stat.st_mtime_ns]:
+                    os.unlink(src_path)
+                    num_unchanged += 1
+                    continue
+                dst_path = os.path.join(dst_root, name)
+                if os.path.islink(src_path):
+                    if os.path.lexists(dst_path):
+                        os.unlink(dst_path)
+                    os.symlink(os.readlink(src_path), dst_path)
+                    os.unlink(src_path)
+                    num_files += 1
+                    continue
+                futures[executor.submit(move_file, src_path, dst_path)] = src_path
+
+        for future in as_completed(futures):
+            try:
+                num_bytes += future.result()
+                num_files += 1
+            except OSError as why:
+                errors.append((futures[future], dst, str(why)))
+
+    duration = (datetime.now() - start).total_seconds()
+
+    if errors:
+        raise Error(errors)
+
+    out = {
+        'files': num_files,
+        'skipped': num_unchanged,
+        'bytes': num_bytes,
+        'duration': duration,
+    }
+
+    return out
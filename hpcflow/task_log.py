@@ -0,0 +1,71 @@
+"""`hpcflow.task_log.py`
+
+This module contains functions for consolidated task logs, in which the log of each
+task of a job array is appended, as a single framed record, to a log file that is
+shared by all tasks of the job array, rather than being written to a separate file per
+task.
+
+"""
+
+import socket
+from datetime import datetime
+from pathlib import Path
+
+from hpcflow.records import append_indexed, read_indexed
+
+# First line of each task's record within a consolidated log file:
+LOG_HEADER_FMT = '=== hpcflow task log: task_idx={} host={} time={} ===\n'
+
+
+def get_log_paths(iter_dir, command_group_order):
+    """Get the paths of the consolidated log file and its index file for the job array
+    of a given command group in a given iteration directory."""
+
+    iter_dir = Path(iter_dir)
+    log_path = iter_dir.joinpath('log_{}.log'.format(command_group_order))
+    index_path = iter_dir.joinpath('log_{}.idx'.format(command_group_order))
+
+    return log_path, index_path
+
+
+def append_task_log(task_log_path, iter_dir, command_group_order, task_idx):
+    """Append a task's log file to the consolidated log of its job array, and then
+    remove the task's log file.
+
+    Parameters
+    ----------
+    task_log_path : str or Path
+    iter_dir : str or Path
+        Iteration directory in which the consolidated log is stored.
+    command_group_order : int
+    task_idx : int
+        Task index, which is the index of the task's record within the index file.
+
+    """
+
+    task_log_path = Path(task_log_path)
+
+    header = LOG_HEADER_FMT.format(task_idx, socket.gethostname(), datetime.now())
+    data = header.encode() + task_log_path.read_bytes()
+    if not data.endswith(b'\n'):
+        data += b'\n'
+
+    log_path, index_path = get_log_paths(iter_dir, command_group_order)
+    append_indexed(log_path, index_path, task_idx, data)
+
+    task_log_path.unlink()
+
+
+def read_task_log(iter_dir, command_group_order, task_idx):
+    """Read a task's record from the consolidated log of its job array, or `None` if
+    the task's log has not been appended."""
+
+    log_path, index_path = get_log_paths(iter_dir, command_group_order)
+    if not index_path.is_file():
+        return None
+
+    data = read_indexed(log_path, index_path, task_idx)
+    if data is None:
+        return None
+
+    return data.decode(errors='replace')
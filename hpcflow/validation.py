@@ -164,3 +164,31 @@ def validate_task_multiplicity(cmd_groups, common_err_msg='',
             cmd_groups[i]['exec_order'] = i
 
     return cmd_groups
+
+
+def validate_working_directory(working_dir, record_width):
+    """Validate a resolved working directory (relative to the Workflow directory), which
+    must fit in a fixed-width record of the working directories file that is read by
+    the jobscript.
+
+    Parameters
+    ----------
+    working_dir : str
+    record_width : int
+        Width in bytes of each record of the working directories file, including the
+        final newline.
+
+    Returns
+    -------
+    working_dir : str
+
+    """
+
+    max_len = record_width - 1
+    if len(working_dir.encode()) > max_len:
+        msg = ('Working directory "{}" is too long: working directories (relative to '
+               'the Workflow directory) resolved after submission may be at most {} '
+               'bytes. Increase the `working_dir_record_width` configuration item.')
+        raise ValueError(msg.format(working_dir, max_len))
+
+    return working_dir
@@ -0,0 +1,79 @@
+import pytest
+
+from hpcflow.api import make_workflow
+from hpcflow.config import Config as CONFIG
+from hpcflow.init_db import init_db
+from hpcflow.models import Submission, Workflow
+from hpcflow.project import Project
+
+
+@pytest.fixture(scope='session', autouse=True)
+def config(tmp_path_factory):
+    """Load the (default) configuration from a temporary config directory."""
+    config_dir = tmp_path_factory.mktemp('config')
+    CONFIG.set_config(config_dir)
+    return CONFIG
+
+
+@pytest.fixture
+def make_files():
+    """Make files with given (relative) paths and contents within a directory."""
+
+    def make_files(root, files):
+        for rel_path, contents in files.items():
+            path = root.joinpath(rel_path)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_text(contents)
+        return root
+
+    return make_files
+
+
+@pytest.fixture
+def read_tree():
+    """Get the (relative) paths and contents of all files within a directory."""
+
+    def read_tree(root):
+        return {
+            path.relative_to(root).as_posix(): path.read_text()
+            for path in sorted(root.rglob('*')) if path.is_file()
+        }
+
+    return read_tree
+
+
+@pytest.fixture
+def set_config(monkeypatch):
+    """Set configuration items for the duration of a test."""
+
+    def set_config(**items):
+        for name, value in items.items():
+            monkeypatch.setitem(CONFIG._Config__conf, name, value)
+
+    return set_config
+
+
+@pytest.fixture
+def make_submission(tmp_path):
+    """Make a workflow (in a new project directory) from a workflow dict and generate a
+    submission of all of its tasks, without writing or submitting any jobscripts."""
+
+    sessions = []
+
+    def make_submission(workflow_dict):
+        dir_path = tmp_path.joinpath('workflow')
+        dir_path.mkdir()
+        config_dir = CONFIG.get('config_dir')
+        workflow_id = make_workflow(dir_path, workflow_dict=workflow_dict,
+                                    config_dir=config_dir)
+        session = init_db(Project(dir_path, config_dir))()
+        sessions.append(session)
+        workflow = session.query(Workflow).get(workflow_id)
+        submission = Submission(workflow, [1, -1, 1])
+        session.commit()
+        return submission
+
+    yield make_submission
+
+    for session in sessions:
+        session.close()
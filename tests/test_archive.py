@@ -0,0 +1,118 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+from hpcflow.archive import archive as archive_module
+from hpcflow.archive.archive import ArchiveRun, TaskArchiveStatus
+
+
+@pytest.fixture
+def archive_tasks(tmp_path, make_submission, set_config):
+    """Get the tasks of a command group whose three tasks share a working directory and
+    are archived to a local archive, with the commands of each task completed."""
+
+    set_config(archive_debounce=0)
+    tmp_path.joinpath('archive').mkdir()
+    submission = make_submission({
+        'command_groups': [{
+            'commands': 'echo <<num>>',
+            'scheduler': 'sge',
+            'archive': 'local',
+        }],
+        'variables': {'num': {'data': [1, 2, 3], 'value': '{}'}},
+        'archive_locations': {'local': {'path': str(tmp_path / 'archive')}},
+    })
+    cg_sub = submission.command_group_submissions[0]
+    tasks = cg_sub.command_group_submission_iterations[0].tasks
+    for task in tasks:
+        task.end_time = datetime.now()
+    Session.object_session(submission).commit()
+    return tasks
+
+
+def get_archive(task):
+    cg_sub = task.command_group_submission_iteration.command_group_submission
+    return cg_sub.command_group.archive
+
+
+def test_execute_with_lock(archive_tasks):
+    archive = get_archive(archive_tasks[0])
+    archive.execute_with_lock(archive_tasks[0])
+
+    assert archive_tasks[0].archive_status == TaskArchiveStatus('complete')
+    assert archive_tasks[1].archive_status == TaskArchiveStatus('pending')
+    assert len(archive_tasks[0].archive_runs) == 1
+
+
+def test_execute_with_lock_claims_stale_requests(archive_tasks):
+    # A worker that died while archiving on behalf of the first task:
+    archive_tasks[0].archive_status = TaskArchiveStatus('active')
+    archive = get_archive(archive_tasks[0])
+    archive.execute_with_lock(archive_tasks[1])
+
+    for task in archive_tasks[:2]:
+        assert task.archive_status == TaskArchiveStatus('complete')
+    assert archive_tasks[0].archived_task is archive_tasks[1]
+    assert [i.num_tasks for i in archive_tasks[1].archive_runs] == [2]
+
+
+def test_execute_with_lock_retries_locked_database(archive_tasks, monkeypatch):
+    session = Session.object_session(archive_tasks[0])
+    commit = session.commit
+    num_failures = 0
+
+    def locked_commit():
+        nonlocal num_failures
+        if num_failures < 2:
+            num_failures += 1
+            raise OperationalError('COMMIT', {}, Exception('database is locked'))
+        commit()
+
+    monkeypatch.setattr(session, 'commit', locked_commit)
+    monkeypatch.setattr(archive_module, 'sleep', lambda secs: None)
+    archive = get_archive(archive_tasks[0])
+    archive.execute_with_lock(archive_tasks[0])
+
+    session.expire_all()
+    assert archive_tasks[0].archive_status == TaskArchiveStatus('complete')
+    assert session.query(ArchiveRun).count() == 1
+
+
+def test_archive_run_waits(archive_tasks, monkeypatch):
+    # The second task's request was queued before the first task acquired the lock:
+    archive_tasks[1].archive_status = TaskArchiveStatus('queued')
+    archive_tasks[1].archive_queue_time = datetime.now() - timedelta(seconds=60)
+    archive = get_archive(archive_tasks[0])
+    monkeypatch.setattr(archive_module, 'sleep', lambda secs: None)
+    archive.execute_with_lock(archive_tasks[2])
+
+    # The run is attributed to the invoking task, whose request was queued just before
+    # it acquired the lock:
+    run = archive_tasks[2].archive_runs[0]
+    assert run.num_tasks == 2
+    assert 0 <= run.lock_wait < 5
+    assert archive_tasks[2].archive_wait == run.lock_wait
+    assert run.debounce_wait >= 0
+    assert archive_tasks[1].archive_wait is None
+
+
+def test_archive_run_waits_other_task(archive_tasks):
+    archive_tasks[1].archive_status = TaskArchiveStatus('queued')
+    archive_tasks[1].archive_queue_time = datetime.now() - timedelta(seconds=60)
+    archive = get_archive(archive_tasks[0])
+    Session.object_session(archive).commit()
+
+    queued = [archive_tasks[1]]
+    lock_time = datetime.now()
+    src_dir = archive.command_groups[0].workflow.directory
+    archive._archive_queued(queued, archive_tasks[0], lock_time, src_dir, archive.path,
+                            [], '{} {}')
+
+    # The archive is attributed to the queued task, and its lock wait is measured from
+    # its own request:
+    run = archive_tasks[1].archive_runs[0]
+    assert run.lock_wait >= 60
+    assert archive_tasks[1].archive_wait == run.lock_wait
+    assert archive_tasks[0].archive_wait is None
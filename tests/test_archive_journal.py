@@ -0,0 +1,126 @@
+import os
+
+import pytest
+
+from hpcflow.archive import journal as journal_module
+from hpcflow.archive.journal import ArchiveJournal, copytree_resumable
+
+
+def test_journal_round_trip(tmp_path, make_files):
+    src = make_files(tmp_path / 'src', {'a.txt': 'a'})
+    stat = os.stat(src / 'a.txt')
+    journal = ArchiveJournal(tmp_path / 'dst')
+    assert not journal.is_resuming
+    journal.start()
+    journal.record('a.txt', stat, file_hash='abc')
+    journal.close()
+
+    loaded = ArchiveJournal(tmp_path / 'dst')
+    assert loaded.is_resuming
+    assert loaded.attempts[0]['pid'] == os.getpid()
+    assert loaded.files == {
+        'a.txt': {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'hash': 'abc'}}
+
+
+def test_journal_truncated_line(tmp_path):
+    journal = ArchiveJournal(tmp_path)
+    journal.start()
+    journal.close()
+    with journal.path.open('a') as handle:
+        handle.write('{"path": "a.txt", "si')
+
+    loaded = ArchiveJournal(tmp_path)
+    assert loaded.is_resuming
+    assert loaded.files == {}
+
+
+def test_journal_writes_are_batched(tmp_path, monkeypatch):
+    monkeypatch.setattr(journal_module, 'JOURNAL_FLUSH_LINES', 3)
+    monkeypatch.setattr(journal_module, 'JOURNAL_FLUSH_INTERVAL', 3600)
+    stat = os.stat(tmp_path)
+
+    journal = ArchiveJournal(tmp_path)
+    journal.start()  # Written immediately
+    assert len(journal.path.read_text().splitlines()) == 1
+    journal.record('a', stat)
+    journal.record('b', stat)
+    assert len(journal.path.read_text().splitlines()) == 1
+    journal.record('c', stat)
+    assert len(journal.path.read_text().splitlines()) == 4
+    journal.record('d', stat)
+    journal.close()
+    assert len(journal.path.read_text().splitlines()) == 5
+
+
+def test_journal_remove(tmp_path):
+    journal = ArchiveJournal(tmp_path)
+    journal.start()
+    journal.remove()
+    assert not journal.path.exists()
+    # The empty hpcflow directory is also removed:
+    assert not journal.path.parent.exists()
+    # But a non-empty hpcflow directory is not:
+    journal = ArchiveJournal(tmp_path)
+    journal.start()
+    journal.path.parent.joinpath('other').write_text('')
+    journal.remove()
+    assert journal.path.parent.exists()
+
+
+def test_is_complete(tmp_path, make_files):
+    src = make_files(tmp_path / 'src', {'a.txt': 'a', 'b.txt': 'b'})
+    dst = make_files(tmp_path / 'dst', {'a.txt': 'a', 'b.txt': 'b'})
+    journal = ArchiveJournal(dst)
+    src_stat = os.stat(src / 'a.txt')
+    journal.record('a.txt', src_stat)
+
+    assert journal.is_complete('a.txt', src_stat, dst / 'a.txt')
+    assert journal.is_complete('a.txt', src_stat, dst / 'a.txt', verify_hash=True,
+                               src_path=src / 'a.txt')
+    # Not in the journal, and a different modification time:
+    os.utime(dst / 'b.txt', ns=(0, 0))
+    assert not journal.is_complete('b.txt', os.stat(src / 'b.txt'), dst / 'b.txt')
+    # Not in the journal, but the modification time was copied:
+    os.utime(dst / 'b.txt', ns=(0, os.stat(src / 'b.txt').st_mtime_ns))
+    assert journal.is_complete('b.txt', os.stat(src / 'b.txt'), dst / 'b.txt')
+    # Destination missing:
+    assert not journal.is_complete('c.txt', src_stat, dst / 'c.txt')
+    # Source changed since it was copied:
+    src.joinpath('a.txt').write_text('changed')
+    assert not journal.is_complete('a.txt', os.stat(src / 'a.txt'), dst / 'a.txt')
+
+
+def test_copytree_resumable(tmp_path, make_files, read_tree):
+    src = make_files(tmp_path / 'src', {'a.txt': 'a', 'sub/b.txt': 'b'})
+    dst = tmp_path / 'dst'
+    out = copytree_resumable(str(src), str(dst))
+    assert out == {'copied': 2, 'skipped': 0, 'bytes_copied': 2}
+    assert read_tree(dst) == read_tree(src)
+    assert not dst.joinpath('.hpcflow').exists()
+
+
+def test_copytree_resumable_resumes(tmp_path, make_files, read_tree, monkeypatch):
+    src = make_files(tmp_path / 'src', {'{}.txt'.format(i): str(i) for i in range(10)})
+    dst = tmp_path / 'dst'
+
+    copy2_fast = journal_module.copy2_fast
+    num_calls = 0
+
+    def interrupted_copy(src_path, dst_path):
+        nonlocal num_calls
+        num_calls += 1
+        if num_calls == 5:
+            raise KeyboardInterrupt
+        return copy2_fast(src_path, dst_path)
+
+    monkeypatch.setattr(journal_module, 'copy2_fast', interrupted_copy)
+    with pytest.raises(KeyboardInterrupt):
+        copytree_resumable(str(src), str(dst), max_workers=1)
+    monkeypatch.setattr(journal_module, 'copy2_fast', copy2_fast)
+
+    assert ArchiveJournal(dst).is_resuming
+    out = copytree_resumable(str(src), str(dst))
+    assert out['skipped'] >= 4
+    assert out['copied'] + out['skipped'] == 10
+    assert read_tree(dst) == read_tree(src)
+    assert not dst.joinpath('.hpcflow').exists()
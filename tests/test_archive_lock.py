@@ -0,0 +1,170 @@
+import errno
+import os
+import socket
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+from hpcflow.archive import lock as lock_module
+from hpcflow.archive.errors import ArchiveError
+from hpcflow.archive.lock import ArchiveLock
+
+# Acquire a lock in another process, and hold it until stdin is closed:
+HOLD_LOCK = textwrap.dedent('''
+    import sys
+    from hpcflow.archive.lock import ArchiveLock
+    with ArchiveLock(sys.argv[1]):
+        print('locked', flush=True)
+        sys.stdin.read()
+''')
+
+
+@pytest.fixture
+def hold_lock():
+    procs = []
+
+    def hold_lock(path):
+        proc = subprocess.Popen([sys.executable, '-c', HOLD_LOCK, str(path)],
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True,
+                                env=dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path)))
+        procs.append(proc)
+        assert proc.stdout.readline() == 'locked\n'
+        return proc
+
+    yield hold_lock
+
+    for proc in procs:
+        proc.communicate()
+
+
+def get_dead_pid():
+    proc = subprocess.Popen([sys.executable, '-c', ''])
+    proc.wait()
+    return proc.pid
+
+
+def use_exclusive_mode(lock_dir):
+    lock_dir.mkdir(exist_ok=True)
+    lock_dir.joinpath(ArchiveLock.MODE_FILENAME).write_text('excl\n')
+
+
+def test_acquire_release(tmp_path):
+    lock = ArchiveLock(tmp_path / 'locks' / 'a.lock')
+    with lock:
+        assert lock.is_locked
+        assert lock.get_holder() == (socket.gethostname(), os.getpid())
+        with pytest.raises(RuntimeError):
+            lock.acquire()
+    assert not lock.is_locked
+    # The most recent holder is recorded:
+    assert lock.get_holder() == (socket.gethostname(), os.getpid())
+    assert (tmp_path / 'locks' / ArchiveLock.MODE_FILENAME).read_text() == 'fcntl\n'
+
+
+@pytest.mark.parametrize('mode', ['fcntl', 'excl'])
+def test_lock_excludes_other_processes(tmp_path, hold_lock, mode):
+    lock_path = tmp_path / 'locks' / 'a.lock'
+    if mode == 'excl':
+        use_exclusive_mode(lock_path.parent)
+
+    proc = hold_lock(lock_path)
+    lock = ArchiveLock(lock_path)
+    assert not lock.acquire(blocking=False)
+    assert lock.get_holder() == (socket.gethostname(), proc.pid)
+
+    proc.communicate()
+    assert lock.acquire(blocking=False)
+    lock.release()
+
+
+def test_exclusive_mode_excludes_within_process(tmp_path):
+    use_exclusive_mode(tmp_path)
+    lock = ArchiveLock(tmp_path / 'a.lock')
+    other = ArchiveLock(tmp_path / 'a.lock')
+    with lock:
+        assert lock.holder_path.name == 'a.lock.excl'
+        assert not other.acquire(blocking=False)
+    assert not lock.holder_path.exists()
+    assert other.acquire(blocking=False)
+    other.release()
+
+
+def test_remove_stale_lock(tmp_path):
+    use_exclusive_mode(tmp_path)
+    lock = ArchiveLock(tmp_path / 'a.lock')
+    lock.holder_path.write_text('{} {} 2026-01-01\n'.format(socket.gethostname(),
+                                                              get_dead_pid()))
+    assert lock.acquire(blocking=False)
+    lock.release()
+    assert sorted(i.name for i in tmp_path.iterdir()) == [ArchiveLock.MODE_FILENAME]
+
+
+@pytest.mark.parametrize('holder', [
+    '{host} {pid} 2026-01-01\n',  # Running process
+    'other_host 1 2026-01-01\n',  # Other host
+    '',  # Being written
+])
+def test_lock_is_not_stale(tmp_path, holder):
+    use_exclusive_mode(tmp_path)
+    lock = ArchiveLock(tmp_path / 'a.lock')
+    lock.holder_path.write_text(holder.format(host=socket.gethostname(), pid=os.getpid()))
+    assert not lock.acquire(blocking=False)
+    assert lock.holder_path.read_text() == holder.format(host=socket.gethostname(),
+                                                         pid=os.getpid())
+
+
+def test_remove_stale_lock_race(tmp_path, monkeypatch):
+    use_exclusive_mode(tmp_path)
+    lock = ArchiveLock(tmp_path / 'a.lock')
+    lock.holder_path.write_text('{} {} 2026-01-01\n'.format(socket.gethostname(),
+                                                              get_dead_pid()))
+    live_holder = '{} {} 2026-01-02\n'.format(socket.gethostname(), os.getpid())
+    kill = os.kill
+
+    def kill_and_replace(pid, sig):
+        # Another waiting process removes the stale lock and acquires the lock after we
+        # have found that the lock is stale, but before we remove it:
+        lock.holder_path.unlink()
+        lock.holder_path.write_text(live_holder)
+        kill(pid, sig)
+
+    monkeypatch.setattr(lock_module.os, 'kill', kill_and_replace)
+    assert lock._remove_stale()
+    # The other process' lock is not removed:
+    assert lock.holder_path.read_text() == live_holder
+    monkeypatch.setattr(lock_module.os, 'kill', kill)
+    assert not lock.acquire(blocking=False)
+
+
+def test_mode_is_recorded_per_directory(tmp_path, monkeypatch):
+    lockf = lock_module.fcntl.lockf
+
+    def lockf_not_supported(fd, cmd, *args):
+        if cmd != lock_module.fcntl.LOCK_UN:
+            raise OSError(errno.ENOLCK, os.strerror(errno.ENOLCK))
+        return lockf(fd, cmd, *args)
+
+    # Record locks are not supported when the directory is first used:
+    monkeypatch.setattr(lock_module.fcntl, 'lockf', lockf_not_supported)
+    with ArchiveLock(tmp_path / 'a.lock') as lock:
+        assert lock.holder_path.name == 'a.lock.excl'
+
+    # The same mode is used by later locks, even if record locks are now supported:
+    monkeypatch.setattr(lock_module.fcntl, 'lockf', lockf)
+    with ArchiveLock(tmp_path / 'b.lock') as lock:
+        assert lock.holder_path.name == 'b.lock.excl'
+
+
+def test_record_lock_failure_is_raised(tmp_path, monkeypatch):
+    with ArchiveLock(tmp_path / 'a.lock'):
+        pass
+
+    def lockf_not_supported(fd, cmd, *args):
+        raise OSError(errno.ENOLCK, os.strerror(errno.ENOLCK))
+
+    monkeypatch.setattr(lock_module.fcntl, 'lockf', lockf_not_supported)
+    with pytest.raises(ArchiveError):
+        ArchiveLock(tmp_path / 'a.lock').acquire()
+    assert not (tmp_path / 'a.lock.excl').exists()
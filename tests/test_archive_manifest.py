@@ -0,0 +1,163 @@
+import hashlib
+import os
+from shutil import Error
+
+import pytest
+
+from hpcflow.archive import manifest as manifest_module
+from hpcflow.archive.manifest import (ArchiveManifest, HashCache, copytree_incremental,
+                                      hash_file)
+
+
+def test_hash_file(tmp_path):
+    path = tmp_path / 'a.txt'
+    path.write_bytes(b'abc' * 1000)
+    assert hash_file(path, block_size=7) == hashlib.sha256(b'abc' * 1000).hexdigest()
+
+
+def test_manifest_round_trip(tmp_path):
+    src_path = tmp_path / 'a.txt'
+    src_path.write_text('a')
+    manifest = ArchiveManifest(tmp_path / 'dst')
+    manifest.update('a.txt', os.stat(src_path), src_path)
+    manifest.save()
+
+    loaded = ArchiveManifest(tmp_path / 'dst')
+    assert loaded.files == manifest.files
+    assert loaded.files['a.txt']['hash'] == hash_file(src_path)
+    assert not loaded.is_changed('a.txt', os.stat(src_path))
+    assert loaded.is_changed('b.txt', os.stat(src_path))
+
+
+def test_manifest_corrupt(tmp_path):
+    manifest = ArchiveManifest(tmp_path)
+    manifest.path.parent.mkdir()
+    manifest.path.write_text('{"version": 1, "files"')
+    assert ArchiveManifest(tmp_path).files == {}
+
+
+def test_manifest_changed_mtime_same_hash(tmp_path):
+    src_path = tmp_path / 'a.txt'
+    src_path.write_text('a')
+    manifest = ArchiveManifest(tmp_path / 'dst')
+    manifest.update('a.txt', os.stat(src_path), src_path)
+
+    os.utime(src_path, ns=(0, 0))
+    stat = os.stat(src_path)
+    assert manifest.is_changed('a.txt', stat)
+    assert not manifest.is_changed('a.txt', stat, src_path)
+    # The recorded modification time is updated:
+    assert not manifest.is_changed('a.txt', stat)
+
+
+def test_hash_cache(tmp_path):
+    path = tmp_path / 'a.txt'
+    path.write_text('a')
+    calls = []
+
+    def hash_func(path):
+        calls.append(path)
+        return hash_file(path)
+
+    cache = HashCache(tmp_path, 'test', hash_func=hash_func)
+    assert cache.get_hash(path) == hash_file(path)
+    assert cache.get_hash(path) == hash_file(path)
+    assert len(calls) == 1
+    cache.save()
+
+    cache = HashCache(tmp_path, 'test', hash_func=hash_func)
+    cache.get_hash(path)
+    assert len(calls) == 1
+
+    path.write_text('changed')
+    assert cache.get_hash(path) == hash_file(path)
+    assert len(calls) == 2
+
+    # Rewritten with the same size and modification time:
+    mtime_ns = os.stat(path).st_mtime_ns
+    path.write_text('CHANGED')
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+    assert cache.get_hash(path) == hash_file(path)
+    assert len(calls) == 3
+
+
+def test_hash_cache_dir(tmp_path):
+    path = tmp_path / 'a.txt'
+    path.write_text('a')
+    cache = HashCache(tmp_path, 'test', cache_dir=tmp_path / 'caches')
+    cache.get_hash(path)
+    cache.save()
+    assert cache.path == tmp_path / 'caches' / 'test_hash_cache.json'
+    assert cache.path.is_file()
+
+
+def test_copytree_incremental(tmp_path, make_files, read_tree):
+    src = make_files(tmp_path / 'src', {'a.txt': 'a', 'sub/b.txt': 'b'})
+    dst = tmp_path / 'dst'
+
+    out = copytree_incremental(str(src), str(dst))
+    assert out == {'copied': 2, 'skipped': 0, 'deleted': 0, 'bytes_copied': 2}
+    assert read_tree(dst) == dict(read_tree(src), **{
+        '.hpcflow/archive_manifest.json': ArchiveManifest(dst).path.read_text()})
+
+    out = copytree_incremental(str(src), str(dst))
+    assert out == {'copied': 0, 'skipped': 2, 'deleted': 0, 'bytes_copied': 0}
+
+    src.joinpath('a.txt').write_text('aa')
+    out = copytree_incremental(str(src), str(dst))
+    assert out == {'copied': 1, 'skipped': 1, 'deleted': 0, 'bytes_copied': 2}
+    assert dst.joinpath('a.txt').read_text() == 'aa'
+
+
+def test_copytree_incremental_delete(tmp_path, make_files):
+    src = make_files(tmp_path / 'src', {'a.txt': 'a', 'b.txt': 'b', 'c.log': 'c'})
+    dst = tmp_path / 'dst'
+    copytree_incremental(str(src), str(dst))
+    dst.joinpath('other.txt').write_text('not archived')
+
+    src.joinpath('b.txt').unlink()
+
+    def ignore(src_dir, names):
+        return [i for i in names if i.endswith('.log')]
+
+    out = copytree_incremental(str(src), str(dst), ignore=ignore, delete=True)
+    assert out['deleted'] == 1
+    assert not dst.joinpath('b.txt').exists()
+    assert 'b.txt' not in ArchiveManifest(dst).files
+    # Excluded files, and files not in the manifest, are not deleted:
+    assert dst.joinpath('c.log').exists()
+    assert dst.joinpath('other.txt').exists()
+
+
+def test_copytree_incremental_errors(tmp_path, make_files):
+    src = make_files(tmp_path / 'src', {'a.txt': 'a', 'b.txt': 'b'})
+    dst = tmp_path / 'dst'
+    dst.joinpath('b.txt').mkdir(parents=True)  # A file cannot be copied over this
+
+    with pytest.raises(Error):
+        copytree_incremental(str(src), str(dst))
+
+    # Only the file that was copied is recorded:
+    assert list(ArchiveManifest(dst).files) == ['a.txt']
+
+
+def test_copytree_incremental_hashes_once(tmp_path, make_files, monkeypatch):
+    src = make_files(tmp_path / 'src', {'a.txt': 'a', 'b.txt': 'b'})
+    dst = tmp_path / 'dst'
+    copytree_incremental(str(src), str(dst), hash_files=True)
+
+    hashed = []
+
+    def counted_hash_file(path, *args, **kwargs):
+        hashed.append(os.path.basename(path))
+        return hash_file(path, *args, **kwargs)
+
+    monkeypatch.setattr(manifest_module, 'hash_file', counted_hash_file)
+    for name, contents in [('a.txt', 'A'), ('b.txt', 'b')]:
+        src.joinpath(name).write_text(contents)
+        os.utime(src / name, ns=(0, 0))
+
+    out = copytree_incremental(str(src), str(dst), hash_files=True)
+    assert out['copied'] == 1
+    assert sorted(hashed) == ['a.txt', 'b.txt']
+    assert ArchiveManifest(dst).files['a.txt']['hash'] == hash_file(src / 'a.txt')
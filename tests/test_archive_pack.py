@@ -0,0 +1,105 @@
+import tarfile
+
+import pytest
+
+from hpcflow.archive.pack import (COMPRESSION_EXT, extract_files, pack_directory,
+                                  read_index)
+
+FILES = {
+    'a.txt': 'a' * 700,
+    'sub/b.txt': 'b',
+    'sub/deep/c.txt': 'c' * 1500,
+    'empty.txt': '',
+}
+
+
+@pytest.mark.parametrize('compression', list(COMPRESSION_EXT))
+def test_pack_extract_round_trip(tmp_path, make_files, read_tree, compression):
+    src = make_files(tmp_path / 'src', FILES)
+    packed = tmp_path / 'packed'
+    out = pack_directory(src, packed, compression=compression)
+    assert out == {'files': 4, 'segments': 1, 'bytes': 2201}
+
+    extracted = extract_files(packed, tmp_path / 'extracted')
+    assert sorted(extracted) == sorted(FILES)
+    assert read_tree(tmp_path / 'extracted') == FILES
+
+
+@pytest.mark.parametrize('compression', list(COMPRESSION_EXT))
+def test_segments_are_valid_tar_files(tmp_path, make_files, compression):
+    src = make_files(tmp_path / 'src', FILES)
+    pack_directory(src, tmp_path / 'packed', segment_size=1000, compression=compression)
+    index = read_index(tmp_path / 'packed')
+    names = []
+    for seg_name in index['segments']:
+        with tarfile.open(tmp_path / 'packed' / seg_name) as tar:
+            names += tar.getnames()
+    assert sorted(names) == sorted(FILES)
+
+
+def test_segment_size(tmp_path, make_files):
+    src = make_files(tmp_path / 'src', {
+        'a.txt': 'a' * 700,
+        'b.txt': 'b' * 300,
+        'c.txt': 'c' * 1,
+        'd.txt': 'd' * 1500,
+        'e.txt': 'e' * 1,
+    })
+    out = pack_directory(src, tmp_path / 'packed', segment_size=1000)
+    assert out['segments'] == 4
+    segments = {k: v['segment']
+                for k, v in read_index(tmp_path / 'packed')['members'].items()}
+    # A segment may be filled exactly, and a file larger than the segment size is
+    # written to its own segment:
+    assert segments == {'a.txt': 0, 'b.txt': 0, 'c.txt': 1, 'd.txt': 2, 'e.txt': 3}
+
+
+def test_extract_selected_files(tmp_path, make_files, read_tree):
+    src = make_files(tmp_path / 'src', FILES)
+    pack_directory(src, tmp_path / 'packed', segment_size=1000, compression='gz')
+    extract_files(tmp_path / 'packed', tmp_path / 'extracted', members=['sub/b.txt'])
+    assert read_tree(tmp_path / 'extracted') == {'sub/b.txt': 'b'}
+
+    with pytest.raises(ValueError):
+        extract_files(tmp_path / 'packed', tmp_path / 'extracted', members=['x.txt'])
+
+
+def test_pack_replaces_previous_segments(tmp_path, make_files, read_tree):
+    src = make_files(tmp_path / 'src', FILES)
+    packed = tmp_path / 'packed'
+    pack_directory(src, packed, segment_size=1000)
+    pack_directory(src, packed, compression='xz')
+    assert sorted(i.name for i in packed.iterdir()) == ['index.json', 'segment_0.tar.xz']
+
+    extract_files(packed, tmp_path / 'extracted')
+    assert read_tree(tmp_path / 'extracted') == FILES
+
+
+def test_pack_ignore(tmp_path, make_files):
+    src = make_files(tmp_path / 'src', FILES)
+
+    def ignore(src_dir, names):
+        return [i for i in names if i == 'deep' or i == 'a.txt']
+
+    out = pack_directory(src, tmp_path / 'packed', ignore=ignore)
+    assert sorted(read_index(tmp_path / 'packed')['members']) == ['empty.txt',
+                                                                  'sub/b.txt']
+    assert out['files'] == 2
+
+
+def test_pack_empty_directory(tmp_path):
+    (tmp_path / 'src').mkdir()
+    out = pack_directory(tmp_path / 'src', tmp_path / 'packed')
+    assert out == {'files': 0, 'segments': 0, 'bytes': 0}
+    assert extract_files(tmp_path / 'packed', tmp_path / 'extracted') == []
+
+
+def test_pack_bad_compression(tmp_path):
+    with pytest.raises(ValueError):
+        pack_directory(tmp_path, tmp_path / 'packed', compression='zip')
+
+
+def test_read_index_bad_version(tmp_path):
+    (tmp_path / 'index.json').write_text('{"version": 0}')
+    with pytest.raises(ValueError):
+        read_index(tmp_path)
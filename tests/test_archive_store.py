@@ -0,0 +1,97 @@
+import os
+import stat
+
+from hpcflow.archive import store as store_module
+from hpcflow.archive.manifest import hash_file
+from hpcflow.archive.store import ArchiveStore, copytree_dedup
+from hpcflow.copytree import copy2_fast
+
+
+def test_store_add(tmp_path, make_files):
+    src = make_files(tmp_path / 'src', {'a.txt': 'same', 'b.txt': 'same', 'c.txt': 'c'})
+    store = ArchiveStore(tmp_path / 'store')
+
+    obj_a = store.add(src / 'a.txt')
+    assert obj_a == store.get_object_path(hash_file(src / 'a.txt'))
+    assert obj_a.read_text() == 'same'
+    assert not obj_a.stat().st_mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)
+
+    assert store.add(src / 'b.txt') == obj_a
+    assert store.add(src / 'c.txt') != obj_a
+    assert store.num_stored == 2
+    assert store.bytes_stored == len('same') + len('c')
+
+
+def test_store_link(tmp_path, make_files):
+    src = make_files(tmp_path / 'src', {'a.txt': 'a'})
+    store = ArchiveStore(tmp_path / 'store')
+    obj_path = store.add(src / 'a.txt')
+
+    dst_path = tmp_path / 'a.txt'
+    dst_path.write_text('old')
+    store.link(obj_path, dst_path)
+    assert os.path.samefile(obj_path, dst_path)
+    # Linking again is a no-op:
+    store.link(obj_path, dst_path)
+    assert os.path.samefile(obj_path, dst_path)
+    assert [i.name for i in tmp_path.iterdir() if i.is_file()] == ['a.txt']
+
+
+def test_copytree_dedup(tmp_path, make_files, read_tree):
+    files = {'a.txt': 'same', 'sub/b.txt': 'same', 'sub/c.txt': 'c'}
+    store_dir = tmp_path / 'store'
+    for idx in range(2):
+        src = make_files(tmp_path / 'src_{}'.format(idx), files)
+        dst = tmp_path / 'dst_{}'.format(idx)
+        out = copytree_dedup(str(src), str(dst), store_dir)
+        assert out['files'] == 3
+        # Files are only added to the store by the first archive:
+        assert out['stored'] == (2 if idx == 0 else 0)
+        assert read_tree(dst) == files
+
+    assert os.path.samefile(tmp_path / 'dst_0' / 'a.txt', tmp_path / 'dst_1' / 'a.txt')
+    assert os.path.samefile(tmp_path / 'dst_0' / 'a.txt',
+                            tmp_path / 'dst_0' / 'sub' / 'b.txt')
+
+
+def test_copytree_dedup_rewritten_file(tmp_path, make_files, read_tree):
+    src = make_files(tmp_path / 'src', {'a.txt': 'old'})
+    copytree_dedup(str(src), str(tmp_path / 'dst_0'), tmp_path / 'store')
+
+    # Rewrite the file with the same size and modification time:
+    mtime_ns = os.stat(src / 'a.txt').st_mtime_ns
+    src.joinpath('a.txt').write_text('new')
+    os.utime(src / 'a.txt', ns=(mtime_ns, mtime_ns))
+
+    copytree_dedup(str(src), str(tmp_path / 'dst_1'), tmp_path / 'store')
+    assert read_tree(tmp_path / 'dst_1') == {'a.txt': 'new'}
+
+
+def test_copytree_dedup_hash_cache_location(tmp_path, make_files):
+    src = make_files(tmp_path / 'src', {'a.txt': 'a'})
+    copytree_dedup(str(src), str(tmp_path / 'dst'), tmp_path / 'store')
+    # Nothing is written to the source directory:
+    assert [i.name for i in src.iterdir()] == ['a.txt']
+    assert len(list((tmp_path / 'store' / 'hash_caches').iterdir())) == 1
+
+
+
+def test_store_add_concurrent(tmp_path, make_files, monkeypatch):
+    src = make_files(tmp_path / 'src', {'a.txt': 'same', 'b.txt': 'same'})
+    store = ArchiveStore(tmp_path / 'store')
+    other_store = ArchiveStore(tmp_path / 'store')
+
+    def copy_racing(src_path, dst_path):
+        # The same contents are stored by another process after this process checked
+        # whether they were already stored:
+        monkeypatch.setattr(store_module, 'copy2_fast', copy2_fast)
+        other_path = other_store.add(src / 'b.txt')
+        copy2_fast(src_path, dst_path)
+        return other_path
+
+    monkeypatch.setattr(store_module, 'copy2_fast', copy_racing)
+    obj_path = store.add(src / 'a.txt')
+
+    assert obj_path == other_store.get_object_path(hash_file(src / 'b.txt'))
+    assert (store.num_stored, other_store.num_stored) == (0, 1)
+    assert not list(store.path.joinpath('tmp').iterdir())
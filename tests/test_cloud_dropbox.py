@@ -0,0 +1,196 @@
+import hashlib
+import os
+
+import pytest
+import requests
+
+from hpcflow.archive.cloud.cloud import APICallCounter
+from hpcflow.archive.cloud.providers import dropbox, local
+from hpcflow.archive.cloud.providers.local import LocalCloudClient
+
+
+@pytest.fixture
+def client(tmp_path):
+    root_dir = tmp_path / 'cloud'
+    root_dir.mkdir()
+    return LocalCloudClient(root_dir)
+
+
+@pytest.fixture
+def data_file(tmp_path):
+    path = tmp_path / 'data.dat'
+    path.write_bytes(os.urandom(10 * 1000 + 1))
+    return path
+
+
+def test_upload_in_chunks(tmp_path, client, data_file, set_config):
+    set_config(cloud_upload_chunk_size=1000)
+    calls = []
+
+    def append(f, cursor, **kwargs):
+        calls.append(len(f))
+        LocalCloudClient.files_upload_session_append_v2(client, f, cursor, **kwargs)
+
+    client.files_upload_session_append_v2 = append
+    dropbox.upload_dropbox_file(client, data_file, '/archive')
+
+    assert (tmp_path / 'cloud' / 'archive' / 'data.dat').read_bytes() == \
+        data_file.read_bytes()
+    # First and last chunks are sent with the session start and finish requests:
+    assert calls == [1000] * 9
+
+
+def test_upload_session_resumes_at_correct_offset(tmp_path, client, data_file,
+                                                  monkeypatch):
+    monkeypatch.setattr(dropbox, 'sleep', lambda secs: None)
+    commit = dropbox._get_commit_info('/data.dat')
+    offsets = []
+
+    def append(f, cursor, **kwargs):
+        offsets.append(cursor.offset)
+        LocalCloudClient.files_upload_session_append_v2(client, f, cursor, **kwargs)
+        if len(offsets) == 2:
+            # The chunk is received, but the response is lost:
+            raise requests.exceptions.ConnectionError
+
+    client.files_upload_session_append_v2 = append
+    with data_file.open('rb') as handle:
+        dropbox._upload_dropbox_file_session(client, handle, data_file.stat().st_size,
+                                             commit, 1000)
+
+    # The retried request fails with an incorrect offset error, from which the upload
+    # is resumed:
+    assert offsets == [1000, 2000, 2000, 3000, 4000, 5000, 6000, 7000, 8000, 9000]
+    assert (tmp_path / 'cloud' / 'data.dat').read_bytes() == data_file.read_bytes()
+
+
+def test_upload_session_file_shrinks(tmp_path, client, data_file):
+    commit = dropbox._get_commit_info('/data.dat')
+    file_size = data_file.stat().st_size
+    with data_file.open('rb') as handle:
+        # Truncate the file after its size was checked:
+        with data_file.open('r+b') as other_handle:
+            other_handle.truncate(2500)
+        dropbox._upload_dropbox_file_session(client, handle, file_size, commit, 1000)
+
+    assert (tmp_path / 'cloud' / 'data.dat').read_bytes() == data_file.read_bytes()
+
+
+def test_get_file_index(client, make_files, monkeypatch):
+    monkeypatch.setattr(local, 'LIST_FOLDER_PAGE_SIZE', 2)
+    make_files(client.root_dir, {'archive/A.txt': 'a', 'archive/sub/b.txt': 'b',
+                                 'archive/sub/deep/c.txt': 'c', 'other.txt': ''})
+    counter = APICallCounter(client)
+    index = dropbox.get_file_index(counter, 'archive')
+    assert sorted(index) == ['/archive/a.txt', '/archive/sub/b.txt',
+                             '/archive/sub/deep/c.txt']
+    assert index['/archive/a.txt'].name == 'A.txt'
+    # Five entries (including two directories) are listed in three pages:
+    assert counter.counts == {'files_list_folder': 1, 'files_list_folder_continue': 2}
+
+
+def test_get_file_index_not_found(client):
+    assert dropbox.get_file_index(client, '/archive') == {}
+
+
+def test_archive_directory_lists_existing_files_once(tmp_path, client, make_files):
+    local_dir = make_files(tmp_path / 'wk', {'a.txt': 'a', 'sub/b.txt': 'b'})
+    make_files(client.root_dir, {'archive/a.txt': 'old'})
+    counter = APICallCounter(client)
+    dropbox.archive_directory(counter, local_dir, '/archive')
+    assert counter.counts['files_list_folder'] == 1
+    assert 'files_get_metadata' not in counter.counts
+
+
+def test_upload_files_in_batches(tmp_path, client, make_files, read_tree, set_config,
+                                 monkeypatch):
+    monkeypatch.setattr(dropbox, 'UPLOAD_BATCH_MAX_ENTRIES', 2)
+    set_config(cloud_upload_chunk_size=10, cloud_upload_workers=3)
+    files = {'small_{}.txt'.format(i): str(i) for i in range(5)}
+    files.update({'large.txt': 'x' * 25})
+    local_dir = make_files(tmp_path / 'wk', files)
+
+    counter = APICallCounter(client)
+    out = dropbox.upload_dropbox_dir(counter, local_dir, '/archive')
+
+    assert read_tree(client.root_dir / 'archive') == files
+    assert counter.counts['files_upload_session_finish_batch'] == 3
+    assert counter.counts['files_upload_session_finish'] == 1
+    assert out == {'considered': 6, 'skipped': 0, 'copied': 6, 'bytes_copied': 30}
+
+
+def test_upload_files_batch_failures(tmp_path, client, make_files, read_tree):
+    local_dir = make_files(tmp_path / 'wk', {'a.txt': 'a', 'b.txt': 'b'})
+    make_files(client.root_dir, {'archive/a.txt': 'conflict'})
+
+    out = dropbox.upload_dropbox_dir(client, local_dir, '/archive', autorename=False)
+    # The conflicting file is not committed:
+    assert read_tree(client.root_dir / 'archive') == {'a.txt': 'conflict', 'b.txt': 'b'}
+    assert out['copied'] == 1
+    assert out['bytes_copied'] == 1
+
+
+def test_get_dropbox_reuses_client(set_config):
+    set_config(dropbox_token='token')
+    assert dropbox.get_dropbox() is dropbox.get_dropbox()
+
+
+def test_get_content_hash(tmp_path, monkeypatch):
+    monkeypatch.setattr(dropbox, 'CONTENT_HASH_BLOCK_SIZE', 4)
+    path = tmp_path / 'a.txt'
+    path.write_bytes(b'abcdefghij')
+    block_hashes = [hashlib.sha256(i).digest() for i in [b'abcd', b'efgh', b'ij']]
+    assert dropbox.get_content_hash(path) == \
+        hashlib.sha256(b''.join(block_hashes)).hexdigest()
+
+    path.write_bytes(b'')
+    assert dropbox.get_content_hash(path) == hashlib.sha256(b'').hexdigest()
+
+
+def test_content_hash_matches_stored_file(tmp_path, client, data_file):
+    dropbox.upload_dropbox_file(client, data_file, '/')
+    metadata = client.files_get_metadata('/data.dat')
+    assert metadata.content_hash == dropbox.get_content_hash(data_file)
+
+
+@pytest.mark.parametrize('local_change,expected', [
+    (None, None),
+    ('older', {'overwrite': False, 'autorename': True}),
+    ('same_time', {'overwrite': True, 'autorename': False}),
+    ('newer', {'overwrite': True, 'autorename': False}),
+])
+def test_get_archive_write_args(tmp_path, client, local_change, expected):
+    local_path = tmp_path / 'a.txt'
+    local_path.write_text('a')
+    os.utime(local_path, (1000, 1000))
+    dropbox.upload_dropbox_file(client, local_path, '/', client_modified=None)
+    os.utime(client.root_dir / 'a.txt', (1000, 1000))
+
+    if local_change:
+        mtime = {'older': 10, 'same_time': 1000.5, 'newer': 2000}[local_change]
+        local_path.write_text('b')
+        os.utime(local_path, (mtime, mtime))
+    else:
+        # Only the modified time has changed:
+        os.utime(local_path, (2000, 2000))
+
+    write_args = dropbox._get_archive_write_args(
+        client, local_path, '/a.txt', file_index=dropbox.get_file_index(client, '/'))
+    if expected:
+        write_args.pop('client_modified')
+    assert write_args == expected
+
+
+def test_archive_directory_skips_unchanged_files(tmp_path, client, make_files, read_tree):
+    local_dir = make_files(tmp_path / 'wk', {'a.txt': 'a', 'sub/b.txt': 'b'})
+    out = dropbox.archive_directory(client, local_dir, '/archive')
+    assert out['copied'] == 2
+
+    # Touching a file does not cause it to be uploaded again:
+    os.utime(local_dir / 'a.txt', (10 ** 9, 10 ** 9))
+    local_dir.joinpath('sub', 'b.txt').write_text('bb')
+    out = dropbox.archive_directory(client, local_dir, '/archive')
+    assert out == {'considered': 2, 'skipped': 1, 'copied': 1, 'bytes_copied': 2}
+    assert read_tree(client.root_dir / 'archive') == {'a.txt': 'a', 'sub/b.txt': 'bb'}
+    # Content hashes are not cached in the local directory:
+    assert sorted(read_tree(local_dir)) == ['a.txt', 'sub/b.txt']
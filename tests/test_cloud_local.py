@@ -0,0 +1,155 @@
+from time import perf_counter
+
+import dropbox as dropbox_api
+import pytest
+
+from hpcflow.archive.cloud.cloud import CloudProvider
+from hpcflow.archive.cloud.errors import CloudProviderError
+from hpcflow.archive.cloud.providers import local
+from hpcflow.archive.cloud.providers.local import LocalCloudClient
+
+
+@pytest.fixture
+def client(tmp_path):
+    root_dir = tmp_path / 'cloud'
+    root_dir.mkdir()
+    return LocalCloudClient(root_dir)
+
+
+def upload(client, path, data, overwrite=False, autorename=False):
+    mode = dropbox_api.files.WriteMode('overwrite' if overwrite else 'add', None)
+    return client.files_upload(data, path, mode=mode, autorename=autorename)
+
+
+def test_get_client(tmp_path, set_config):
+    set_config(local_cloud_dir=None)
+    with pytest.raises(CloudProviderError):
+        local.get_client()
+
+    set_config(local_cloud_dir=str(tmp_path / 'cloud'))
+    assert local.get_client() is local.get_client()
+    with pytest.raises(ValueError):
+        local.check_access()
+    (tmp_path / 'cloud').mkdir()
+    local.check_access()
+
+
+def test_upload_and_metadata(client):
+    metadata = upload(client, '/sub/a.txt', b'abc')
+    assert metadata.path_display == '/sub/a.txt'
+    assert metadata.size == 3
+    assert client.files_get_metadata('/sub/a.txt') == metadata
+    assert (client.root_dir / 'sub' / 'a.txt').read_bytes() == b'abc'
+
+    with pytest.raises(dropbox_api.exceptions.ApiError) as exc_info:
+        client.files_get_metadata('/sub/b.txt')
+    assert exc_info.value.error.get_path().is_not_found()
+
+
+def test_upload_write_modes(client):
+    upload(client, '/a.txt', b'a')
+
+    # Identical contents are not a conflict:
+    upload(client, '/a.txt', b'a')
+    with pytest.raises(dropbox_api.exceptions.ApiError):
+        upload(client, '/a.txt', b'b')
+
+    assert upload(client, '/a.txt', b'b', autorename=True).name == 'a (1).txt'
+    assert upload(client, '/a.txt', b'c', autorename=True).name == 'a (2).txt'
+    upload(client, '/a.txt', b'd', overwrite=True)
+    assert (client.root_dir / 'a.txt').read_bytes() == b'd'
+
+
+def test_upload_session(client):
+    start = client.files_upload_session_start(b'abc')
+    cursor = dropbox_api.files.UploadSessionCursor(start.session_id, 3)
+    client.files_upload_session_append_v2(b'def', cursor)
+
+    # Incorrect offset:
+    with pytest.raises(dropbox_api.exceptions.ApiError) as exc_info:
+        client.files_upload_session_append_v2(b'def', cursor)
+    assert exc_info.value.error.get_incorrect_offset().correct_offset == 6
+
+    cursor = dropbox_api.files.UploadSessionCursor(start.session_id, 6)
+    commit = dropbox_api.files.CommitInfo(path='/a.txt')
+    client.files_upload_session_finish(b'g', cursor, commit)
+    assert (client.root_dir / 'a.txt').read_bytes() == b'abcdefg'
+
+    # The session is finished:
+    with pytest.raises(dropbox_api.exceptions.ApiError):
+        client.files_upload_session_finish(b'', cursor, commit)
+
+
+def test_upload_session_finish_batch(client):
+    upload(client, '/conflict.txt', b'old')
+    entries = []
+    for name, close in [('a.txt', True), ('b.txt', False), ('conflict.txt', True)]:
+        start = client.files_upload_session_start(name.encode(), close=close)
+        cursor = dropbox_api.files.UploadSessionCursor(start.session_id, len(name))
+        commit = dropbox_api.files.CommitInfo(path='/' + name)
+        entries.append(dropbox_api.files.UploadSessionFinishArg(cursor, commit))
+
+    result = client.files_upload_session_finish_batch(entries).get_complete()
+    # Sessions must be closed before they are committed in a batch, and conflicting
+    # files are not committed:
+    assert [i.is_success() for i in result.entries] == [True, False, False]
+    assert (client.root_dir / 'a.txt').read_bytes() == b'a.txt'
+    assert (client.root_dir / 'conflict.txt').read_bytes() == b'old'
+
+
+def test_list_folder(client, monkeypatch):
+    monkeypatch.setattr(local, 'LIST_FOLDER_PAGE_SIZE', 2)
+    for path in ['/a.txt', '/sub/b.txt', '/sub/c.txt']:
+        upload(client, path, b'')
+    # The emulator's own files are not listed:
+    assert client.root_dir.joinpath('.hpcflow').is_dir()
+
+    result = client.files_list_folder('/', recursive=False)
+    assert [i.name for i in result.entries] == ['sub', 'a.txt']
+    assert not result.has_more
+
+    result = client.files_list_folder('/', recursive=True)
+    entries = result.entries
+    while result.has_more:
+        result = client.files_list_folder_continue(result.cursor)
+        entries += result.entries
+    assert [i.path_display for i in entries] == ['/sub', '/a.txt', '/sub/b.txt',
+                                                 '/sub/c.txt']
+
+    with pytest.raises(dropbox_api.exceptions.ApiError):
+        client.files_list_folder('/a.txt')
+
+
+def test_move_and_download(tmp_path, client):
+    upload(client, '/a.txt', b'a')
+    client.files_move_v2('/a.txt', '/sub/b.txt')
+    client.files_download_to_file(str(tmp_path / 'b.txt'), '/sub/b.txt')
+    assert (tmp_path / 'b.txt').read_bytes() == b'a'
+
+    with pytest.raises(dropbox_api.exceptions.ApiError):
+        client.files_move_v2('/a.txt', '/c.txt')
+
+
+def test_malformed_path(client):
+    with pytest.raises(dropbox_api.exceptions.ApiError):
+        client.files_get_metadata('/../a.txt')
+
+
+def test_latency_and_bandwidth(tmp_path):
+    client = LocalCloudClient(tmp_path, latency=0.05, bandwidth_MB=1)
+    start = perf_counter()
+    client.files_upload_session_start(b'x' * (2**20 // 10))
+    assert perf_counter() - start >= 0.14
+
+
+def test_archive_directory(tmp_path, make_files, read_tree, set_config):
+    set_config(local_cloud_dir=str(tmp_path / 'cloud'))
+    (tmp_path / 'cloud').mkdir()
+    src = make_files(tmp_path / 'wk', {'a.txt': 'a', 'sub/b.txt': 'b'})
+
+    out = CloudProvider.local.archive_directory(src, '/archive', [])
+    assert read_tree(tmp_path / 'cloud' / 'archive') == read_tree(src)
+    assert out['copied'] == 2
+    assert out['api_calls']['files_list_folder'] == 1
+    assert CloudProvider.local.check_exists('/archive')
+    assert CloudProvider.local.get_directories('/archive') == ['sub']
@@ -0,0 +1,95 @@
+import errno
+import os
+from shutil import Error
+
+import pytest
+
+from hpcflow import copytree
+from hpcflow.copytree import copy2_fast, copyfile_fast, copytree_parallel
+
+
+@pytest.fixture
+def big_file(tmp_path):
+    path = tmp_path / 'big.dat'
+    path.write_bytes(os.urandom(3 * 1000 + 7))
+    return path
+
+
+def test_copyfile_fast(tmp_path, big_file, monkeypatch):
+    monkeypatch.setattr(copytree, '_FAST_COPY_BLOCK_SIZE', 1000)
+    copyfile_fast(big_file, tmp_path / 'copy.dat')
+    assert (tmp_path / 'copy.dat').read_bytes() == big_file.read_bytes()
+
+
+def test_copyfile_fast_empty(tmp_path):
+    (tmp_path / 'empty.dat').write_bytes(b'')
+    (tmp_path / 'copy.dat').write_bytes(b'old')
+    copyfile_fast(tmp_path / 'empty.dat', tmp_path / 'copy.dat')
+    assert (tmp_path / 'copy.dat').read_bytes() == b''
+
+
+@pytest.mark.parametrize('failure', ['unsupported', 'nothing_copied'])
+def test_copyfile_fast_fallback(tmp_path, big_file, monkeypatch, failure):
+    calls = []
+
+    def fast_copy(fsrc, fdst, offset, count):
+        calls.append(offset)
+        if failure == 'unsupported':
+            raise OSError(errno.EXDEV, os.strerror(errno.EXDEV))
+        return 0
+
+    monkeypatch.setattr(copytree, '_copy_file_range', fast_copy)
+    monkeypatch.setattr(copytree, '_sendfile', fast_copy)
+    monkeypatch.setattr(copytree, '_HAS_COPY_FILE_RANGE', True)
+    monkeypatch.setattr(copytree, '_HAS_SENDFILE', True)
+
+    copyfile_fast(big_file, tmp_path / 'copy.dat')
+    assert (tmp_path / 'copy.dat').read_bytes() == big_file.read_bytes()
+    # Both kernel-side copies are attempted once before using `shutil.copyfile`:
+    assert calls == [0, 0]
+
+
+def test_copyfile_fast_other_errors_are_raised(tmp_path, big_file, monkeypatch):
+
+    def fast_copy(fsrc, fdst, offset, count):
+        raise OSError(errno.EIO, os.strerror(errno.EIO))
+
+    monkeypatch.setattr(copytree, '_copy_file_range', fast_copy)
+    monkeypatch.setattr(copytree, '_HAS_COPY_FILE_RANGE', True)
+    with pytest.raises(OSError):
+        copyfile_fast(big_file, tmp_path / 'copy.dat')
+
+
+def test_copy2_fast_copies_metadata(tmp_path, big_file):
+    os.utime(big_file, ns=(10 ** 9, 2 * 10 ** 9))
+    copy2_fast(big_file, tmp_path / 'copy.dat')
+    assert os.stat(tmp_path / 'copy.dat').st_mtime_ns == 2 * 10 ** 9
+
+
+def test_copytree_parallel(tmp_path, make_files, read_tree):
+    files = {'{}/{}.txt'.format(i % 3, i): str(i) for i in range(20)}
+    src = make_files(tmp_path / 'src', dict(files, **{'skip.log': ''}))
+    os.symlink('0/0.txt', src / 'link.txt')
+    os.utime(src / '0', ns=(0, 0))
+
+    def ignore(src_dir, names):
+        return [i for i in names if i.endswith('.log')]
+
+    copytree_parallel(str(src), str(tmp_path / 'dst'), symlinks=True, ignore=ignore,
+                      max_workers=4)
+    assert read_tree(tmp_path / 'dst') == dict(files, **{'link.txt': '0'})
+    assert os.readlink(tmp_path / 'dst' / 'link.txt') == '0/0.txt'
+    # Directory metadata is copied after the directory contents:
+    assert os.stat(tmp_path / 'dst' / '0').st_mtime_ns == 0
+
+
+def test_copytree_parallel_collects_errors(tmp_path, make_files, read_tree):
+    src = make_files(tmp_path / 'src', {'a.txt': 'a', 'b.txt': 'b', 'c.txt': 'c'})
+    dst = tmp_path / 'dst'
+    dst.joinpath('b.txt').mkdir(parents=True)
+
+    with pytest.raises(Error) as exc_info:
+        copytree_parallel(str(src), str(dst), max_workers=2)
+    assert [os.path.basename(i[0]) for i in exc_info.value.args[0]] == ['b.txt']
+    # Other files are still copied:
+    assert read_tree(dst) == {'a.txt': 'a', 'c.txt': 'c'}
@@ -0,0 +1,392 @@
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy.orm import Session
+
+from hpcflow import models
+from hpcflow.archive.archive import TaskArchiveStatus
+from hpcflow.config import Config as CONFIG
+from hpcflow.models import IterationStatus, KillResult, RootArchiveStatus, Workflow
+from hpcflow.project import Project
+from hpcflow.records import read_record
+from hpcflow.scheduler import SunGridEngine
+
+
+@pytest.fixture
+def loop_submission(make_submission):
+    """Get a submission of a command group with three tasks and two loop
+    iterations."""
+
+    return make_submission({
+        'command_groups': [{
+            'commands': 'echo <<num>>',
+            'scheduler': 'sge',
+            'auto_throttle': True,
+        }],
+        'variables': {'num': {'data': [1, 2, 3], 'value': '{}'}},
+        'loop': {'max_iterations': 2},
+    })
+
+
+@pytest.fixture
+def root_archive_submission(tmp_path, make_submission, set_config, monkeypatch):
+    """Get a submission whose command group is archived to the root archive, where
+    the root archive process has not yet completed."""
+
+    set_config(archive_debounce=0,
+               archive_locations={'local': {'path': str(tmp_path / 'archive')}})
+    # The root archive process is not started:
+    monkeypatch.setattr(Workflow, 'start_root_archive', lambda self: None)
+    tmp_path.joinpath('archive').mkdir()
+    submission = make_submission({
+        'command_groups': [{
+            'commands': 'echo 1',
+            'scheduler': 'sge',
+            'archive': 'local',
+        }],
+        'root_archive': 'local',
+    })
+    submission.workflow.root_archive_status = RootArchiveStatus('active')
+    submission.workflow.root_archive_heartbeat = datetime.now()
+    cg_sub = submission.command_group_submissions[0]
+    cg_sub.get_task(0, cg_sub.get_iteration(0)).end_time = datetime.now()
+    Session.object_session(submission).commit()
+    return submission
+
+
+def test_do_archive_waits_for_root_archive(root_archive_submission, monkeypatch):
+    workflow = root_archive_submission.workflow
+    sleeps = []
+
+    def root_archive_completes(secs):
+        sleeps.append(secs)
+        workflow.root_archive_status = RootArchiveStatus('complete')
+        Session.object_session(workflow).commit()
+
+    monkeypatch.setattr(models, 'sleep', root_archive_completes)
+    cg_sub = root_archive_submission.command_group_submissions[0]
+    cg_sub.do_archive(0, 0)
+
+    assert len(sleeps) == 1
+    task = cg_sub.get_task(0, cg_sub.get_iteration(0))
+    assert task.archive_status == TaskArchiveStatus('complete')
+
+
+def test_do_archive_root_archive_timeout(root_archive_submission, monkeypatch,
+                                        set_config):
+    set_config(root_archive_timeout=60)
+    workflow = root_archive_submission.workflow
+    workflow.root_archive_heartbeat = datetime.now() - timedelta(seconds=120)
+    Session.object_session(workflow).commit()
+
+    monkeypatch.setattr(models, 'sleep', lambda secs: None)
+    cg_sub = root_archive_submission.command_group_submissions[0]
+    cg_sub.do_archive(0, 0)
+
+    # The root archive process is assumed to have died, and the task is archived:
+    assert workflow.root_archive_status == RootArchiveStatus('failed')
+    task = cg_sub.get_task(0, cg_sub.get_iteration(0))
+    assert task.archive_status == TaskArchiveStatus('complete')
+
+
+def test_set_task_end_last_task(loop_submission):
+    cg_sub = loop_submission.command_group_submissions[0]
+    assert [cg_sub.set_task_end(i, 0) for i in range(3)] == [False, False, True]
+    # Tasks of the next iteration are counted separately:
+    assert not cg_sub.set_task_end(0, 1)
+
+
+def test_contention_curve(loop_submission, set_config):
+    cg_sub = loop_submission.command_group_submissions[0]
+    cg_sub_iter = cg_sub.get_command_group_submission_iteration(cg_sub.get_iteration(0))
+    start = datetime.now()
+    # Launch time, end time and lock wait of each task:
+    times = [(0, 1.5, 1.0), (1, 3, 5.0), (2, None, 9.0)]
+    for task, (launch, end, wait) in zip(cg_sub_iter.tasks, times):
+        task.launch_time = start + timedelta(seconds=launch)
+        if end is not None:
+            task.end_time = start + timedelta(seconds=end)
+        task.start_wait = wait
+
+    # The first task had ended when the third task was launched:
+    assert cg_sub_iter.get_contention_curve() == {1: 1.0, 2: 7.0}
+    assert cg_sub_iter.recommend_max_running_tasks(max_wait=8) is None
+    assert cg_sub_iter.recommend_max_running_tasks(max_wait=6) == 1
+
+
+@pytest.mark.parametrize('qalter_success', [True, False])
+def test_throttle_next_iteration(loop_submission, monkeypatch, qalter_success):
+    cg_sub = loop_submission.command_group_submissions[0]
+    next_cg_sub_iter = cg_sub.get_command_group_submission_iteration(
+        cg_sub.get_iteration(1))
+    next_cg_sub_iter.scheduler_job_id = 123
+
+    calls = []
+
+    def set_max_running_tasks(self, scheduler_job_id, max_running_tasks):
+        calls.append((scheduler_job_id, max_running_tasks))
+        return qalter_success
+
+    monkeypatch.setattr(SunGridEngine, 'set_max_running_tasks', set_max_running_tasks)
+    monkeypatch.setattr(models.CommandGroupSubmissionIteration,
+                        'recommend_max_running_tasks', lambda self: 2)
+    cg_sub.throttle_next_iteration(0)
+
+    assert calls == [(123, 2)]
+    # The maximum is only recorded if it was set successfully:
+    assert next_cg_sub_iter.max_running_tasks == (2 if qalter_success else None)
+
+
+def test_kill_active(loop_submission, monkeypatch, set_config):
+    set_config(kill_batch_size=2)
+    cg_sub = loop_submission.command_group_submissions[0]
+    cg_sub_iters = [cg_sub.get_command_group_submission_iteration(cg_sub.get_iteration(i))
+                    for i in range(2)]
+    cg_sub_iters[0].scheduler_job_id = 1001
+    cg_sub_iters[0].scheduler_stats_job_id = 1002
+    cg_sub_iters[1].scheduler_job_id = 1003
+
+    batches = []
+
+    def delete_jobs(self, scheduler_job_ids):
+        batches.append(scheduler_job_ids)
+        return {i: 'inactive' if i == 1002 else 'deleted' for i in scheduler_job_ids}
+
+    monkeypatch.setattr(SunGridEngine, 'delete_jobs', delete_jobs)
+
+    # Only active jobs are deleted:
+    monkeypatch.setattr(SunGridEngine, 'get_active_job_ids', lambda self: {1003})
+    loop_submission.workflow.kill_active()
+    assert batches == [[1003]]
+    assert [i.kill_result for i in cg_sub_iters] == [KillResult('inactive'),
+                                                     KillResult('deleted')]
+
+    # If the job states cannot be queried, all jobs are deleted, in batches:
+    batches.clear()
+    monkeypatch.setattr(SunGridEngine, 'get_active_job_ids', lambda self: None)
+    loop_submission.workflow.kill_active()
+    assert batches == [[1001, 1002], [1003]]
+    assert [i.kill_result for i in cg_sub_iters] == [KillResult('deleted'),
+                                                     KillResult('deleted')]
+
+
+
+@pytest.fixture
+def input_cache_submission(tmp_path, make_submission):
+    """Get a submission of a command group with three tasks and two loop iterations,
+    which stages input files via an alternate scratch input cache."""
+
+    tmp_path.joinpath('scratch').mkdir()
+    submission = make_submission({
+        'command_groups': [{
+            'commands': 'echo <<num>>',
+            'scheduler': 'sge',
+            'alternate_scratch': str(tmp_path / 'scratch'),
+            'alternate_scratch_cache': ['*.dat'],
+        }],
+        'variables': {'num': {'data': [1, 2, 3], 'value': '{}'}},
+        'loop': {'max_iterations': 2},
+    })
+    cache_dir = submission.command_group_submissions[0].input_cache_dir
+    cache_dir.mkdir()
+    return submission
+
+
+def test_is_input_cache_in_use(input_cache_submission):
+    cg_sub = input_cache_submission.command_group_submissions[0]
+    for iter_idx in range(2):
+        # Tasks of later iterations may yet run:
+        assert input_cache_submission.is_input_cache_in_use()
+        cg_sub.get_iteration(iter_idx).status = IterationStatus('active')
+        for task_idx in range(3):
+            assert input_cache_submission.is_input_cache_in_use()
+            cg_sub.set_task_end(task_idx, iter_idx)
+    assert not input_cache_submission.is_input_cache_in_use()
+
+
+@pytest.mark.parametrize('outcome', ['deleted', 'failed'])
+def test_kill_active_evicts_input_caches(input_cache_submission, monkeypatch, outcome):
+    cg_sub = input_cache_submission.command_group_submissions[0]
+    cg_sub_iter = cg_sub.get_command_group_submission_iteration(cg_sub.get_iteration(0))
+    cg_sub_iter.scheduler_job_id = 1001
+
+    monkeypatch.setattr(SunGridEngine, 'get_active_job_ids', lambda self: {1001})
+    monkeypatch.setattr(SunGridEngine, 'delete_jobs',
+                        lambda self, job_ids: {i: outcome for i in job_ids})
+    input_cache_submission.workflow.kill_active()
+
+    # Killed tasks never end, so the cache is removed unless a job may still be running:
+    assert cg_sub.input_cache_dir.is_dir() == (outcome == 'failed')
+
+@pytest.fixture
+def partial_hold_submission(make_submission):
+    """Get a submission of two command groups of three tasks each, where the tasks of
+    the second command group are held individually."""
+
+    return make_submission({
+        'command_groups': [
+            {'commands': 'echo <<num>>', 'scheduler': 'sge'},
+            {'commands': 'echo <<num>>', 'scheduler': 'sge', 'partial_hold': True},
+        ],
+        'variables': {'num': {'data': [1, 2, 3], 'value': '{}'}},
+    })
+
+
+@pytest.mark.parametrize('delete_orphans', [False, True])
+def test_release_dependent_tasks(partial_hold_submission, monkeypatch, set_config,
+                                 delete_orphans):
+    set_config(kill_batch_size=1)
+    upstream, downstream = partial_hold_submission.command_group_submissions
+    iteration = upstream.get_iteration(0)
+    cg_sub_iter = downstream.get_command_group_submission_iteration(iteration)
+    cg_sub_iter.scheduler_job_id = 1001
+    # The third upstream task did not finalise its outputs (e.g. it was killed):
+    up_tasks = upstream.get_command_group_submission_iteration(iteration).tasks
+    for task in up_tasks[:2]:
+        task.outputs_finalised = True
+
+    calls = []
+
+    def release_tasks(self, scheduler_job_id, task_ids):
+        calls.append(('release', scheduler_job_id, task_ids))
+        return True
+
+    def delete_tasks(self, scheduler_job_id, task_ids):
+        calls.append(('delete', scheduler_job_id, task_ids))
+        return True
+
+    monkeypatch.setattr(SunGridEngine, 'release_tasks', release_tasks)
+    monkeypatch.setattr(SunGridEngine, 'delete_tasks', delete_tasks)
+    upstream.release_dependent_tasks(0, delete_orphans=delete_orphans)
+
+    # Tasks are released in batches:
+    expected = [('release', 1001, [1]), ('release', 1001, [2])]
+    if delete_orphans:
+        expected.append(('delete', 1001, [3]))
+    assert calls == expected
+    assert [i.dependency_released for i in cg_sub_iter.tasks] == [True, True, False]
+
+    # Released tasks are not released again:
+    calls.clear()
+    upstream.release_dependent_tasks(0)
+    assert calls == []
+
+
+def test_write_jobscripts_release(partial_hold_submission):
+    hf_dir = partial_hold_submission.workflow.directory / '.hpcflow'
+    partial_hold_submission.write_submit_dirs(hf_dir)
+    js_paths, _, js_release_paths = partial_hold_submission.write_jobscripts(hf_dir)
+
+    # Only the upstream command group releases held tasks:
+    assert js_release_paths[1] is None
+    assert js_release_paths[0].is_file()
+    assert (partial_hold_submission.get_jobscript_paths(hf_dir) ==
+            (js_paths, [None, None], js_release_paths))
+
+
+def test_working_dir_record_width(make_submission, set_config):
+    set_config(working_dir_record_width=64)
+    long_dir = 'sim_' + 'x' * 96
+    submission = make_submission({
+        'command_groups': [{
+            'commands': 'echo 1',
+            'scheduler': 'sge',
+            'directory': '<<sim_dir>>',
+        }],
+        'variables': {'sim_dir': {'data': [long_dir, 'sim_1'], 'value': '{}'}},
+    })
+
+    # The record width fits the longest working directory resolved at submission:
+    assert submission.working_dir_record_width == len(long_dir) + 1
+    hf_dir = submission.workflow.directory / '.hpcflow'
+    submission.write_submit_dirs(hf_dir)
+    js_path = submission.write_jobscripts(hf_dir)[0][0]
+    assert 'bs={} '.format(len(long_dir) + 1) in js_path.read_text()
+
+    cg_sub = submission.command_group_submissions[0]
+    project = Project(submission.workflow.directory, CONFIG.get('config_dir'))
+    wk_dirs_path = js_path.parent.joinpath('iter_0', 'working_dirs_0.txt')
+    for task_idx in range(2):
+        cg_sub.write_working_directory(project, task_idx, submission.first_iteration)
+    assert sorted([read_record(wk_dirs_path, i, len(long_dir) + 1)
+                   for i in range(2)]) == ['sim_1', long_dir]
+
+
+@pytest.fixture
+def dynamic_loop_submission(make_submission):
+    """Get a submission of a dynamic loop of a command group with three tasks, followed
+    by a command group that runs once the loop has converged. The loop converges once
+    the file `converged` exists in the workflow directory."""
+
+    submission = make_submission({
+        'command_groups': [
+            {'commands': 'echo <<num>>', 'scheduler': 'sge'},
+            {'commands': 'echo done', 'scheduler': 'sge'},
+        ],
+        'variables': {'num': {'data': [1, 2, 3], 'value': '{}'}},
+        'loop': {
+            'max_iterations': 3,
+            'groups': [0],
+            'convergence_command': 'test -f converged',
+        },
+    })
+    submission.write_submit_dirs(submission.workflow.directory / '.hpcflow')
+    return submission
+
+
+def test_check_loop(dynamic_loop_submission, monkeypatch):
+    submitted = []
+    monkeypatch.setattr(models.Submission, '_submit_jobscripts',
+                        lambda self, js_submissions, *args: submitted.append(
+                            js_submissions))
+    project = Project(dynamic_loop_submission.workflow.directory,
+                      CONFIG.get('config_dir'))
+    cg_sub = dynamic_loop_submission.command_group_submissions[0]
+    iterations = dynamic_loop_submission.workflow.iterations
+
+    # Not all tasks of the iteration have ended:
+    cg_sub.set_task_end(0, 0)
+    cg_sub.check_loop(project, 0, 0)
+    assert submitted == []
+    assert iterations[0].status == IterationStatus('active')
+
+    # Not converged, so the next iteration is submitted:
+    for task_idx in range(1, 3):
+        cg_sub.set_task_end(task_idx, 0)
+    cg_sub.check_loop(project, 2, 0)
+    assert submitted == [[(0, 1)]]
+    assert [i.status for i in iterations] == [IterationStatus('complete'),
+                                              IterationStatus('active'),
+                                              IterationStatus('pending')]
+
+    # The loop is only continued once per iteration:
+    cg_sub.check_loop(project, 1, 0)
+    assert len(submitted) == 1
+
+    # Converged, so the command groups that follow the loop are submitted:
+    dynamic_loop_submission.workflow.directory.joinpath('converged').touch()
+    for task_idx in range(3):
+        cg_sub.set_task_end(task_idx, 1)
+    cg_sub.check_loop(project, 0, 1)
+    assert submitted[1] == [(1, 0)]
+    assert iterations[2].status == IterationStatus('pending')
+
+
+def test_check_loop_failure(dynamic_loop_submission, monkeypatch):
+
+    def submit_jobscripts(self, *args):
+        raise ValueError('Could not retrieve the job ID.')
+
+    monkeypatch.setattr(models.Submission, '_submit_jobscripts', submit_jobscripts)
+    project = Project(dynamic_loop_submission.workflow.directory,
+                      CONFIG.get('config_dir'))
+    cg_sub = dynamic_loop_submission.command_group_submissions[0]
+    for task_idx in range(3):
+        cg_sub.set_task_end(task_idx, 0)
+
+    with pytest.raises(ValueError):
+        cg_sub.check_loop(project, 2, 0)
+
+    # The iteration remains active, so the loop check may be retried:
+    iteration = dynamic_loop_submission.workflow.iterations[0]
+    assert iteration.status == IterationStatus('active')
@@ -0,0 +1,95 @@
+import pytest
+
+from hpcflow.records import (INDEX_RECORD_WIDTH, append_indexed, read_indexed,
+                             read_record, write_record)
+
+WORKING_DIR_RECORD_WIDTH = 256
+
+
+def test_write_read_record_round_trip(tmp_path):
+    path = tmp_path / 'records.txt'
+    write_record(path, 0, 'sim_0', WORKING_DIR_RECORD_WIDTH)
+    write_record(path, 2, 'sim_2/run', WORKING_DIR_RECORD_WIDTH)
+    assert read_record(path, 0, WORKING_DIR_RECORD_WIDTH) == 'sim_0'
+    assert read_record(path, 2, WORKING_DIR_RECORD_WIDTH) == 'sim_2/run'
+
+
+def test_records_are_fixed_width_lines(tmp_path):
+    path = tmp_path / 'records.txt'
+    write_record(path, 0, 'a', 8)
+    write_record(path, 1, 'bb', 8)
+    assert path.read_bytes() == b'a      \nbb     \n'
+
+
+def test_write_record_in_place(tmp_path):
+    path = tmp_path / 'records.txt'
+    write_record(path, 0, 'first', 16)
+    write_record(path, 1, 'second', 16)
+    write_record(path, 0, 'new', 16)
+    assert read_record(path, 0, 16) == 'new'
+    assert read_record(path, 1, 16) == 'second'
+
+
+def test_read_unwritten_record(tmp_path):
+    path = tmp_path / 'records.txt'
+    write_record(path, 2, 'third', 16)
+    # Records before the last written record are a hole in the file:
+    assert read_record(path, 0, 16) is None
+    # Records after the end of the file:
+    assert read_record(path, 3, 16) is None
+
+
+def test_record_max_length(tmp_path):
+    path = tmp_path / 'records.txt'
+    record = 'x' * (WORKING_DIR_RECORD_WIDTH - 1)
+    write_record(path, 0, record, WORKING_DIR_RECORD_WIDTH)
+    assert read_record(path, 0, WORKING_DIR_RECORD_WIDTH) == record
+
+
+def test_record_too_long(tmp_path):
+    path = tmp_path / 'records.txt'
+    with pytest.raises(ValueError):
+        write_record(path, 0, 'x' * WORKING_DIR_RECORD_WIDTH, WORKING_DIR_RECORD_WIDTH)
+
+
+def test_record_width_is_in_bytes(tmp_path):
+    path = tmp_path / 'records.txt'
+    record = 'é' * 4  # Two bytes per character
+    with pytest.raises(ValueError):
+        write_record(path, 0, record, 8)
+    write_record(path, 0, record, 9)
+    assert read_record(path, 0, 9) == record
+
+
+def test_append_read_indexed_round_trip(tmp_path):
+    data_path = tmp_path / 'data.dat'
+    index_path = tmp_path / 'data.idx'
+    append_indexed(data_path, index_path, 1, b'second')
+    append_indexed(data_path, index_path, 0, b'first\n')
+    assert read_indexed(data_path, index_path, 0) == b'first\n'
+    assert read_indexed(data_path, index_path, 1) == b'second'
+    assert data_path.read_bytes() == b'secondfirst\n'
+    assert index_path.stat().st_size == 2 * INDEX_RECORD_WIDTH
+
+
+def test_append_indexed_empty_data(tmp_path):
+    data_path = tmp_path / 'data.dat'
+    index_path = tmp_path / 'data.idx'
+    append_indexed(data_path, index_path, 0, b'')
+    assert read_indexed(data_path, index_path, 0) == b''
+
+
+def test_read_indexed_unwritten(tmp_path):
+    data_path = tmp_path / 'data.dat'
+    index_path = tmp_path / 'data.idx'
+    append_indexed(data_path, index_path, 1, b'second')
+    assert read_indexed(data_path, index_path, 0) is None
+    assert read_indexed(data_path, index_path, 2) is None
+
+
+def test_append_indexed_rewrites_record(tmp_path):
+    data_path = tmp_path / 'data.dat'
+    index_path = tmp_path / 'data.idx'
+    append_indexed(data_path, index_path, 0, b'old')
+    append_indexed(data_path, index_path, 0, b'new')
+    assert read_indexed(data_path, index_path, 0) == b'new'
@@ -0,0 +1,133 @@
+from subprocess import CompletedProcess
+
+import pytest
+
+from hpcflow import scheduler as scheduler_module
+from hpcflow.scheduler import SunGridEngine
+
+
+@pytest.fixture
+def fake_run(monkeypatch):
+    """Replace scheduler commands with a function that records the command and returns
+    given output."""
+
+    calls = []
+
+    def set_output(stdout='', stderr='', returncode=0):
+
+        def run(cmd, **kwargs):
+            calls.append(cmd)
+            return CompletedProcess(cmd, returncode, stdout.encode(), stderr.encode())
+
+        monkeypatch.setattr(scheduler_module, 'run', run)
+        return calls
+
+    return set_output
+
+
+def test_get_active_job_ids(fake_run):
+    fake_run(stdout=(
+        'job-ID  prior   name       user         state submit/start at     queue\n'
+        '-----------------------------------------------------------------------\n'
+        '   1001 0.5 js_0.sh    user     r     01/01/2020 10:00:00 all.q@node1  1\n'
+        '   1001 0.5 js_0.sh    user     qw    01/01/2020 10:00:00              2-4:1\n'
+        '   1002 0.0 js_1.sh    user     hqw   01/01/2020 10:00:00              1-4:1\n'
+    ))
+    assert SunGridEngine(options={}).get_active_job_ids() == {1001, 1002}
+
+    fake_run(stderr='error: failed receiving gdi request', returncode=1)
+    assert SunGridEngine(options={}).get_active_job_ids() is None
+
+
+def test_delete_jobs(fake_run):
+    calls = fake_run(stdout=(
+        'user has registered the job-array task 1001.2 for deletion\n'
+        'user has deleted job 1002\n'
+        'job 1004 is already in deletion\n'
+    ), stderr='denied: job "1003" does not exist', returncode=1)
+
+    outcomes = SunGridEngine(options={}).delete_jobs([1001, 1002, 1003, 1004, 1005])
+    assert calls == [['qdel', '1001', '1002', '1003', '1004', '1005']]
+    assert outcomes == {1001: 'deleted', 1002: 'deleted', 1003: 'inactive',
+                        1004: 'deleted', 1005: 'failed'}
+
+
+def test_delete_jobs_no_output(fake_run):
+    fake_run()
+    assert SunGridEngine(options={}).delete_jobs([1001]) == {1001: 'deleted'}
+
+
+@pytest.fixture
+def submit_dir(tmp_path, set_config):
+    """Get the submit directory within a workflow directory `wk`."""
+    set_config(config_dir=str(tmp_path / 'config'))
+    submit_dir = tmp_path / 'wk' / '.hpcflow' / 'submit'
+    submit_dir.mkdir(parents=True)
+    return submit_dir
+
+
+def test_get_template_cached():
+    scheduler = SunGridEngine(options={})
+    template = scheduler.get_template('jobscript', archive=True)
+    assert scheduler.get_template('jobscript', archive=True) is template
+    # Disabled features do not change the template:
+    assert scheduler.get_template('jobscript', archive=True, loop_check=False) is template
+    assert SunGridEngine(options={}).get_template('jobscript', archive=True) is template
+    assert scheduler.get_template('jobscript') is not template
+
+
+FEATURE_LINES = {
+    'archive': 'hpcflow archive ',
+    'alternate_scratch_dir': 'hpcflow stage-in ',
+    'loop_check': 'hpcflow check-loop ',
+    'release_dependents': 'hpcflow release ',
+    'consolidate_logs': 'hpcflow append-log ',
+}
+
+
+@pytest.mark.parametrize('feature', [None] + sorted(FEATURE_LINES))
+def test_write_jobscript(submit_dir, feature):
+    features = {'archive': False, 'alternate_scratch_dir': None}
+    if feature:
+        features[feature] = '/scratch' if feature == 'alternate_scratch_dir' else True
+    js_path = SunGridEngine(options={'l': 'short'}).write_jobscript(
+        submit_dir, submit_dir.parents[1], 0, max_num_tasks=4, task_step_size=1,
+        environment=['module load app'], command_group_submission_id=5, name='name',
+        wk_dirs_record_width=300, **features)
+
+    assert js_path == submit_dir / 'js_0.sh'
+    js_text = js_path.read_text()
+    for feature_i, line in FEATURE_LINES.items():
+        assert (line in js_text) == (feature_i == feature)
+    assert '@@' not in js_text
+    assert '#$ -t 1-4:1' in js_text
+    assert '#$ -l short' in js_text
+    assert '\nmodule load app\n' in js_text
+    assert 'dd if=${ITER_DIR}/working_dirs_0.txt bs=300 ' in js_text
+    assert ('hpcflow set-task-end --directory $ROOT_DIR --config-dir {} 5 $TASK_IDX '
+            '$ITER_IDX'.format(submit_dir.parents[2] / 'config')) in js_text
+
+
+def test_write_stats_jobscript(submit_dir):
+    js_path = SunGridEngine(options={'l': 'long'}).write_stats_jobscript(
+        submit_dir, submit_dir.parents[1], 0, 4, 2, 5, 'name')
+
+    assert js_path == submit_dir / 'st_0.sh'
+    js_text = js_path.read_text()
+    assert '#$ -t 1-4:2' in js_text
+    # User options are not applied to the stats jobscript:
+    assert '#$ -l long' not in js_text
+    assert 'TASK_IDX=$((($SGE_TASK_ID - 1)/2))' in js_text
+    assert 'hpcflow get-scheduler-stats ' in js_text
+
+
+def test_write_release_jobscript(tmp_path, submit_dir):
+    js_path = SunGridEngine(options={}).write_release_jobscript(
+        submit_dir, tmp_path / 'wk', 1, 5, 'name')
+
+    assert js_path == submit_dir / 'rl_1.sh'
+    js_text = js_path.read_text()
+    assert 'SUBMIT_DIR=$ROOT_DIR/.hpcflow/submit' in js_text
+    assert '#$ -t 1-1:1' in js_text
+    assert ('hpcflow release-orphans --directory $ROOT_DIR --config-dir {} 5 $ITER_IDX'
+            .format(tmp_path / 'config')) in js_text
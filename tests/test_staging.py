@@ -0,0 +1,130 @@
+import os
+
+import pytest
+
+from hpcflow.staging import (InputCache, load_manifest, match_patterns,
+                             read_exclusion_list, stage_in, stage_out)
+
+
+@pytest.mark.parametrize('rel_path,patterns,expected', [
+    ('a.txt', ['*.txt'], True),
+    ('sub/a.txt', ['*.txt'], True),
+    ('a.dat', ['*.txt'], False),
+    ('a.txt', [], False),
+    # Anchored patterns match the whole path:
+    ('a.txt', ['/a.txt'], True),
+    ('sub/a.txt', ['/a.txt'], False),
+    ('sub/a.txt', ['/sub/*.txt'], True),
+    # Unanchored patterns match the same number of trailing components:
+    ('x/sub/a.txt', ['sub/*.txt'], True),
+    ('a.txt', ['sub/a.txt'], False),
+    # Trailing slashes (directory patterns) are ignored:
+    ('out', ['out/'], True),
+    # Empty patterns match nothing:
+    ('a.txt', ['/'], False),
+    # Matching is case sensitive:
+    ('A.TXT', ['*.txt'], False),
+    ('b.txt', ['a.txt', 'b.*'], True),
+])
+def test_match_patterns(rel_path, patterns, expected):
+    assert match_patterns(rel_path, patterns) == expected
+
+
+def test_read_exclusion_list(tmp_path):
+    path = tmp_path / 'exclude.txt'
+    path.write_text('# comment\n\n*.log\n  /out/  \n')
+    assert read_exclusion_list(path) == ['*.log', '/out/']
+
+
+def test_stage_in_out_round_trip(tmp_path, make_files, read_tree):
+    files = {'in.txt': 'in', 'sub/data.dat': 'data', 'sub/deep/x.txt': 'x'}
+    src = make_files(tmp_path / 'wk', files)
+    scratch = tmp_path / 'scratch'
+    manifest_path = tmp_path / 'manifest.json'
+
+    stats_in = stage_in(src, scratch, manifest_path=manifest_path, max_workers=2)
+    assert read_tree(scratch) == files
+    assert stats_in['files'] == 3
+    assert stats_in['bytes'] == sum(len(i) for i in files.values())
+    assert sorted(load_manifest(manifest_path)) == sorted(files)
+
+    # Modify one file and add another on the scratch:
+    scratch.joinpath('in.txt').write_text('modified')
+    scratch.joinpath('sub', 'out.txt').write_text('out')
+
+    stats_out = stage_out(scratch, src, manifest_path=manifest_path, max_workers=2)
+    assert stats_out['files'] == 2
+    assert stats_out['skipped'] == 2
+    assert read_tree(src) == dict(files, **{'in.txt': 'modified', 'sub/out.txt': 'out'})
+    # Files (but not directories) are removed from the scratch:
+    assert read_tree(scratch) == {}
+    assert scratch.joinpath('sub', 'deep').is_dir()
+
+
+def test_stage_in_exclusion_list(tmp_path, make_files, read_tree):
+    src = make_files(tmp_path / 'wk', {
+        'in.txt': 'in',
+        'run.log': 'log',
+        'out/result.txt': 'result',
+        'sub/out/keep.txt': 'keep',
+    })
+    exc_path = tmp_path / 'exclude.txt'
+    exc_path.write_text('*.log\n/out\n')
+
+    stats = stage_in(src, tmp_path / 'scratch', exclusion_list_path=exc_path)
+    assert read_tree(tmp_path / 'scratch') == {'in.txt': 'in', 'sub/out/keep.txt': 'keep'}
+    assert stats['skipped'] == 2
+
+
+def test_stage_out_without_manifest(tmp_path, make_files, read_tree):
+    scratch = make_files(tmp_path / 'scratch', {'a.txt': 'a', 'sub/b.txt': 'b'})
+    stats = stage_out(scratch, tmp_path / 'wk')
+    assert stats['files'] == 2
+    assert read_tree(tmp_path / 'wk') == {'a.txt': 'a', 'sub/b.txt': 'b'}
+
+
+def test_stage_out_symlink(tmp_path, make_files):
+    scratch = make_files(tmp_path / 'scratch', {'a.txt': 'a'})
+    os.symlink('a.txt', scratch / 'link.txt')
+    stage_out(scratch, tmp_path / 'wk')
+    link_path = tmp_path / 'wk' / 'link.txt'
+    assert link_path.is_symlink()
+    assert os.readlink(link_path) == 'a.txt'
+
+
+def test_stage_in_via_input_cache(tmp_path, make_files, read_tree):
+    cache_dir = tmp_path / 'cache'
+    for task_idx in range(2):
+        src = make_files(tmp_path / 'wk_{}'.format(task_idx), {
+            'shared.dat': 'shared',
+            'own.txt': 'own {}'.format(task_idx),
+        })
+        dst = tmp_path / 'scratch_{}'.format(task_idx)
+        stats = stage_in(src, dst, input_cache_dir=cache_dir,
+                         input_cache_patterns=['*.dat'])
+        assert read_tree(dst) == read_tree(src)
+        assert stats['cache_linked'] == 1
+        # The shared file is only added to the cache by the first task:
+        assert stats['cache_added'] == (1 if task_idx == 0 else 0)
+        # Bytes linked from the cache are not counted as copied:
+        assert stats['bytes'] == len('own {}'.format(task_idx))
+
+    assert os.path.samefile(tmp_path / 'scratch_0' / 'shared.dat',
+                            tmp_path / 'scratch_1' / 'shared.dat')
+
+
+def test_input_cache_evict(tmp_path, make_files):
+    src = make_files(tmp_path / 'wk', {'a.dat': 'a', 'b.dat': 'b'})
+    cache = InputCache(tmp_path / 'cache')
+    cache.copy_file(src / 'a.dat', tmp_path / 'a.dat')
+    cache.add(src / 'b.dat')
+
+    evicted = cache.evict()
+    assert evicted == {'referenced': 1, 'unreferenced': 1, 'bytes': 2}
+    assert not cache.path.exists()
+    assert not list(tmp_path.glob('cache*'))
+    # Linked files are unaffected:
+    assert (tmp_path / 'a.dat').read_text() == 'a'
+
+    # Already evicted:
+    assert cache.evict() is None
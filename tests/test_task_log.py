@@ -0,0 +1,45 @@
+from hpcflow.task_log import append_task_log, get_log_paths, read_task_log
+
+
+def test_append_read_task_log_round_trip(tmp_path):
+    task_log_path = tmp_path / 'log_0.1'
+    task_log_path.write_text('Running command: "echo hi"\nhi\n')
+    append_task_log(task_log_path, tmp_path, 0, 0)
+
+    task_log = read_task_log(tmp_path, 0, 0)
+    header, body = task_log.split('\n', 1)
+    assert header.startswith('=== hpcflow task log: task_idx=0 ')
+    assert body == 'Running command: "echo hi"\nhi\n'
+    assert not task_log_path.exists()
+
+
+def test_task_logs_are_framed_by_task(tmp_path):
+    for task_idx in [2, 0, 1]:
+        task_log_path = tmp_path / 'log_1.{}'.format(task_idx + 1)
+        task_log_path.write_text('task {}'.format(task_idx))
+        append_task_log(task_log_path, tmp_path, 1, task_idx)
+
+    for task_idx in range(3):
+        task_log = read_task_log(tmp_path, 1, task_idx)
+        # A final newline is added if missing:
+        assert task_log.endswith('\ntask {}\n'.format(task_idx))
+
+    log_path, index_path = get_log_paths(tmp_path, 1)
+    assert log_path.read_text().count('=== hpcflow task log:') == 3
+
+
+def test_read_task_log_not_appended(tmp_path):
+    # No consolidated log:
+    assert read_task_log(tmp_path, 0, 0) is None
+
+    task_log_path = tmp_path / 'log_0.2'
+    task_log_path.write_text('task 1')
+    append_task_log(task_log_path, tmp_path, 0, 1)
+    assert read_task_log(tmp_path, 0, 0) is None
+
+
+def test_read_task_log_replaces_invalid_bytes(tmp_path):
+    task_log_path = tmp_path / 'log_0.1'
+    task_log_path.write_bytes(b'bad \xff byte\n')
+    append_task_log(task_log_path, tmp_path, 0, 0)
+    assert read_task_log(tmp_path, 0, 0).endswith('bad � byte\n')